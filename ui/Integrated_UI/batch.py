@@ -0,0 +1,249 @@
+"""
+EdgeWriter - Offline batch runner
+Runs a writing task over many documents with the same templates and Phi-3
+engine as server.py, without going through HTTP.
+
+Examples:
+  python batch.py docs/ --task Proofread -o proofread.jsonl
+  python batch.py input.jsonl --task Rewrite --tone Formal -o out.jsonl
+
+Inputs can be directories (every .txt/.md file below them), single text
+files, or JSONL files whose lines carry "text" plus optional "id", "task",
+"tone" and "custom_tone". A document's id is its file path as reached from
+the input given (``<path>:<line>`` for a JSONL line without an "id"), and
+two documents with the same id stop the run before anything is submitted.
+A JSONL line that cannot be read is written to the output as an error.
+Results are appended to the output JSONL as they finish; re-running with the
+same output skips documents already written there, so an interrupted run
+picks up where it stopped.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+
+TEXT_EXTENSIONS = (".txt", ".md")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Process documents in bulk with the Phi-3 engine")
+    parser.add_argument("inputs", nargs="+", help="Directories, .txt/.md files or .jsonl files")
+    parser.add_argument("-o", "--output", required=True, help="JSONL file to append results to (also the checkpoint)")
+    parser.add_argument("--task", default="Proofread", help="Summarize, Proofread, Paraphrase or Rewrite (default: Proofread)")
+    parser.add_argument("--tone", default="Neutral", help="Tone for Rewrite")
+    parser.add_argument("--custom-tone", default="", help="Style description when --tone Custom")
+    parser.add_argument("--in-flight", type=int, default=0, help="Documents submitted at once (default: 2 x batch size)")
+    parser.add_argument("--workers", type=int, default=None, help="Use N worker processes (EDGEWRITER_WORKERS)")
+    parser.add_argument("--max-batch", type=int, default=None, help="Sequences per batch (EDGEWRITER_MAX_BATCH)")
+    parser.add_argument(
+        "--priority",
+        default="background",
+        choices=("interactive", "normal", "background"),
+        help="Scheduler priority class of the documents (default: background, behind the server's own requests)",
+    )
+    parser.add_argument("--model", default=None, help="Registry model name or GGUF path (default: the server's default model)")
+    parser.add_argument("--restart", action="store_true", help="Ignore the existing output file and start over")
+    return parser.parse_args()
+
+
+def iter_documents(paths, defaults):
+    """
+    Yield (id, request fields) for every document in the inputs; for a JSONL
+    line that is not a JSON object the fields are ``{"error": ...}``.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(TEXT_EXTENSIONS):
+                        file_path = os.path.normpath(os.path.join(root, name))
+                        with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+                            yield file_path, dict(defaults, text=f.read())
+        elif path.lower().endswith(".jsonl"):
+            with open(path, "r", encoding="utf-8") as f:
+                for line_no, line in enumerate(f, start=1):
+                    if not line.strip():
+                        continue
+                    line_id = f"{os.path.normpath(path)}:{line_no}"
+                    try:
+                        record = json.loads(line)
+                        if not isinstance(record, dict):
+                            raise ValueError(f"expected an object, got {type(record).__name__}")
+                    except ValueError as e:
+                        yield line_id, {"error": f"Invalid JSONL line: {e}"}
+                        continue
+                    fields = dict(defaults)
+                    fields.update({k: record[k] for k in ("task", "tone", "custom_tone", "text") if k in record})
+                    yield str(record.get("id", line_id)), fields
+        else:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                yield os.path.normpath(path), dict(defaults, text=f.read())
+
+
+def duplicate_ids(documents):
+    """Ids that more than one document in the inputs has."""
+    seen = set()
+    duplicates = []
+    for doc_id, _ in documents:
+        if doc_id in seen and doc_id not in duplicates:
+            duplicates.append(doc_id)
+        seen.add(doc_id)
+    return duplicates
+
+
+def load_checkpoint(output_path):
+    """Ids already written successfully to the output file."""
+    done = set()
+    if not os.path.isfile(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by an interrupted run
+            if "error" not in record:
+                done.add(record["id"])
+    return done
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def main():
+    args = parse_args()
+    # server.py reads its configuration from the environment at import time
+    if args.workers is not None:
+        os.environ["EDGEWRITER_WORKERS"] = str(args.workers)
+    if args.max_batch is not None:
+        os.environ["EDGEWRITER_MAX_BATCH"] = str(args.max_batch)
+
+    import server
+    from edgewriter.longdoc import clean_output
+    from edgewriter.model_registry import ModelSpec
+    from edgewriter.scheduler import QueueFullError
+
+    # --model pins every document to one model; otherwise each is routed by task/tone
+    pinned = args.model
+    if args.model and args.model not in server._models.specs:
+        server._models.add(ModelSpec("batch", args.model, server.BACKEND), default=True)
+        pinned = "batch"
+
+    defaults = {"task": args.task, "tone": args.tone, "custom_tone": args.custom_tone}
+    done_ids = set() if args.restart else load_checkpoint(args.output)
+    documents = list(iter_documents(args.inputs, defaults))
+    duplicates = duplicate_ids(documents)
+    if duplicates:
+        # Results and the checkpoint are keyed by id, so they would overwrite each other
+        shown = ", ".join(duplicates[:5]) + (f" and {len(duplicates) - 5} more" if len(duplicates) > 5 else "")
+        sys.exit(f"Duplicate document ids in the inputs: {shown}")
+    documents = [(doc_id, fields) for doc_id, fields in documents if doc_id not in done_ids]
+    total = len(documents)
+    print(f"{total} documents to process ({len(done_ids)} already in {args.output})")
+    if not total:
+        return
+
+    engine = server.get_scheduler(model=pinned)
+    window = args.in_flight or engine.max_batch * 2
+    mode = "w" if args.restart else "a"
+
+    start = time.time()
+    completed = failed = completion_tokens = 0
+    last_report = 0.0
+    pending = deque(documents)
+    inflight = deque()
+
+    with open(args.output, mode, encoding="utf-8") as out:
+
+        def write(record):
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+
+        try:
+            while pending or inflight:
+                # Keep the engine fed: at most `window` documents submitted at once
+                while pending and len(inflight) < window:
+                    doc_id, fields = pending[0]
+                    if "error" in fields:
+                        pending.popleft()
+                        failed += 1
+                        write({"id": doc_id, "error": fields["error"]})
+                        continue
+                    try:
+                        req = server.Request(**fields)
+                        with server.lease_scheduler(req.task.strip(), req.tone.strip(), pinned) as engine:
+                            job = engine.submit(
+                                server.generate_prompt_tokens(req, engine),
+                                **dict(server.generate_params(req.task.strip()), priority=args.priority),
+                            )
+                    except QueueFullError:
+                        if inflight:
+                            break
+                        time.sleep(1)
+                        continue
+                    except ValueError as e:
+                        pending.popleft()
+                        failed += 1
+                        write({"id": doc_id, "task": fields.get("task"), "error": str(e)})
+                        continue
+                    pending.popleft()
+                    inflight.append((doc_id, req, job, time.time()))
+
+                if not inflight:
+                    continue
+                doc_id, req, job, submitted = inflight.popleft()
+                try:
+                    output = job.result()
+                except Exception as e:
+                    failed += 1
+                    write({"id": doc_id, "task": req.task, "error": str(e)})
+                    continue
+
+                usage = output.get("usage", {})
+                completed += 1
+                completion_tokens += usage.get("completion_tokens", 0)
+                write({
+                    "id": doc_id,
+                    "task": req.task,
+                    "tone": req.tone,
+                    "text": clean_output(output, server.GENERATE_TRIM),
+                    "finish_reason": output["choices"][0].get("finish_reason"),
+                    "latency": round(time.time() - submitted, 2),
+                    "tokens": {
+                        "prompt": usage.get("prompt_tokens", 0),
+                        "completion": usage.get("completion_tokens", 0),
+                        "total": usage.get("total_tokens", 0),
+                    },
+                })
+
+                now = time.time()
+                if now - last_report >= 2 or not (pending or inflight):
+                    last_report = now
+                    elapsed = now - start
+                    finished = completed + failed
+                    eta = elapsed / finished * (total - finished) if finished else None
+                    print(
+                        f"[batch] {finished}/{total} done ({failed} failed) | "
+                        f"{completion_tokens / elapsed:.1f} tokens/s | ETA {format_eta(eta)}",
+                        flush=True,
+                    )
+        except KeyboardInterrupt:
+            for _, _, job, _ in inflight:
+                job.cancel()
+            print(f"\nInterrupted - {completed} results saved; run the same command again to resume.")
+            sys.exit(130)
+
+    elapsed = time.time() - start
+    print(f"✓ {completed} documents in {elapsed:.1f}s ({failed} failed), {completion_tokens / elapsed:.1f} tokens/s -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -54,6 +54,10 @@ const chatMessages = document.getElementById('chat-messages');
 
 // === Config ===
 const MEDIAPIPE_MODEL = '/nano_model_UI/weights.bin';
+const MEDIAPIPE_MANIFEST = '/nano_model_UI/manifest.json';
+const WEIGHTS_CACHE = 'edgewriter-weights'; // verified chunks, kept so a reload or interrupted download resumes
+const DOWNLOAD_PARALLEL = 4;
+const CHUNK_RETRIES = 3;
 const PHI3_SERVER_URL = ''; // Same origin - server.py serves both UI and API
 
 // === State ===
@@ -66,6 +70,7 @@ let baseInitPromise = null;
 
 let currentMode = 'writing';
 let chatHistory = [];
+let phiSessionId = null; // server-side Phi-3 chat session (keeps history + KV cache)
 let isChatProcessing = false;
 let stopRequested = false;
 
@@ -644,23 +649,48 @@ async function sendChatMessage() {
       return;
     }
 
-    // Phi-3 chat (requires /chat endpoint; handled gracefully if missing)
-    const payload = { messages: chatHistory.slice(-12) };
-    const res = await fetch(`${PHI3_SERVER_URL}/chat`, {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify(payload),
-      signal: AbortSignal.timeout(30000)
-    });
+    // Phi-3 chat: the server keeps the session history, so only the new
+    // message is sent; tokens arrive as Server-Sent Events
+    let assistantText = '';
+    let responseDiv = null;
 
-    if (!res.ok) {
-      throw new Error(`Chat failed with status ${res.status}`);
+    const onEvent = (event, data) => {
+      if (event === 'token') {
+        if (!responseDiv) {
+          removeTypingIndicator();
+          responseDiv = addChatMessage('assistant', '', true, true);
+        }
+        assistantText += data.text;
+        responseDiv.innerHTML += escapeHtml(data.text);
+        chatMessages.scrollTop = chatMessages.scrollHeight;
+      } else if (event === 'done') {
+        assistantText = data.text || assistantText;
+      } else if (event === 'error') {
+        throw new Error(data.detail || 'Streaming failed');
+      }
+    };
+
+    const sendToSession = async () => {
+      if (!phiSessionId) phiSessionId = await createPhiSession(chatHistory.slice(0, -1));
+      await streamPhi3(`${PHI3_SERVER_URL}/chat/sessions/${phiSessionId}/messages/stream`, { content: message }, onEvent);
+    };
+    try {
+      await sendToSession();
+    } catch (err) {
+      // Session expired or the server restarted: recreate it from local history once
+      if (responseDiv || !String(err?.message || '').includes('status 404')) throw err;
+      phiSessionId = null;
+      await sendToSession();
     }
 
-    const data = await res.json();
     removeTypingIndicator();
-    const assistantText = data.text || 'No response';
-    addChatMessage('assistant', assistantText, false, true);
+    assistantText = assistantText || 'No response';
+    if (responseDiv) {
+      responseDiv.classList.remove('generating');
+      responseDiv.innerHTML = renderMarkdownBasic(assistantText);
+    } else {
+      addChatMessage('assistant', assistantText, false, true);
+    }
     chatHistory.push({ role: 'assistant', content: assistantText });
   } catch (err) {
     console.error('Chat error:', err);
@@ -687,6 +717,179 @@ async function sendChatMessage() {
   }
 }
 
+// === Phi-3 chat sessions ===
+async function createPhiSession(messages) {
+  const res = await fetch(`${PHI3_SERVER_URL}/chat/sessions`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ messages: messages.slice(-12) })
+  });
+  if (!res.ok) throw new Error(`Chat failed with status ${res.status}`);
+  return (await res.json()).session_id;
+}
+
+function dropPhiSession() {
+  if (!phiSessionId) return;
+  fetch(`${PHI3_SERVER_URL}/chat/sessions/${phiSessionId}`, { method: 'DELETE' }).catch(() => {});
+  phiSessionId = null;
+}
+
+// === Phi-3 SSE streaming ===
+// POSTs `payload` and calls onEvent(event, data) for every SSE frame.
+// The timeout is per-event (idle), so long replies are not cut off.
+async function streamPhi3(url, payload, onEvent, idleTimeoutMs = 30000) {
+  const controller = new AbortController();
+  let idleTimer = setTimeout(() => controller.abort(), idleTimeoutMs);
+  const resetIdle = () => {
+    clearTimeout(idleTimer);
+    idleTimer = setTimeout(() => controller.abort(), idleTimeoutMs);
+  };
+
+  try {
+    const res = await fetch(url, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(payload),
+      signal: controller.signal
+    });
+    if (!res.ok || !res.body) {
+      throw new Error(`Chat failed with status ${res.status}`);
+    }
+
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      resetIdle();
+      buffer += decoder.decode(value, { stream: true });
+
+      let sep;
+      while ((sep = buffer.indexOf('\n\n')) !== -1) {
+        const frame = buffer.slice(0, sep);
+        buffer = buffer.slice(sep + 2);
+        let event = 'message';
+        let data = '';
+        for (const line of frame.split('\n')) {
+          if (line.startsWith('event:')) event = line.slice(6).trim();
+          else if (line.startsWith('data:')) data += line.slice(5).trim();
+        }
+        if (data) onEvent(event, JSON.parse(data));
+      }
+    }
+  } finally {
+    clearTimeout(idleTimer);
+  }
+}
+
+// === Model download ===
+// The server publishes size, ETag and per-chunk SHA-256 for weights.bin in
+// manifest.json. Chunks are fetched in parallel with Range requests, checked
+// against their hash and kept in Cache Storage, so only the missing ones are
+// downloaded again after a reload or a dropped connection.
+async function sha256Hex(buffer) {
+  const digest = await crypto.subtle.digest('SHA-256', buffer);
+  return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+}
+
+async function fetchChunk(file, chunk) {
+  const end = chunk.offset + chunk.length - 1;
+  let lastError = null;
+  for (let attempt = 0; attempt < CHUNK_RETRIES; attempt++) {
+    try {
+      // If-Range: a changed file comes back as a 200 instead of mixing versions
+      const resp = await fetch(file.url, {
+        headers: { 'Range': `bytes=${chunk.offset}-${end}`, 'If-Range': file.etag },
+        cache: 'no-store'
+      });
+      if (resp.status !== 206) {
+        const error = new Error(`weights.bin changed during the download (HTTP ${resp.status}), please retry`);
+        error.fatal = true;
+        throw error;
+      }
+      const buffer = await resp.arrayBuffer();
+      if (buffer.byteLength === chunk.length && await sha256Hex(buffer) === chunk.sha256) return buffer;
+      lastError = new Error(`Chunk at ${chunk.offset} failed verification`);
+    } catch (e) {
+      if (e.fatal) throw e;
+      lastError = e;
+    }
+  }
+  throw lastError;
+}
+
+async function downloadWeights(onProgress) {
+  let manifest = null;
+  try {
+    const resp = await fetch(MEDIAPIPE_MANIFEST);
+    if (resp.ok) manifest = (await resp.json()).files.find(f => f.url === MEDIAPIPE_MODEL);
+  } catch (e) {
+    console.warn('Model manifest unavailable:', e);
+  }
+  if (!manifest || !window.crypto?.subtle || !window.caches) {
+    // Older servers / insecure origins: one plain download
+    const resp = await fetch(MEDIAPIPE_MODEL);
+    if (!resp.ok) throw new Error(`Failed to fetch weights.bin (HTTP ${resp.status})`);
+    return resp.blob();
+  }
+
+  const cache = await caches.open(WEIGHTS_CACHE);
+  const keyFor = (i) => `${MEDIAPIPE_MODEL}?etag=${encodeURIComponent(manifest.etag)}&chunk=${i}`;
+  // Chunks of older versions of the file are no longer useful
+  for (const req of await cache.keys()) {
+    if (!req.url.includes(`etag=${encodeURIComponent(manifest.etag)}&`)) await cache.delete(req);
+  }
+
+  const parts = new Array(manifest.chunks.length);
+  let received = 0;
+  const report = () => onProgress(received / manifest.size);
+  let next = 0;
+  const worker = async () => {
+    while (next < manifest.chunks.length) {
+      const i = next++;
+      const chunk = manifest.chunks[i];
+      const cached = await cache.match(keyFor(i));
+      let buffer = cached ? await cached.arrayBuffer() : null;
+      if (buffer && buffer.byteLength !== chunk.length) buffer = null;
+      if (!buffer) {
+        buffer = await fetchChunk(manifest, chunk);
+        await cache.put(keyFor(i), new Response(buffer)).catch(e => console.warn('Could not keep chunk:', e));
+      }
+      parts[i] = buffer;
+      received += chunk.length;
+      report();
+    }
+  };
+  await Promise.all(Array.from({ length: Math.min(DOWNLOAD_PARALLEL, manifest.chunks.length) }, worker));
+  return new Blob(parts, { type: 'application/octet-stream' });
+}
+
+// === Live telemetry ===
+// One SSE stream from the server's background sampler: no polling and no
+// subprocess per update
+function startTelemetryStream() {
+  const live = document.getElementById('hw-live');
+  if (!live || !window.EventSource) return;
+  const source = new EventSource('/api/telemetry/stream');
+  source.addEventListener('sample', (event) => {
+    const s = JSON.parse(event.data);
+    const parts = [
+      `CPU ${Math.round(s.cpuPercent)}%`,
+      `RAM ${s.ramUsedGB.toFixed(1)}/${s.ramGB} GB`,
+      `Server ${Math.round(s.processRssMB)} MB`
+    ];
+    const gpu = (s.gpus || []).find(g => g.utilization != null);
+    if (gpu) {
+      parts.push(`GPU ${gpu.utilization}% (${(gpu.memoryUsedMB / 1024).toFixed(1)}/${(gpu.memoryTotalMB / 1024).toFixed(1)} GB)`);
+    }
+    live.textContent = `Live: ${parts.join(' • ')}`;
+  });
+  // EventSource reconnects by itself
+  source.onerror = () => { live.textContent = 'Live: --'; };
+}
+
 // === Initialize Base Model ===
 async function initBaseModel() {
   if (isBaseModelReady) return true;
@@ -709,9 +912,9 @@ async function initBaseModel() {
     updateProgress(30, "Downloading model...");
 
     // Fetch weights into a Blob URL to avoid range/stream issues on some setups
-    const resp = await fetch(MEDIAPIPE_MODEL);
-    if (!resp.ok) throw new Error(`Failed to fetch weights.bin (HTTP ${resp.status})`);
-    const blob = await resp.blob();
+    const blob = await downloadWeights(
+      (done) => updateProgress(30 + Math.round(done * 25), `Downloading model... ${Math.round(done * 100)}%`)
+    );
     modelBlobUrl = URL.createObjectURL(blob);
     
     const genaiFileset = await GenAiFilesetResolver.forGenAiTasks(
@@ -808,8 +1011,10 @@ async function generateWithBaseModel(task, tone, userText) {
 // === Generate with Phi-3 ===
 async function generateWithPhi3(task, tone, userText) {
   const start = performance.now();
+  // Multi-paragraph edits go paragraph by paragraph so unchanged ones come from the server cache
+  const incremental = task !== 'Summarize' && /\n\s*\n/.test(userText);
   
-  const res = await fetch(`${PHI3_SERVER_URL}/generate`, {
+  const res = await fetch(`${PHI3_SERVER_URL}/generate${incremental ? '/incremental' : ''}`, {
     method: "POST",
     headers: { "Content-Type": "application/json" },
     body: JSON.stringify({ 
@@ -1018,6 +1223,7 @@ switchMode('writing');
 detectHardware().then(() => {
   console.log("🖥️ Hardware detection complete");
 });
+startTelemetryStream();
 
 // Check Phi-3 server in background
 checkPhi3Server().then(ready => {
@@ -1042,6 +1248,7 @@ if (chatClear) {
   chatClear.addEventListener('click', () => {
     if (confirm('Clear all chat history?')) {
       chatHistory = [];
+      dropPhiSession();
       if (chatMessages) {
         chatMessages.innerHTML = '<div class="text-center text-slate-500 text-sm py-8">Start a conversation...</div>';
       }
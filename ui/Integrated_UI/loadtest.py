@@ -0,0 +1,361 @@
+"""
+EdgeWriter - HTTP load generator
+Replays a mix of /generate, /chat and weights.bin range requests against
+server.py and reports latency percentiles, time to first token and throughput.
+
+Examples:
+  python loadtest.py --fake --concurrency 8 --requests 200
+  python loadtest.py --url http://127.0.0.1:8000 --rate 2 --duration 120
+  python loadtest.py --fake --fake-delay 0.05 --mix Proofread=2,chat=1,weights=1
+
+--concurrency keeps N requests in flight (closed loop). --rate sends
+requests at a fixed average rate with Poisson arrivals whether or not earlier
+ones finished (open loop); latency is then measured from the scheduled
+arrival, so queueing inside the server shows up in the numbers.
+
+--fake starts server.py in-process on a free port with a deterministic fake
+model (edgewriter/fake_engine.py) that sleeps --fake-delay per decode step,
+so the server's own queueing and I/O overhead can be measured without the
+GGUF. A sparse weights.bin of --fake-weights-mb is created for range traffic.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+TASKS = ("Summarize", "Proofread", "Paraphrase", "Rewrite")
+TONES = ("Formal", "Casual", "Professional", "Friendly", "Concise", "Academic")
+WORDS = (
+    "the quick brown fox jumps over lazy dog while our team reviews quarterly report and drafts "
+    "a short summary for customers who asked about delivery times pricing updates and new features "
+    "we plan to ship next month after testing on older laptops phones and edge devices"
+).split()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load-test the EdgeWriter server")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Server to test (ignored with --fake)")
+    parser.add_argument("--mix", default="Proofread=2,Rewrite=1,Summarize=1,Paraphrase=1,chat=1",
+                        help="Weighted request kinds: task names, chat and weights (default: %(default)s)")
+    parser.add_argument("--lengths", default="50,200,600", help="Input lengths in words, picked at random (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests kept in flight (closed loop)")
+    parser.add_argument("--rate", type=float, default=0, help="Average requests per second (open loop); overrides --concurrency")
+    parser.add_argument("--requests", type=int, default=100, help="Requests to send (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=0, help="Stop sending after this many seconds instead")
+    parser.add_argument("--no-stream", action="store_true", help="Use the non-streaming routes (no TTFT)")
+    parser.add_argument("--cache", action="store_true", help="Allow response-cache hits (off by default)")
+    parser.add_argument("--range-kb", type=int, default=1024, help="Size of each weights.bin range request")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the request mix and inputs")
+    parser.add_argument("--json", default=None, help="Also write the report to this file")
+    parser.add_argument("--fake", action="store_true", help="Start server.py in-process with a fake model")
+    parser.add_argument("--fake-delay", type=float, default=0.02, help="Fake decode step in seconds (default: %(default)s)")
+    parser.add_argument("--fake-prefill", type=float, default=0.0002, help="Fake prefill seconds per prompt token")
+    parser.add_argument("--fake-tokens", type=int, default=128, help="Fake reply length in tokens")
+    parser.add_argument("--fake-weights-mb", type=int, default=64, help="Size of the fake weights.bin")
+    parser.add_argument("--max-batch", type=int, default=None, help="EDGEWRITER_MAX_BATCH for the fake server")
+    parser.add_argument("--max-queue", type=int, default=None, help="EDGEWRITER_MAX_QUEUE for the fake server")
+    return parser.parse_args()
+
+
+def parse_mix(spec: str) -> List[tuple]:
+    mix = []
+    for part in spec.split(","):
+        name, _, weight = part.strip().partition("=")
+        if name not in TASKS and name not in ("chat", "weights"):
+            raise SystemExit(f"Unknown request kind in --mix: {name}")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return round(values[lo] + (values[hi] - values[lo]) * (k - lo), 4)
+
+
+def start_fake_server(args) -> str:
+    """Import server.py with a FakeScheduler plugged in and serve it on a free port."""
+    if args.max_batch is not None:
+        os.environ["EDGEWRITER_MAX_BATCH"] = str(args.max_batch)
+    if args.max_queue is not None:
+        os.environ["EDGEWRITER_MAX_QUEUE"] = str(args.max_queue)
+    os.environ.setdefault("EDGEWRITER_CHAT_COMPACTION", "0")
+
+    import socket
+
+    import uvicorn
+
+    import server
+    from edgewriter.fake_engine import FakeScheduler
+
+    fake = FakeScheduler(
+        max_batch=server.MAX_BATCH,
+        max_queue=server.MAX_QUEUE,
+        n_ctx=server.KV_CTX,
+        token_delay=args.fake_delay,
+        prefill_delay=args.fake_prefill,
+        output_tokens=args.fake_tokens,
+        pause_slots=int(server.PAUSE_SLOTS) if server.PAUSE_SLOTS else None,
+    )
+    # Every task goes to the fake engine, whatever EDGEWRITER_MODELS says
+    server._models.install("fake", fake)
+    server._models.specs["fake"].hash = "fake"
+    server._models.routes = []
+    weights_dir = tempfile.mkdtemp(prefix="edgewriter_loadtest_")
+    with open(os.path.join(weights_dir, "weights.bin"), "wb") as f:
+        f.truncate(args.fake_weights_mb * 1024 * 1024)
+    server.NANO_UI_DIR = weights_dir
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    uv = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=uv.run, daemon=True).start()
+    while not uv.started:
+        time.sleep(0.05)
+    print(f"Fake server on port {port}: {server.MAX_BATCH} sequences/batch, {args.fake_delay}s per step, {args.fake_tokens} tokens per reply")
+    return f"http://127.0.0.1:{port}"
+
+
+class Client:
+    """One keep-alive connection per thread."""
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self._local = threading.local()
+
+    def _conn(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=600)
+        return conn
+
+    def request(self, method: str, path: str, body: Optional[Dict] = None, headers: Optional[Dict] = None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        headers = dict(headers or {})
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+        for attempt in range(2):
+            reused = getattr(self._local, "conn", None) is not None
+            conn = self._conn()
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                return conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                self._local.conn = None
+                # The server may have closed an idle keep-alive connection
+                if not reused or attempt:
+                    raise
+
+
+class LoadTest:
+    def __init__(self, args, url: str):
+        self.args = args
+        self.client = Client(url)
+        self.rng = random.Random(args.seed)
+        self.mix = parse_mix(args.mix)
+        self.lengths = [int(n) for n in args.lengths.split(",")]
+        self.results: List[Dict] = []
+        self._lock = threading.Lock()
+        self._weights_size: Optional[int] = None
+
+    def make_request(self) -> Dict:
+        """Pick the next request from the mix (under the lock, so runs are reproducible)."""
+        with self._lock:
+            kind = self.rng.choices([k for k, _ in self.mix], weights=[w for _, w in self.mix])[0]
+            words = self.rng.choice(self.lengths)
+            text = " ".join(self.rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+            tone = self.rng.choice(TONES)
+            offset = self.rng.random()
+        return {"kind": kind, "words": words, "text": text, "tone": tone, "offset": offset}
+
+    def run_one(self, req: Dict, scheduled: float) -> Dict:
+        result = {"kind": req["kind"], "words": req["words"], "status": None, "ttft": None, "tokens": 0, "bytes": 0}
+        try:
+            if req["kind"] == "weights":
+                self._weights(req, result)
+            else:
+                self._generate(req, result)
+        except Exception as e:
+            result["error"] = str(e) or type(e).__name__
+        result["latency"] = time.time() - scheduled
+        with self._lock:
+            self.results.append(result)
+        return result
+
+    def _generate(self, req: Dict, result: Dict):
+        stream = not self.args.no_stream
+        if req["kind"] == "chat":
+            path = "/chat/stream" if stream else "/chat"
+            body = {"messages": [{"role": "user", "content": req["text"]}]}
+        else:
+            path = "/generate/stream" if stream else "/generate"
+            body = {"task": req["kind"], "tone": req["tone"], "text": req["text"], "cache": self.args.cache}
+        start = time.time()
+        resp = self.client.request("POST", path, body)
+        result["status"] = resp.status
+        if resp.status != 200 or not stream:
+            data = resp.read()
+            if resp.status == 200:
+                result["tokens"] = json.loads(data).get("tokens", {}).get("completion", 0)
+            return
+        event = None
+        while True:
+            line = resp.readline()
+            if not line:
+                break
+            line = line.decode("utf-8").rstrip("\n")
+            if line.startswith("event: "):
+                event = line[7:]
+                if event == "token" and result["ttft"] is None:
+                    result["ttft"] = time.time() - start
+            elif line.startswith("data: ") and event in ("done", "error"):
+                data = json.loads(line[6:])
+                if event == "error":
+                    result["error"] = data.get("detail", "stream error")
+                else:
+                    result["tokens"] = data.get("tokens", {}).get("completion", 0)
+
+    def _weights(self, req: Dict, result: Dict):
+        size = self.args.range_kb * 1024
+        if self._weights_size is None:
+            resp = self.client.request("GET", "/nano_model_UI/weights.bin", headers={"Range": "bytes=0-0"})
+            resp.read()
+            if resp.status != 206:
+                result["status"] = resp.status
+                return
+            self._weights_size = int(resp.getheader("Content-Range").rsplit("/", 1)[1])
+        start = int(req["offset"] * max(1, self._weights_size - size))
+        resp = self.client.request("GET", "/nano_model_UI/weights.bin", headers={"Range": f"bytes={start}-{start + size - 1}"})
+        result["status"] = resp.status
+        result["bytes"] = len(resp.read())
+
+    def run(self):
+        args = self.args
+        deadline = time.time() + args.duration if args.duration else None
+        total = None if deadline else args.requests
+        self.started = time.time()
+
+        def more(sent):
+            return (deadline is None or time.time() < deadline) and (total is None or sent < total)
+
+        if args.rate > 0:
+            # Open loop: arrivals do not wait for earlier requests
+            with ThreadPoolExecutor(max_workers=256) as pool:
+                sent = 0
+                next_at = time.time()
+                while more(sent):
+                    delay = next_at - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    pool.submit(self.run_one, self.make_request(), next_at)
+                    sent += 1
+                    next_at += self.rng.expovariate(args.rate)
+        else:
+            counter = {"sent": 0}
+
+            def worker():
+                while True:
+                    with self._lock:
+                        if not more(counter["sent"]):
+                            return
+                        counter["sent"] += 1
+                    self.run_one(self.make_request(), time.time())
+
+            threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, args.concurrency))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.elapsed = time.time() - self.started
+
+    def report(self) -> Dict:
+        by_kind: Dict[str, List[Dict]] = {}
+        for r in self.results:
+            by_kind.setdefault(r["kind"], []).append(r)
+        kinds = {}
+        for kind, results in sorted(by_kind.items()):
+            ok = [r for r in results if r["status"] in (200, 206) and "error" not in r]
+            latencies = [r["latency"] for r in ok]
+            ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+            statuses: Dict[str, int] = {}
+            for r in results:
+                if r not in ok:
+                    key = str(r["status"]) if r["status"] else "error"
+                    statuses[key] = statuses.get(key, 0) + 1
+            kinds[kind] = {
+                "requests": len(results),
+                "ok": len(ok),
+                "failed": statuses,
+                "latency": {f"p{q}": percentile(latencies, q) for q in (50, 95, 99)},
+                "ttft": {f"p{q}": percentile(ttfts, q) for q in (50, 95, 99)} if ttfts else None,
+                "completionTokens": sum(r["tokens"] for r in ok),
+                "bytes": sum(r["bytes"] for r in ok),
+            }
+        ok_all = [r for r in self.results if r["status"] in (200, 206) and "error" not in r]
+        return {
+            "mode": f"open loop, {self.args.rate} req/s" if self.args.rate > 0 else f"closed loop, {self.args.concurrency} in flight",
+            "elapsed": round(self.elapsed, 2),
+            "requests": len(self.results),
+            "ok": len(ok_all),
+            "requestsPerSecond": round(len(ok_all) / self.elapsed, 3),
+            "tokensPerSecond": round(sum(r["tokens"] for r in ok_all) / self.elapsed, 2),
+            "megabytesPerSecond": round(sum(r["bytes"] for r in ok_all) / self.elapsed / 1e6, 2),
+            "latency": {f"p{q}": percentile([r["latency"] for r in ok_all], q) for q in (50, 95, 99)},
+            "kinds": kinds,
+        }
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return "--" if value is None else f"{value:.3f}s"
+
+
+def print_report(report: Dict):
+    print(f"\n{report['requests']} requests ({report['ok']} ok) in {report['elapsed']}s, {report['mode']}")
+    print(f"Throughput: {report['requestsPerSecond']} req/s | {report['tokensPerSecond']} tokens/s | {report['megabytesPerSecond']} MB/s")
+    print(f"\n{'kind':<12}{'ok/total':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'ttft p50':>10}{'ttft p95':>10}  failed")
+    for kind, k in report["kinds"].items():
+        ttft = k["ttft"] or {}
+        print(
+            f"{kind:<12}{k['ok']:>5}/{k['requests']:<4}"
+            f"{format_seconds(k['latency']['p50']):>10}{format_seconds(k['latency']['p95']):>10}{format_seconds(k['latency']['p99']):>10}"
+            f"{format_seconds(ttft.get('p50')):>10}{format_seconds(ttft.get('p95')):>10}  {k['failed'] or ''}"
+        )
+
+
+def main():
+    args = parse_args()
+    url = start_fake_server(args) if args.fake else args.url
+    test = LoadTest(args, url)
+    limit = f"{args.duration}s" if args.duration else f"{args.requests} requests"
+    print(f"Sending {limit} to {url} ({args.mix})")
+    try:
+        test.run()
+    except KeyboardInterrupt:
+        test.elapsed = time.time() - test.started
+        print("\nInterrupted - reporting what finished so far")
+    report = test.report()
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.json}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
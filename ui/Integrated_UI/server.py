@@ -4,12 +4,12 @@ Serves both the UI and the Phi-3 model inference
 """
 from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from llama_cpp import Llama
-from typing import List, Optional
+from typing import Dict, List, Literal, Optional, Tuple, Union
 import uvicorn
+import hashlib
 import time
 import os
 import webbrowser
@@ -17,11 +17,33 @@ import threading
 import subprocess
 import sys
 import psutil
-import re
 import tempfile
 import shutil
 import atexit
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from edgewriter.backend_engine import BackendEngine
+from edgewriter.backends import LLAMA_CPP, Completion, load_backend
+from edgewriter.cancellation import CancelOnDisconnect
+from edgewriter.chat_context import Compactor, ContextBudget
+from edgewriter.daemon import DaemonEngine
+from edgewriter.file_response import FileRangeResponse
+from edgewriter.incremental import process_incremental
+from edgewriter.longdoc import clean_output, summarize_long
+from edgewriter.manifest import ManifestCache
+from edgewriter.metrics import MetricsMiddleware, ServerMetrics
+from edgewriter.model_registry import Lease, ModelBudgetError, ModelRegistry, ModelSpec, UnknownModelError, load_registry_config
+from edgewriter.preload import Preloader
+from edgewriter.prefix_cache import model_file_hash
+from edgewriter.response_cache import ResponseCache, response_key
+from edgewriter.scheduler import QueueFullError, Scheduler
+from edgewriter.sessions import SessionBusyError, SessionStore
+from edgewriter.speculative import speculative_stats
+from edgewriter.streaming import sse_event, stream_completion
+from edgewriter.telemetry import TelemetrySampler
+from edgewriter.templates import load_templates
+from edgewriter.worker_pool import WorkerPool
+
 app = FastAPI(title="EdgeWriter – Dual Engine")
 
 app.add_middleware(
@@ -31,12 +53,83 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Stop generating for clients that disconnect mid-request
+app.add_middleware(CancelOnDisconnect)
 
 # === CONFIG ===
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PHI_MODEL_DIR = os.path.join(SCRIPT_DIR, "..", "phi_model_UI")
-MODEL_PATH = os.path.join(PHI_MODEL_DIR, "phi3-writing-Q8.gguf")
 NANO_UI_DIR = os.path.join(SCRIPT_DIR, "..", "nano_model_UI")
+# Inference runtime (see edgewriter/backends.py) and the model it loads: a
+# GGUF for llama.cpp, the exported model folder for onnxruntime-genai
+BACKEND = os.environ.get("EDGEWRITER_BACKEND", "llama.cpp")
+MODEL_PATH = os.environ.get("EDGEWRITER_MODEL_PATH") or os.path.join(PHI_MODEL_DIR, "phi3-writing-Q8.gguf")
+# Several models with per-task/tone routes: a JSON file or inline JSON (see
+# edgewriter/model_registry.py; without it only MODEL_PATH is served). Idle
+# models are unloaded, least recently used first, to keep the loaded ones
+# within this share of total RAM (0 = only what the OS reports as available)
+MODELS_CONFIG = os.environ.get("EDGEWRITER_MODELS", "")
+MODEL_MEMORY_FRACTION = float(os.environ.get("EDGEWRITER_MODEL_MEMORY", "0.8"))
+# Shared inference daemon (python -m edgewriter.daemon): socket path or
+# host:port. When set, generation goes to the daemon and this process loads
+# no model; the daemon's own settings decide batching, queue and KV size
+DAEMON = os.environ.get("EDGEWRITER_DAEMON", "")
+
+# Scheduler: sequences decoded together per llama.cpp batch, max queued
+# requests before answering 429, and KV cells shared by running sequences
+MAX_BATCH = int(os.environ.get("EDGEWRITER_MAX_BATCH", "4"))
+MAX_QUEUE = int(os.environ.get("EDGEWRITER_MAX_QUEUE", "16"))
+KV_CTX = int(os.environ.get("EDGEWRITER_KV_CTX", "4096"))
+# Keep the task templates' fixed instructions prefilled (extra KV on top of
+# KV_CTX); set a directory to also persist the snapshots across restarts
+PREFIX_CACHE = os.environ.get("EDGEWRITER_PREFIX_CACHE", "1") != "0"
+PREFIX_CACHE_DIR = os.environ.get("EDGEWRITER_PREFIX_CACHE_DIR", "")
+# Task template set from edgewriter/prompts: a name (its highest version), a
+# pinned <name>-v<N>, or a directory of templates
+TEMPLATE_SET = os.environ.get("EDGEWRITER_TEMPLATES", "fewshot")
+# Chat sessions: how many keep their KV between turns (idle ones are evicted
+# first when KV_CTX runs short), how many are remembered, and their idle TTL
+SESSION_KV_SLOTS = int(os.environ.get("EDGEWRITER_SESSION_KV_SLOTS", "4"))
+# Lower-priority generations that may be paused (keeping their KV) so
+# interactive requests start at once; default MAX_BATCH, 0 disables preemption
+PAUSE_SLOTS = os.environ.get("EDGEWRITER_PAUSE_SLOTS", "")
+MAX_SESSIONS = int(os.environ.get("EDGEWRITER_MAX_SESSIONS", "64"))
+SESSION_TTL = float(os.environ.get("EDGEWRITER_SESSION_TTL", "3600"))
+# /generate response cache: in-memory entries (0 disables) and an optional
+# SQLite file that keeps them across restarts
+RESPONSE_CACHE_SIZE = int(os.environ.get("EDGEWRITER_RESPONSE_CACHE", "256"))
+RESPONSE_CACHE_DB = os.environ.get("EDGEWRITER_RESPONSE_CACHE_DB", "")
+# Chat: tokens reserved for each reply (the rest of the context holds
+# history), and whether idle time is used to fold old session turns into a
+# running summary
+CHAT_REPLY_TOKENS = int(os.environ.get("EDGEWRITER_CHAT_REPLY_TOKENS", "2048"))
+CHAT_COMPACTION = os.environ.get("EDGEWRITER_CHAT_COMPACTION", "1") != "0"
+# Worker pool (CPU servers): run N model processes instead of the in-process
+# scheduler; threads per worker default to cores / N
+WORKERS = int(os.environ.get("EDGEWRITER_WORKERS", "0"))
+WORKER_THREADS = int(os.environ.get("EDGEWRITER_WORKER_THREADS", "0"))
+# Prompt-lookup speculative decoding: max draft tokens per step for the
+# copy-heavy tasks (0 disables)
+SPECULATIVE_DRAFT = int(os.environ.get("EDGEWRITER_SPECULATIVE_DRAFT", "8"))
+SPECULATIVE_TASKS = {"Proofread", "Paraphrase"}
+# Long-document summarization: tokens per chunk (0 = sized so MAX_BATCH
+# chunks fit in KV_CTX together)
+LONGDOC_CHUNK_TOKENS = int(os.environ.get("EDGEWRITER_LONGDOC_CHUNK_TOKENS", "0"))
+# Startup: read ahead, load and warm up Phi-3 in the background as soon as the
+# server starts instead of on the first request (progress on /ready), and
+# mlock the weights so they are not paged out under memory pressure
+PRELOAD = os.environ.get("EDGEWRITER_PRELOAD", "0") != "0"
+MLOCK = os.environ.get("EDGEWRITER_MLOCK", "0") != "0"
+# Browser model downloads: chunk size (MB) of the hashed ranges listed in
+# /nano_model_UI/manifest.json
+MANIFEST_CHUNK_MB = int(os.environ.get("EDGEWRITER_MANIFEST_CHUNK_MB", "8"))
+# Hardware telemetry (/api/telemetry): seconds between samples and how many
+# samples are kept
+TELEMETRY_INTERVAL = float(os.environ.get("EDGEWRITER_TELEMETRY_INTERVAL", "2"))
+TELEMETRY_HISTORY = int(os.environ.get("EDGEWRITER_TELEMETRY_HISTORY", "300"))
+# Seconds a generation may run before it stops with its partial output
+# (finish_reason "deadline"); requests can set their own. 0 = no limit
+REQUEST_DEADLINE = float(os.environ.get("EDGEWRITER_DEADLINE", "0"))
 
 # === Browser launch===
 URL = "http://127.0.0.1:8000"
@@ -161,33 +254,166 @@ def monitor_browser_and_stop(server: "uvicorn.Server"):
 
 
 # === Phi-3 lazy-load state ===
-_llm: Optional[Llama] = None
-_llm_lock = threading.Lock()
-
-
-def get_llm() -> Llama:
-    """Load and return the Phi-3 Llama instance on first use."""
-    global _llm
-    if _llm is not None:
-        return _llm
-
-    with _llm_lock:
-        if _llm is not None:
-            return _llm
-
-        if not os.path.isfile(MODEL_PATH):
-            raise RuntimeError(f"Phi-3 model file not found: {MODEL_PATH}")
-
-        print(f"Loading Phi-3 Mini on-demand from: {MODEL_PATH}")
-        _llm = Llama(
-            model_path=MODEL_PATH,
-            n_ctx=4096,
-            n_batch=512,
-            n_gpu_layers=-1,
-            verbose=False,
+# Models (and their engines) are loaded on first use by the registry below
+_preloader: Optional[Preloader] = None
+_response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_DB or None) if RESPONSE_CACHE_SIZE > 0 else None
+
+
+def engine_totals() -> Optional[Dict]:
+    """Queue and completion counters summed over the loaded models (None while none is loaded)."""
+    stats = [engine.stats() for engine in _models.engines().values()]
+    if not stats:
+        return None
+    return {key: sum(s.get(key) or 0 for s in stats) for key in ("queueDepth", "running", "completed", "rejected")}
+
+
+_metrics = ServerMetrics(
+    model=os.path.basename(MODEL_PATH),
+    model_loaded=lambda: bool(_models.engines()),
+    engine_stats=engine_totals,
+)
+app.add_middleware(MetricsMiddleware, metrics=_metrics)
+
+
+def cache_index_dir() -> Optional[str]:
+    """Where file hashes are remembered across restarts: next to the prefix/response caches when they are on disk."""
+    return PREFIX_CACHE_DIR or (os.path.dirname(os.path.abspath(RESPONSE_CACHE_DB)) if RESPONSE_CACHE_DB else None)
+
+
+def model_hash(spec: ModelSpec) -> str:
+    """SHA-256 of the model file(s)."""
+    if spec.hash is None and spec.backend == "daemon":
+        spec.hash = _models.get(spec.name).model_hash()
+    elif spec.hash is None:
+        spec.hash = model_file_hash(spec.path, cache_index_dir())
+    return spec.hash
+
+
+def load_engine(spec: ModelSpec) -> Union[Scheduler, WorkerPool, BackendEngine, DaemonEngine]:
+    """Start the engine that owns all generation for one registry model."""
+    if spec.backend == "daemon":
+        engine = DaemonEngine(spec.path)
+        print(f"✓ {spec.name}: using the inference daemon at {spec.path} ({engine.info['model']})\n")
+        return engine
+    if not os.path.exists(spec.path):
+        raise RuntimeError(f"Phi-3 model file not found: {spec.path}")
+    workers = int(spec.options.get("workers", WORKERS))
+    max_batch = int(spec.options.get("max_batch", MAX_BATCH))
+    kv_ctx = int(spec.options.get("kv_ctx", KV_CTX))
+
+    if workers > 0:
+        print(f"Starting {workers} {spec.name} worker processes from: {spec.path}")
+        pool = WorkerPool(
+            spec.path,
+            workers=workers,
+            n_ctx=kv_ctx,
+            n_threads=WORKER_THREADS or None,
+            max_queue=MAX_QUEUE,
+            llama_kwargs={"n_gpu_layers": 0, "use_mlock": MLOCK},
+            backend=spec.backend,
         )
-        print("✓ Phi-3 Model loaded successfully!\n")
-        return _llm
+        atexit.register(pool.close)
+        return pool
+
+    print(f"Loading {spec.name} ({spec.backend}) on-demand from: {spec.path}")
+    # With llama.cpp, generation runs in the scheduler's own
+    # multi-sequence context, so this one only needs to be big enough for
+    # a single batch. Other backends generate in their own context.
+    llm = load_backend(
+        spec.backend,
+        spec.path,
+        n_ctx=512 if spec.backend == "llama.cpp" else kv_ctx,
+        n_batch=512,
+        n_gpu_layers=-1,
+        use_mlock=MLOCK,
+        verbose=False,
+    )
+    print(f"✓ {spec.name} loaded successfully!\n")
+
+    if not llm.supports(LLAMA_CPP):
+        # No multi-sequence batching outside llama.cpp: one generation at a time
+        engine = BackendEngine(llm, max_queue=MAX_QUEUE)
+        print(f"✓ {llm.name} engine ready: queue bound {MAX_QUEUE}, {llm.n_ctx} token context\n")
+        return engine
+    prefixes = template_prefixes() if PREFIX_CACHE else None
+    scheduler = Scheduler(
+        llm.llama,
+        max_batch=max_batch,
+        max_queue=MAX_QUEUE,
+        n_ctx=kv_ctx,
+        prefixes=prefixes,
+        prefix_cache_dir=PREFIX_CACHE_DIR or None,
+        model_hash=model_hash(spec) if prefixes and PREFIX_CACHE_DIR else None,
+        session_slots=SESSION_KV_SLOTS,
+        pause_slots=int(PAUSE_SLOTS) if PAUSE_SLOTS else None,
+    )
+    print(f"✓ Scheduler ready: {max_batch} sequences/batch, queue bound {MAX_QUEUE}, {kv_ctx} KV cells\n")
+    return scheduler
+
+
+def load_model(spec: ModelSpec) -> Union[Scheduler, WorkerPool, BackendEngine, DaemonEngine]:
+    """Registry loader: start the engine, then tokenize the templates' static text with its vocabulary."""
+    engine = load_engine(spec)
+    TEMPLATES.tokenized(engine)
+    return engine
+
+
+def build_model_registry() -> ModelRegistry:
+    """EDGEWRITER_MODELS when set, otherwise the daemon or just MODEL_PATH; budget is a share of total RAM."""
+    budget = int(psutil.virtual_memory().total * MODEL_MEMORY_FRACTION) if MODEL_MEMORY_FRACTION > 0 else None
+    if MODELS_CONFIG:
+        config = load_registry_config(MODELS_CONFIG)
+        return ModelRegistry(config["specs"], load_model, config["routes"], config["default"], memory_budget=budget)
+    if DAEMON:
+        return ModelRegistry({"daemon": ModelSpec("daemon", DAEMON, "daemon")}, load_model, memory_budget=budget)
+    name = os.path.splitext(os.path.basename(os.path.normpath(MODEL_PATH)))[0]
+    return ModelRegistry({name: ModelSpec(name, MODEL_PATH, BACKEND)}, load_model, memory_budget=budget)
+
+
+_models = build_model_registry()
+
+
+def get_scheduler(
+    task: Optional[str] = None, tone: Optional[str] = None, model: Optional[str] = None
+) -> Union[Scheduler, WorkerPool, BackendEngine, DaemonEngine]:
+    """Return the engine for the model that serves ``task``/``tone`` (or ``model``), loading it on first use."""
+    return _models.get(_await_preload(task, tone, model))
+
+
+def lease_scheduler(task: Optional[str] = None, tone: Optional[str] = None, model: Optional[str] = None) -> Lease:
+    """
+    Same as get_scheduler, but the model is not unloaded until the lease is
+    released: hold it (``with lease as engine:``) until the job is submitted.
+    """
+    return _models.lease(_await_preload(task, tone, model))
+
+
+def _await_preload(task: Optional[str], tone: Optional[str], model: Optional[str]) -> str:
+    name = _models.resolve(task, tone, model)
+    if _models.loaded(name) is None and _preloader is not None and _preloader.active:
+        # Wait for the background load instead of queueing on the registry's
+        # lock; if it failed, the load below retries and raises to this request
+        _preloader.wait()
+    return name
+
+
+def warm_up():
+    """One-token generation in every sequence/worker so the first request skips the cold first decode."""
+    with lease_scheduler() as engine:
+        prompt = generate_prompt_tokens(Request(task="Proofread", text="Warm up."), engine)
+        jobs = [engine.submit(prompt, **dict(GENERATE_PARAMS, max_tokens=1)) for _ in range(engine.max_batch)]
+    for job in jobs:
+        job.result()
+
+
+def start_preload() -> Preloader:
+    """Start the background read-ahead → load → warm-up (EDGEWRITER_PRELOAD=1)."""
+    global _preloader
+    spec = _models.specs[_models.default]
+    steps = [("load", get_scheduler), ("warmup", warm_up)]
+    # A daemon's weights are already resident in the daemon process
+    _preloader = Preloader(spec.path, steps, readahead=spec.backend != "daemon").start()
+    return _preloader
 
 
 def get_gpu_info():
@@ -272,14 +498,40 @@ def get_system_info():
     return {"ramGB": ram_gb}
 
 
+# nvidia-smi/wmic run once in the sampler thread, not per request
+_telemetry = TelemetrySampler(get_gpu_info, TELEMETRY_INTERVAL, TELEMETRY_HISTORY)
+
+
+# Keep proxies/browsers from buffering token streams
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
 def _weights_file_path() -> str:
     return os.path.join(NANO_UI_DIR, "weights.bin")
 
+
+# Model files the browser downloads from /nano_model_UI, listed in its manifest
+NANO_MODEL_ARTIFACTS = ("weights.bin",)
+_manifests = ManifestCache(chunk_size=MANIFEST_CHUNK_MB * 1024 * 1024, cache_dir=cache_index_dir())
+
+# Scheduling class (see edgewriter/scheduler.py); each route has a default
+Priority = Literal["interactive", "normal", "background"]
+
+
 class Request(BaseModel):
     task: str
     tone: str = "Neutral"
     custom_tone: str = ""
     text: str
+    # Set to false to always sample a fresh output instead of reusing a cached one
+    cache: bool = True
+    # Registry model to use instead of the one routed for the task/tone
+    model: Optional[str] = None
+    # Token budget (at most the task's default) and time limit in seconds;
+    # output cut short by either reports it in finish_reason
+    max_tokens: Optional[int] = None
+    deadline: Optional[float] = None
+    priority: Optional[Priority] = None
 
 
 class ChatMessage(BaseModel):
@@ -289,135 +541,64 @@ class ChatMessage(BaseModel):
 
 class ChatRequest(BaseModel):
     messages: List[ChatMessage]
+    model: Optional[str] = None
+    max_tokens: Optional[int] = None
+    deadline: Optional[float] = None
+    priority: Optional[Priority] = None
 
-# TASK TEMPLATES
 
-SUMMARIZE_TEMPLATE = """<|user|>
-TASK: Summarize the text in 2-4 sentences, capturing the main progression of ideas.
-RULES:
-- Cover the beginning, middle, and end of the argument
-- Combine related points for conciseness
-- Do NOT add information not in the original
-- Maintain factual accuracy
-
-EXAMPLE INPUT: Advances in battery chemistry over the past decade have shifted from incremental improvements to structural innovations. Researchers now prioritize energy-dense solid-state architectures, aiming to reduce flammability while extending cycle life far beyond current lithium-ion norms. Supply-chain constraints still impede large-scale deployment, particularly in the sourcing of high-purity lithium and rare-earth stabilizers.
-EXAMPLE OUTPUT: Battery development has moved from small refinements to structural innovations, with solid-state architectures prioritized for higher energy density, lower flammability, and longer life. Deployment remains limited by supply-chain constraints.
+class LongSummaryRequest(BaseModel):
+    text: str
+    model: Optional[str] = None
+    # Applies to the whole map-reduce; chunks still running then stop early
+    deadline: Optional[float] = None
+    priority: Optional[Priority] = None
 
-Now summarize:
-{text}<|end|>
-<|assistant|>"""
 
-PROOFREAD_TEMPLATE = """<|user|>
-TASK: Fix grammar, spelling, and punctuation errors.
-RULES:
-- Only fix errors, do NOT rewrite or paraphrase
-- Keep the original wording and style
-- Do NOT change facts or meaning
-- Preserve the sentence structure
+class SessionCreate(BaseModel):
+    messages: List[ChatMessage] = []
+    # Pins the session to this registry model (default: the "Chat" route)
+    model: Optional[str] = None
 
-EXAMPLE INPUT: The system faild to start becuase of a memmory allocation error.
-EXAMPLE OUTPUT: The system failed to start because of a memory allocation error.
 
-EXAMPLE INPUT: Calibration complted; sensors returnd stable readings
-EXAMPLE OUTPUT: Calibration completed; sensors returned stable readings.
+class SessionMessage(BaseModel):
+    content: str
+    max_tokens: Optional[int] = None
+    deadline: Optional[float] = None
+    priority: Optional[Priority] = None
 
-Now proofread (fix only errors, keep original wording):
-{text}<|end|>
-<|assistant|>"""
 
-PARAPHRASE_TEMPLATE = """<|user|>
-TASK: Paraphrase while keeping similar length and one-to-one orderly meaning.
-RULES:
-- Use different words but keep ALL facts
-- Do NOT add or remove information
-- Maintain the same level of detail and structure of sentence
-- Keep the same approximate length
+class SessionRegenerate(BaseModel):
+    max_tokens: Optional[int] = None
+    deadline: Optional[float] = None
+    priority: Optional[Priority] = None
 
-EXAMPLE INPUT: The system failed to start due to a memory allocation error.
-EXAMPLE OUTPUT: A memory allocation issue prevented the system from starting.
+# TASK TEMPLATES (edgewriter/prompts/, see edgewriter/templates.py)
 
-EXAMPLE INPUT: Calibration completed; sensors returned stable readings.
-EXAMPLE OUTPUT: The calibration process finished, and the sensors showed consistent results.
+TEMPLATES = load_templates(TEMPLATE_SET)
+print(f"Task templates: {TEMPLATES.label} ({len(TEMPLATES.templates)} templates)")
 
-Now paraphrase (use different words, keep same meaning and length):
-{text}<|end|>
-<|assistant|>"""
+# === ROUTES ===
 
-REWRITE_TEMPLATES = {
-    "Neutral": """<|user|>
-TASK: Rewrite the text for better clarity and readability.
-TONE: Maintain neutral, clear language without strong stylistic choices.
-RULES:
-- Keep EVERY piece of information from the original
-- Do NOT add interpretations, explanations, or new facts
-- Do NOT remove ANY details
-- Do NOT change the meaning
-
-EXAMPLE INPUT: The system failed to start due to a memory allocation error.
-EXAMPLE OUTPUT: The system failed to start because of a memory allocation error.
-
-Now rewrite:
-{text}<|end|>
-<|assistant|>""",
-    "Professional": """<|user|>
-TASK: Rewrite the text in a professional tone.
-TONE: Use formal, business-appropriate vocabulary. Use complete sentences and precise terminology.
-RULES:
-- Keep EVERY piece of information from the original
-- Do NOT add or remove details
-- Do NOT change the meaning
-
-EXAMPLE INPUT: The system failed to start due to a memory allocation error.
-EXAMPLE OUTPUT: The system encountered a startup failure attributable to a memory allocation error.
-
-Now rewrite professionally:
-{text}<|end|>
-<|assistant|>""",
-    "Friendly": """<|user|>
-TASK: Rewrite the text in a friendly tone.
-TONE: Use conversational, warm language. Use contractions and relatable phrasing.
-RULES:
-- Keep EVERY piece of information from the original
-- Do NOT add or remove details
-- Do NOT change the meaning
-
-EXAMPLE INPUT: The system failed to start due to a memory allocation error.
-EXAMPLE OUTPUT: The system couldn't start up because of a memory allocation error.
-
-Now rewrite in a friendly way:
-{text}<|end|>
-<|assistant|>""",
-    "Concise": """<|user|>
-TASK: Rewrite the text to be extremely concise.
-TONE: Be extremely brief. Remove unnecessary words while keeping all facts.
-RULES:
-- Keep ALL information from the original
-- Remove filler words and redundancy
-- Do NOT change the meaning
-
-EXAMPLE INPUT: The system failed to start due to a memory allocation error.
-EXAMPLE OUTPUT: System failed: memory allocation error.
-
-Now rewrite concisely:
-{text}<|end|>
-<|assistant|>""",
-    "Academic": """<|user|>
-TASK: Rewrite the text in an academic tone.
-TONE: Use scholarly vocabulary. Use formal academic sentence structures and precise terminology.
-RULES:
-- Keep EVERY piece of information from the original
-- Do NOT add or remove details
-- Do NOT change the meaning
+@app.exception_handler(QueueFullError)
+def queue_full(request, exc: QueueFullError):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc), "queueDepth": exc.depth},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
 
-EXAMPLE INPUT: The system failed to start due to a memory allocation error.
-EXAMPLE OUTPUT: The system initialization was unsuccessful due to a memory allocation error.
+@app.exception_handler(UnknownModelError)
+def unknown_model(request, exc: UnknownModelError):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
 
-Now rewrite academically:
-{text}<|end|>
-<|assistant|>"""
-}
+@app.exception_handler(ModelBudgetError)
+def model_budget(request, exc: ModelBudgetError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "5"})
 
-# === ROUTES ===
+@app.exception_handler(SessionBusyError)
+def session_busy(request, exc: SessionBusyError):
+    return JSONResponse(status_code=409, content={"detail": str(exc)})
 
 @app.get("/")
 def index():
@@ -429,169 +610,231 @@ def js():
 
 @app.get("/health")
 def health():
+    default_engine = _models.loaded(_models.default)
     return {
         "status": "ok",
         "model": "Phi-3 Mini (fine-tuned)",
         "engine": "dual",
-        "phiLoaded": _llm is not None,
+        "phiLoaded": bool(_models.engines()),
+        "preload": _preloader.status() if _preloader is not None else None,
+        "scheduler": default_engine.stats() if default_engine is not None else None,
+        "models": _models.stats(),
+        "templates": TEMPLATES.info(),
+        "chatSessions": len(_sessions),
+        "chatCompaction": _compactor.stats() if _compactor is not None else None,
+        "responseCache": _response_cache.stats() if _response_cache is not None else None,
     }
 
 
-@app.get("/api/gpu-info")
-def gpu_info():
-    gpus = get_gpu_info()
-    system = get_system_info()
-    return {"gpus": gpus, **system}
+@app.get("/ready")
+def ready():
+    """Readiness probe: 200 once Phi-3 is loaded and warmed up, 503 with load progress before that."""
+    if _preloader is None:
+        # Lazy mode: requests are accepted and load the model themselves
+        return {"ready": True, "state": "ready" if _models.engines() else "lazy"}
+    status = _preloader.status()
+    if _preloader.ready:
+        return {"ready": True, **status}
+    return JSONResponse(status_code=503, content={"ready": False, **status}, headers={"Retry-After": "1"})
+
 
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition of the inference and HTTP metrics."""
+    return PlainTextResponse(_metrics.render(), media_type=ServerMetrics.CONTENT_TYPE)
 
-@app.get("/nano_model_UI/weights.bin")
-def nano_weights(range_header: Optional[str] = Header(None, alias="Range")):
-    """Serve weights.bin with proper HTTP Range support (MediaPipe requires this)."""
+
+@app.get("/api/gpu-info")
+def gpu_info():
+    """GPUs and RAM from the latest telemetry sample."""
+    sample = _telemetry.latest()
+    if sample is None:
+        return {"gpus": [], **get_system_info()}
+    return sample
+
+
+@app.get("/api/telemetry")
+def telemetry(limit: int = 0):
+    """Recent telemetry samples, oldest first (``limit`` keeps the newest N)."""
+    _telemetry.start()
+    return {"interval": _telemetry.interval, "samples": _telemetry.history(limit or None)}
+
+
+@app.get("/api/telemetry/stream")
+def telemetry_stream():
+    """Server-Sent Events: the latest sample, then a ``sample`` event as each new one is taken."""
+
+    async def frames():
+        # Async so an open stream holds no threadpool thread while it waits
+        sample = _telemetry.latest(timeout=0)
+        seq = sample["seq"] if sample else 0
+        if sample:
+            yield sse_event("sample", sample)
+        while True:
+            sample = await _telemetry.next_sample(seq, timeout=15)
+            if sample is None:
+                yield ": keep-alive\n\n"
+                continue
+            seq = sample["seq"]
+            yield sse_event("sample", sample)
+
+    return StreamingResponse(frames(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@app.api_route("/nano_model_UI/weights.bin", methods=["GET", "HEAD"])
+def nano_weights():
+    """
+    Serve weights.bin with Range support (MediaPipe requires it), including
+    multi-range requests, ETag/Last-Modified revalidation (304) and a
+    zero-copy body where the ASGI server supports it.
+    """
     weights_path = _weights_file_path()
     if not os.path.isfile(weights_path):
         raise HTTPException(status_code=404, detail="weights.bin not found")
+    return FileRangeResponse(weights_path, headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+
+@app.get("/nano_model_UI/manifest.json")
+def nano_manifest(if_none_match: Optional[str] = Header(None)):
+    """
+    Size, ETag, SHA-256 and fixed-size hashed chunks of each model file, so
+    the browser can fetch the chunks in parallel with Range requests, verify
+    them and resume an interrupted download.
+    """
+    files = [
+        _manifests.get(os.path.join(NANO_UI_DIR, name), f"/nano_model_UI/{name}")
+        for name in NANO_MODEL_ARTIFACTS
+        if os.path.isfile(os.path.join(NANO_UI_DIR, name))
+    ]
+    if not files:
+        raise HTTPException(status_code=404, detail="No model files to describe")
+    validators = f"{_manifests.chunk_size}:" + ",".join(f["etag"] for f in files)
+    etag = '"' + hashlib.sha256(validators.encode("utf-8")).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse({"files": files}, headers=headers)
+
+STOP_SEQUENCES = ["<|end|>", "<|user|>", "<|assistant|>"]
+GENERATE_TRIM = STOP_SEQUENCES + ["\n\n\n", "Summary:\n\n"]
+GENERATE_PARAMS = {
+    "max_tokens": 512,
+    "temperature": 0.5,
+    "top_p": 0.90,
+    "repeat_penalty": 1.1,
+    "stop": STOP_SEQUENCES,
+}
 
-    file_size = os.path.getsize(weights_path)
-    common_headers = {
-        "Accept-Ranges": "bytes",
-        "Cache-Control": "public, max-age=31536000, immutable",
-    }
 
-    if not range_header:
-        def iter_full():
-            with open(weights_path, "rb") as f:
-                while True:
-                    chunk = f.read(1024 * 1024)
-                    if not chunk:
-                        break
-                    yield chunk
-
-        headers = {**common_headers, "Content-Length": str(file_size)}
-        return StreamingResponse(iter_full(), media_type="application/octet-stream", headers=headers)
-
-    match = re.match(r"^bytes=(\d*)-(\d*)$", range_header.strip())
-    if not match:
-        raise HTTPException(status_code=416, detail="Invalid Range header")
-
-    start_str = match.group(1)
-    end_str = match.group(2)
-
-    # bytes=START-END
-    # bytes=START-
-    # bytes=-SUFFIX_LEN
-    if start_str == "" and end_str == "":
-        raise HTTPException(status_code=416, detail="Invalid Range header")
-
-    if start_str == "" and end_str != "":
-        # suffix range: last N bytes
-        suffix_len = int(end_str)
-        if suffix_len <= 0:
-            raise HTTPException(status_code=416, detail="Invalid Range header")
-        start = max(file_size - suffix_len, 0)
-        end = file_size - 1
-    else:
-        start = int(start_str)
-        end = int(end_str) if end_str else file_size - 1
-
-    if start >= file_size or end < start:
-        return StreamingResponse(
-            iter(()),
-            status_code=416,
-            media_type="application/octet-stream",
-            headers={**common_headers, "Content-Range": f"bytes */{file_size}"},
-        )
+def generate_params(task: str) -> Dict:
+    """GENERATE_PARAMS plus the speculative draft length for tasks that mostly copy their input."""
+    if SPECULATIVE_DRAFT > 0 and task in SPECULATIVE_TASKS:
+        return dict(GENERATE_PARAMS, speculative=SPECULATIVE_DRAFT)
+    return GENERATE_PARAMS
 
-    end = min(end, file_size - 1)
-    length = end - start + 1
-
-    def iter_range():
-        with open(weights_path, "rb") as f:
-            f.seek(start)
-            remaining = length
-            while remaining > 0:
-                chunk = f.read(min(remaining, 1024 * 1024))
-                if not chunk:
-                    break
-                remaining -= len(chunk)
-                yield chunk
-
-    headers = {
-        **common_headers,
-        "Content-Range": f"bytes {start}-{end}/{file_size}",
-        "Content-Length": str(length),
-    }
-    return StreamingResponse(
-        iter_range(),
-        status_code=206,
-        media_type="application/octet-stream",
-        headers=headers,
-    )
 
-@app.post("/generate")
-def generate(req: Request):
-    start = time.time()
-    
-    task = req.task.strip()
-    tone = req.tone.strip()
-    text = req.text.strip()
-
-    if task == "Summarize":
-        prompt = SUMMARIZE_TEMPLATE.format(text=text)
-    elif task == "Proofread":
-        prompt = PROOFREAD_TEMPLATE.format(text=text)
-    elif task == "Paraphrase":
-        prompt = PARAPHRASE_TEMPLATE.format(text=text)
-    elif task == "Rewrite":
-        if tone == "Custom" and req.custom_tone:
-            custom_tone = req.custom_tone.strip()
-            prompt = f"""<|user|>
-Rewrite the following text in a {custom_tone} style:
-
-{text}<|end|>
-<|assistant|>"""
-        elif tone in REWRITE_TEMPLATES:
-            prompt = REWRITE_TEMPLATES[tone].format(text=text)
-        else:
-            prompt = f"""<|user|>
-Rewrite the following text in a {tone} style:
+# Priority class of each kind of request unless it sets "priority": chat
+# replies are waited on, long documents and history compaction are not
+ROUTE_PRIORITIES = {"chat": "interactive", "generate": "normal", "long": "background", "compaction": "background"}
 
-{text}<|end|>
-<|assistant|>"""
-    else:
-        prompt = f"""<|user|>
-Process the following text:
 
-{text}<|end|>
-<|assistant|>"""
+def request_params(base: Dict, req: BaseModel, route: str) -> Dict:
+    """
+    ``base`` with a request's token budget (capped at the route's own
+    max_tokens), its deadline, in seconds from now, as the absolute time the
+    engines check, and its priority class (the route's by default).
+    """
+    params = dict(base, priority=req.priority or ROUTE_PRIORITIES[route])
+    max_tokens = getattr(req, "max_tokens", None)
+    if max_tokens is not None:
+        params["max_tokens"] = max(1, min(max_tokens, base["max_tokens"]))
+    seconds = req.deadline if req.deadline is not None else REQUEST_DEADLINE
+    if seconds > 0:
+        params["deadline"] = time.time() + seconds
+    return params
 
-    llm = get_llm()
-    output = llm(
-        prompt,
-        max_tokens=512,
-        temperature=0.5,
-        top_p=0.90,
-        repeat_penalty=1.1, 
-        stop=["<|end|>", "<|user|>", "<|assistant|>"],
-        echo=False,
-    )
 
-    raw_result = output["choices"][0]["text"]
-    result = raw_result.strip()
+def sampling_params(params: Dict) -> Dict:
+    """The part of ``params`` that shapes the output, i.e. its response cache key."""
+    return {key: params[key] for key in GENERATE_PARAMS}
+
+
+def generate_template(req: Request) -> Tuple[str, Dict[str, str]]:
+    """Template name and field values for a /generate request."""
+    name, values = TEMPLATES.select(req.task.strip(), req.tone.strip(), (req.custom_tone or "").strip())
+    return name, {**values, "text": req.text.strip()}
+
+
+def build_generate_prompt(req: Request) -> str:
+    """Render the task template for a /generate request (the text its response cache key is built from)."""
+    name, values = generate_template(req)
+    return TEMPLATES.render(name, **values)
+
 
-    for seq in ["<|end|>", "<|user|>", "<|assistant|>", "\n\n\n", "Summary:\n\n"]:
-        if seq in result:
-            result = result.split(seq)[0].strip()
+def generate_prompt_tokens(req: Request, engine) -> List[int]:
+    """The /generate prompt as token ids: the template's pre-tokenized text around the request's own tokens."""
+    name, values = generate_template(req)
+    return TEMPLATES.tokens(engine, name, **values)
 
-    latency = round(time.time() - start, 2)
-    
-    usage = output.get("usage", {})
-    prompt_tokens = usage.get("prompt_tokens", 0)
-    completion_tokens = usage.get("completion_tokens", 0)
-    total_tokens = usage.get("total_tokens", 0)
+
+def metric_labels(req: Request) -> Tuple[str, str]:
+    """/metrics task and tone labels of a /generate request, from its template rather than the raw strings."""
+    return TEMPLATES.labels(generate_template(req)[0])
+
+
+def check_prompt_fits(tokens: List[int], engine):
+    """413 before queueing when the prompt leaves no room for a reply."""
+    if len(tokens) >= engine.n_ctx_seq:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Prompt is {len(tokens)} tokens; the model's context is {engine.n_ctx_seq}",
+        )
+
+
+def lookup_response(req: Request, prompt: str, model: str, params: Dict):
+    """Return (cache key, cached response); the key is None when caching is off for this request."""
+    if _response_cache is None:
+        return None, None
+    if not req.cache:
+        _response_cache.skip()
+        return None, None
+    key = response_key(prompt, sampling_params(params), model_hash(_models.specs[model]))
+    return key, _response_cache.get(key)
+
+
+@app.post("/generate")
+def generate(req: Request):
+    start = time.time()
+    task = req.task.strip()
+    prompt = build_generate_prompt(req)
+    model = _models.resolve(task, req.tone.strip(), req.model)
+    params = request_params(generate_params(task), req, "generate")
+    label, tone_label = metric_labels(req)
+
+    cache_key, hit = lookup_response(req, prompt, model, params)
+    if hit is not None:
+        elapsed = time.time() - start
+        latency = round(elapsed, 2)
+        print(f"[{task}] Cache hit in {latency}s | Output: {hit['text'][:80]}{'...' if len(hit['text'])>80 else ''}")
+        _metrics.observe_request(label, tone_label, elapsed, cached=True)
+        return {"text": hit["text"], "latency": latency, "tokens": hit["tokens"], "raw_output": hit["raw_output"], "finish_reason": hit.get("finish_reason"), "model": model, "cached": True}
+
+    with lease_scheduler(model=model) as engine:
+        tokens = generate_prompt_tokens(req, engine)
+        check_prompt_fits(tokens, engine)
+        completion = Completion.from_output(engine(tokens, **params))
+    result = completion.clean_text(GENERATE_TRIM)
+    elapsed = time.time() - start
+    latency = round(elapsed, 2)
+    prompt_tokens = completion.prompt_tokens
+    completion_tokens = completion.completion_tokens
+    total_tokens = prompt_tokens + completion_tokens
 
     print(f"[{task}] Done in {latency}s | Tokens: {prompt_tokens}+{completion_tokens}={total_tokens} | Output: {result[:80]}{'...' if len(result)>80 else ''}")
+    _metrics.observe_completion(label, prompt_tokens, completion_tokens, completion.timings, finish_reason=completion.finish_reason)
+    _metrics.observe_request(label, tone_label, elapsed)
 
-    return {
+    response = {
         "text": result,
         "latency": latency,
         "tokens": {
@@ -599,8 +842,239 @@ Process the following text:
             "completion": completion_tokens,
             "total": total_tokens
         },
-        "raw_output": raw_result
+        "raw_output": completion.text,
+        "finish_reason": completion.finish_reason,
+        "model": model,
     }
+    speculative = speculative_stats(completion.usage)
+    if speculative:
+        response["speculative"] = speculative
+    if cache_key:
+        _response_cache.put(cache_key, {
+            "text": result,
+            "tokens": response["tokens"],
+            "raw_output": completion.text,
+            "finish_reason": completion.finish_reason,
+        })
+    return response
+
+
+@app.post("/generate/stream")
+def generate_stream(req: Request):
+    """Same as /generate, but tokens are pushed as Server-Sent Events."""
+    start = time.time()
+    task = req.task.strip()
+    prompt = build_generate_prompt(req)
+    model = _models.resolve(task, req.tone.strip(), req.model)
+    params = request_params(generate_params(task), req, "generate")
+    label, tone_label = metric_labels(req)
+
+    cache_key, hit = lookup_response(req, prompt, model, params)
+    if hit is not None:
+        elapsed = time.time() - start
+        latency = round(elapsed, 3)
+        _metrics.observe_request(label, tone_label, elapsed, cached=True)
+        frames = [
+            sse_event("token", {"text": hit["text"]}),
+            sse_event("done", {
+                "text": hit["text"],
+                "latency": latency,
+                "ttft": latency,
+                "finish_reason": hit.get("finish_reason"),
+                "tokens": hit["tokens"],
+                "raw_output": hit["raw_output"],
+                "cached": True,
+            }),
+        ]
+        return StreamingResponse(iter(frames), media_type="text/event-stream", headers=SSE_HEADERS)
+
+    def on_done(data):
+        _metrics.observe_stream(label, tone_label, data, latency=time.time() - start)
+        if cache_key:
+            _response_cache.put(cache_key, {
+                "text": data["text"],
+                "tokens": data["tokens"],
+                "raw_output": data["raw_output"],
+                "finish_reason": data["finish_reason"],
+            })
+
+    with lease_scheduler(model=model) as engine:
+        tokens = generate_prompt_tokens(req, engine)
+        check_prompt_fits(tokens, engine)
+        frames = stream_completion(
+            engine,
+            tokens,
+            params,
+            GENERATE_TRIM,
+            label=task,
+            start=start,
+            on_done=on_done,
+        )
+    return StreamingResponse(frames, media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@app.post("/generate/tokens")
+def generate_tokens(req: Request):
+    """Exact prompt size of a /generate request, without generating."""
+    task = req.task.strip()
+    model = _models.resolve(task, req.tone.strip(), req.model)
+    with lease_scheduler(model=model) as engine:
+        name, values = generate_template(req)
+        compiled = TEMPLATES.tokenized(engine)
+        prompt_tokens = len(compiled.build(name, **values))
+        template_tokens = compiled.static_tokens(name)
+    return {
+        "model": model,
+        "template": name,
+        "templates": TEMPLATES.label,
+        "tokens": {
+            "prompt": prompt_tokens,
+            "template": template_tokens,
+            "text": prompt_tokens - template_tokens,
+        },
+        "context": engine.n_ctx_seq,
+        "fits": prompt_tokens < engine.n_ctx_seq,
+    }
+
+
+def paragraph_prompt(req: Request, paragraph: str, engine) -> List[int]:
+    """Tokens for one paragraph of an incremental request (413 if it alone does not fit)."""
+    tokens = generate_prompt_tokens(Request(task=req.task, tone=req.tone, custom_tone=req.custom_tone, text=paragraph), engine)
+    check_prompt_fits(tokens, engine)
+    return tokens
+
+
+def run_incremental(req: Request):
+    task = req.task.strip()
+    model = _models.resolve(task, req.tone.strip(), req.model)
+    params = request_params(generate_params(task), req, "generate")
+    # Paragraphs are submitted as the events are consumed, so the lease is
+    # held until the generator is done with
+    lease = lease_scheduler(model=model)
+    scheduler = lease.engine
+    try:
+        events = process_incremental(
+            scheduler,
+            req.text,
+            render=lambda paragraph: build_generate_prompt(
+                Request(task=req.task, tone=req.tone, custom_tone=req.custom_tone, text=paragraph)
+            ),
+            build=lambda paragraph: paragraph_prompt(req, paragraph, scheduler),
+            cache_key=lambda prompt: response_key(prompt, sampling_params(params), model_hash(_models.specs[model])),
+            params=params,
+            trim=GENERATE_TRIM,
+            cache=_response_cache if req.cache else None,
+            window=scheduler.max_batch * 2,
+        )
+    except Exception:
+        lease.release()
+        raise
+    return lease.bind(events)
+
+
+@app.post("/generate/incremental")
+def generate_incremental(req: Request):
+    """
+    /generate paragraph by paragraph: unchanged paragraphs come from the
+    response cache and only edited ones are sent to the model.
+    """
+    start = time.time()
+    label, tone_label = metric_labels(req)
+    for event, data in run_incremental(req):
+        if event == "done":
+            print(f"[{req.task.strip()}/incremental] Done in {data['latency']}s | {data['processed']} processed, {data['reused']} reused | Tokens: {data['tokens']['total']}")
+            _metrics.observe_request(f"{label}/incremental", tone_label, time.time() - start)
+            return data
+
+
+@app.post("/generate/incremental/stream")
+def generate_incremental_stream(req: Request):
+    """Same as /generate/incremental with a ``paragraph`` event per processed paragraph."""
+    start = time.time()
+    label, tone_label = metric_labels(req)
+    events = run_incremental(req)
+
+    def frames():
+        try:
+            for event, data in events:
+                if event == "done":
+                    print(f"[{req.task.strip()}/incremental] Streamed in {data['latency']}s | {data['processed']} processed, {data['reused']} reused | Tokens: {data['tokens']['total']}")
+                    _metrics.observe_request(f"{label}/incremental", tone_label, time.time() - start)
+                yield sse_event(event, data)
+        except Exception as e:
+            print(f"[{req.task.strip()}/incremental] Failed: {e}")
+            yield sse_event("error", {"detail": str(e)})
+        finally:
+            events.close()
+
+    return StreamingResponse(frames(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+LONG_SUMMARY_PARAMS = dict(GENERATE_PARAMS, max_tokens=256)
+
+
+def long_chunk_tokens(scheduler: Scheduler) -> int:
+    if LONGDOC_CHUNK_TOKENS > 0:
+        return LONGDOC_CHUNK_TOKENS
+    compiled = TEMPLATES.tokenized(scheduler)
+    overhead = max(compiled.static_tokens("Summarize"), compiled.static_tokens("MergeSummaries")) + LONG_SUMMARY_PARAMS["max_tokens"]
+    # Small enough that a full batch of chunks is admitted at once
+    return max(256, min(scheduler.n_ctx_seq, scheduler.n_ctx // scheduler.max_batch) - overhead)
+
+
+def run_long_summary(req: LongSummaryRequest):
+    lease = lease_scheduler("Summarize", model=req.model)
+    scheduler = lease.engine
+    try:
+        compiled = TEMPLATES.tokenized(scheduler)
+        events = summarize_long(
+            scheduler,
+            req.text.strip(),
+            map_prompt=lambda chunk: compiled.build("Summarize", text=chunk),
+            merge_prompt=lambda notes: compiled.build("MergeSummaries", text=notes),
+            params=request_params(LONG_SUMMARY_PARAMS, req, "long"),
+            trim=GENERATE_TRIM,
+            chunk_tokens=long_chunk_tokens(scheduler),
+            window=scheduler.max_batch * 2,
+            count_tokens=lambda s: len(compiled.text_tokens(s)),
+        )
+    except Exception:
+        lease.release()
+        raise
+    return lease.bind(events)  # held while chunks are still being submitted
+
+
+@app.post("/generate/long")
+def generate_long(req: LongSummaryRequest):
+    """Summarize a document of any length (map-reduce over chunks)."""
+    start = time.time()
+    for event, data in run_long_summary(req):
+        if event == "done":
+            print(f"[Summarize/long] Done in {data['latency']}s | {data['chunks']} chunks, {data['levels']} levels{' (truncated)' if data['truncated'] else ''} | Tokens: {data['tokens']['total']}")
+            _metrics.observe_request("Summarize/long", "", time.time() - start)
+            return data
+
+
+@app.post("/generate/long/stream")
+def generate_long_stream(req: LongSummaryRequest):
+    """Same as /generate/long with ``progress`` events per finished chunk."""
+    start = time.time()
+    events = run_long_summary(req)
+
+    def frames():
+        try:
+            for event, data in events:
+                if event == "done":
+                    print(f"[Summarize/long] Streamed in {data['latency']}s | {data['chunks']} chunks, {data['levels']} levels{' (truncated)' if data['truncated'] else ''} | Tokens: {data['tokens']['total']}")
+                    _metrics.observe_request("Summarize/long", "", time.time() - start)
+                yield sse_event(event, data)
+        except Exception as e:
+            print(f"[Summarize/long] Failed: {e}")
+            yield sse_event("error", {"detail": str(e)})
+        finally:
+            events.close()
+
+    return StreamingResponse(frames(), media_type="text/event-stream", headers=SSE_HEADERS)
 
 
 CHAT_SYSTEM_PROMPT = """<|system|>
@@ -610,54 +1084,345 @@ Treat prior turns as context; do not repeat them.
 <|end|>"""
 
 
-def build_chat_prompt(messages: List[ChatMessage]):
-    trimmed = messages[-12:]
+def template_prefixes() -> Dict[str, str]:
+    """Static text every task template starts with, plus the chat system prompt."""
+    prefixes = {task: TEMPLATES[task].head for task in ("Summarize", "Proofread", "Paraphrase") if task in TEMPLATES}
+    for name, template in TEMPLATES.templates.items():
+        if name.startswith("Rewrite."):
+            prefixes[f"Rewrite/{name[len('Rewrite.'):]}"] = template.head
+    # build_chat_prompt joins parts with newlines
+    prefixes["Chat"] = CHAT_SYSTEM_PROMPT + "\n"
+    return prefixes
+
+
+def render_chat_prompt(messages: List[Dict[str, str]], summary: str = "") -> str:
     parts = [CHAT_SYSTEM_PROMPT]
-    for msg in trimmed:
-        role = "assistant" if (msg.role or "").lower().strip() == "assistant" else "user"
-        content = (msg.content or "").strip()
+    if summary:
+        parts.append(f"<|system|>\nSummary of the earlier conversation:\n{summary}\n<|end|>")
+    for msg in messages:
+        role = "assistant" if (msg["role"] or "").lower().strip() == "assistant" else "user"
+        content = (msg["content"] or "").strip()
         parts.append(f"<|{role}|>\n{content}\n<|end|>")
     parts.append("<|assistant|>")
     return "\n".join(parts)
 
 
+def chat_budget(scheduler) -> ContextBudget:
+    """History budget: the model's context minus the room reserved for the reply."""
+    return ContextBudget(
+        count_tokens=lambda text: len(scheduler.tokenize(text.encode("utf-8"), special=True)),
+        render=render_chat_prompt,
+        budget=scheduler.n_ctx_seq - CHAT_PARAMS["max_tokens"],
+        truncate=lambda text, n: scheduler.detokenize(scheduler.tokenize(text.encode("utf-8"), add_bos=False)[-n:]).decode("utf-8", errors="ignore"),
+    )
+
+
+def build_chat_prompt(messages: List[ChatMessage], scheduler):
+    return chat_budget(scheduler).fit([{"role": m.role, "content": m.content} for m in messages])
+
+
+CHAT_PARAMS = {
+    "max_tokens": CHAT_REPLY_TOKENS,
+    "temperature": 0.5,
+    "top_p": 0.9,
+    "repeat_penalty": 1.05,
+    "stop": STOP_SEQUENCES,
+}
+
+
 @app.post("/chat")
 def chat(req: ChatRequest):
     start = time.time()
-    prompt = build_chat_prompt(req.messages)
-
-    llm = get_llm()
-    output = llm(
-        prompt,
-        max_tokens=2048,
-        temperature=0.5,
-        top_p=0.9,
-        repeat_penalty=1.05,
-        stop=["<|end|>", "<|user|>", "<|assistant|>"],
-        echo=False,
+    model = _models.resolve("Chat", model=req.model)
+    with lease_scheduler(model=model) as scheduler:
+        prompt = build_chat_prompt(req.messages, scheduler)
+        completion = Completion.from_output(scheduler(prompt, **request_params(CHAT_PARAMS, req, "chat")))
+    result = completion.clean_text(STOP_SEQUENCES)
+    elapsed = time.time() - start
+    latency = round(elapsed, 2)
+    _metrics.observe_completion(
+        "chat", completion.prompt_tokens, completion.completion_tokens, completion.timings, finish_reason=completion.finish_reason
     )
+    _metrics.observe_request("chat", "", elapsed)
+
+    return {
+        "text": result,
+        "latency": latency,
+        "tokens": {
+            "prompt": completion.prompt_tokens,
+            "completion": completion.completion_tokens,
+            "total": completion.prompt_tokens + completion.completion_tokens,
+        },
+        "raw_output": completion.text,
+        "finish_reason": completion.finish_reason,
+        "model": model,
+    }
+
+
+@app.post("/chat/stream")
+def chat_stream(req: ChatRequest):
+    """Same as /chat, but tokens are pushed as Server-Sent Events."""
+    start = time.time()
+    with lease_scheduler("Chat", model=req.model) as scheduler:
+        prompt = build_chat_prompt(req.messages, scheduler)
+        frames = stream_completion(
+            scheduler,
+            prompt,
+            request_params(CHAT_PARAMS, req, "chat"),
+            STOP_SEQUENCES,
+            label="chat",
+            start=start,
+            on_done=lambda data: _metrics.observe_stream("chat", "", data, latency=time.time() - start),
+        )
+    return StreamingResponse(frames, media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+# === Chat sessions ===
+# The server keeps the history and the scheduler keeps the session's KV, so a
+# new turn only prefills the tokens after the last reply.
+
+def _drop_session_kv(session_id: str):
+    for engine in _models.engines().values():
+        engine.drop_session(session_id)
+
+
+_sessions = SessionStore(max_sessions=MAX_SESSIONS, ttl=SESSION_TTL, on_evict=_drop_session_kv)
 
-    raw_result = output["choices"][0]["text"]
-    result = raw_result.strip()
-    for seq in ["<|end|>", "<|user|>", "<|assistant|>"]:
-        if seq in result:
-            result = result.split(seq)[0].strip()
 
-    latency = round(time.time() - start, 2)
-    usage = output.get("usage", {})
+def build_session_prompt(session, scheduler) -> str:
+    """
+    Render the running summary plus the history from ``session.window`` on.
+    Normally the compactor keeps this small; if it falls behind, the oldest
+    turns are dropped in one block down to 3/4 of the budget (not one per
+    turn) so the following turns still share their prefix with the cached KV.
+    """
+    budget = chat_budget(scheduler)
+    live = session.messages[session.window:]
+    session.window += budget.drop_count(live, session.summary, target=budget.budget * 3 // 4)
+    return budget.fit(session.messages[session.window:], session.summary)
+
+
+COMPACT_TEMPLATE = """<|user|>
+TASK: Update the summary of a conversation with the new turns below.
+RULES:
+- Keep facts, names, decisions and open questions the user may refer back to
+- At most 150 words
+- Output only the updated summary
+
+Current summary:
+{summary}
+
+New turns:
+{turns}<|end|>
+<|assistant|>"""
+
+COMPACT_PARAMS = {
+    "max_tokens": 256,
+    "temperature": 0.3,
+    "top_p": 0.9,
+    "repeat_penalty": 1.1,
+    "stop": STOP_SEQUENCES,
+    "priority": ROUTE_PRIORITIES["compaction"],
+}
+
+
+def plan_compaction(session) -> int:
+    """
+    Fold the oldest turns once the live history passes half the budget, down
+    to about a quarter (the summary itself is capped by COMPACT_PARAMS).
+    """
+    engine = _models.loaded(_models.resolve("Chat", model=session.model))
+    if engine is None:
+        return 0  # its model was unloaded; compact once it is back
+    budget = chat_budget(engine)
+    live = session.messages[session.window:]
+    if len(live) <= 2 or budget.tokens(live) <= budget.budget // 2:
+        return 0
+    keep = 2
+    while keep < len(live) and budget.tokens(live[-(keep + 1):]) <= budget.budget // 4:
+        keep += 1
+    return len(live) - keep
+
+
+def summarize_turns(session, messages: List[Dict[str, str]]) -> Optional[str]:
+    """Summary from the session's own model, the one plan_compaction budgeted for (None if it was unloaded)."""
+    engine = _models.loaded(_models.resolve("Chat", model=session.model))
+    if engine is None:
+        return None  # never load (and maybe evict) a model just to compact
+    turns = "\n".join(f"{m['role'].capitalize()}: {m['content'].strip()}" for m in messages)
+    output = engine(COMPACT_TEMPLATE.format(summary=session.summary or "(none)", turns=turns), **COMPACT_PARAMS)
+    return clean_output(output, STOP_SEQUENCES)
+
+
+def engine_idle() -> bool:
+    stats = engine_totals()
+    if stats is None:
+        return True  # nothing loaded, nothing running; plan_compaction skips sessions whose model is gone
+    return stats["queueDepth"] == 0 and stats["running"] == 0
+
+
+_compactor = Compactor(_sessions, plan=plan_compaction, summarize=summarize_turns, is_idle=engine_idle) if CHAT_COMPACTION else None
+
+
+def _turn_finished(session):
+    if _compactor is not None:
+        _compactor.request(session.id)
+
+
+def _begin_turn(session_id: str, content: Optional[str]):
+    """Lock the session and add the user message (or drop the last reply to regenerate)."""
+    session = _sessions.acquire(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Unknown chat session: {session_id}")
+    saved = list(session.messages)
+    lease = None
+    try:
+        if content is not None:
+            session.messages.append({"role": "user", "content": content})
+        elif session.messages and session.messages[-1]["role"] == "assistant":
+            session.messages.pop()
+        if not session.messages or session.messages[-1]["role"] != "user":
+            raise HTTPException(status_code=400, detail="Nothing to reply to in this session")
+        # Released by the caller once the reply is submitted
+        lease = lease_scheduler("Chat", model=session.model)
+        return session, saved, build_session_prompt(session, lease.engine), lease
+    except Exception:
+        if lease is not None:
+            lease.release()
+        session.messages = saved
+        _sessions.release(session)
+        raise
+
+
+def _session_reply(session_id: str, content: Optional[str], params: Dict):
+    start = time.time()
+    session, saved, prompt, lease = _begin_turn(session_id, content)
+    try:
+        with lease as scheduler:
+            completion = Completion.from_output(scheduler(prompt, session=session.id, **params))
+        result = completion.clean_text(STOP_SEQUENCES)
+        if completion.finish_reason == "cancelled":
+            session.messages = saved  # the client left; nobody saw this turn
+        else:
+            session.messages.append({"role": "assistant", "content": result})
+    except Exception:
+        session.messages = saved
+        raise
+    finally:
+        _sessions.release(session)
+    _turn_finished(session)
+
+    elapsed = time.time() - start
+    latency = round(elapsed, 2)
+    tokens = completion.tokens()
+    print(f"[chat:{session.id[:8]}] Done in {latency}s | Tokens: {tokens['prompt']} ({tokens.get('cached', 0)} cached)+{tokens['completion']}")
+    _metrics.observe_completion(
+        "chat", completion.prompt_tokens, completion.completion_tokens, completion.timings, finish_reason=completion.finish_reason
+    )
+    _metrics.observe_request("chat", "", elapsed)
 
     return {
+        "session_id": session.id,
         "text": result,
         "latency": latency,
         "tokens": {
-            "prompt": usage.get("prompt_tokens", 0),
-            "completion": usage.get("completion_tokens", 0),
-            "total": usage.get("total_tokens", 0),
+            "prompt": tokens["prompt"],
+            "cached": tokens.get("cached", 0),
+            "completion": tokens["completion"],
+            "total": tokens["total"],
         },
-        "raw_output": raw_result,
+        "raw_output": completion.text,
+        "finish_reason": completion.finish_reason,
     }
 
 
+def _session_stream(session_id: str, content: Optional[str], params: Dict):
+    start = time.time()
+    session, saved, prompt, lease = _begin_turn(session_id, content)
+    replied = []
+
+    def on_done(data):
+        _metrics.observe_stream("chat", "", data, latency=time.time() - start)
+        if data["finish_reason"] != "cancelled":  # else the client left and the turn is rolled back
+            session.messages.append({"role": "assistant", "content": data["text"]})
+            replied.append(True)
+
+    try:
+        with lease as scheduler:
+            frames = stream_completion(
+                scheduler,
+                prompt,
+                dict(params, session=session.id),
+                STOP_SEQUENCES,
+                label=f"chat:{session.id[:8]}",
+                start=start,
+                on_done=on_done,
+            )
+    except Exception:
+        session.messages = saved
+        _sessions.release(session)
+        raise
+
+    def events():
+        try:
+            yield from frames
+        finally:
+            if not replied:
+                session.messages = saved
+            _sessions.release(session)
+            if replied:
+                _turn_finished(session)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@app.post("/chat/sessions")
+def create_session(req: SessionCreate):
+    if req.model:
+        _models.resolve(model=req.model)  # 400 for unknown models
+    session = _sessions.create([{"role": m.role, "content": m.content} for m in req.messages], model=req.model)
+    return session.to_dict()
+
+
+@app.get("/chat/sessions/{session_id}")
+def get_session(session_id: str):
+    session = _sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Unknown chat session: {session_id}")
+    return session.to_dict()
+
+
+@app.delete("/chat/sessions/{session_id}")
+def delete_session(session_id: str):
+    if not _sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail=f"Unknown chat session: {session_id}")
+    return {"deleted": session_id}
+
+
+@app.post("/chat/sessions/{session_id}/messages")
+def session_message(session_id: str, req: SessionMessage):
+    """Append a user turn and return the reply."""
+    return _session_reply(session_id, req.content, request_params(CHAT_PARAMS, req, "chat"))
+
+
+@app.post("/chat/sessions/{session_id}/messages/stream")
+def session_message_stream(session_id: str, req: SessionMessage):
+    return _session_stream(session_id, req.content, request_params(CHAT_PARAMS, req, "chat"))
+
+
+@app.post("/chat/sessions/{session_id}/regenerate")
+def session_regenerate(session_id: str, req: Optional[SessionRegenerate] = None):
+    """Replace the last assistant reply with a new one."""
+    req = req or SessionRegenerate()
+    return _session_reply(session_id, None, request_params(CHAT_PARAMS, req, "chat"))
+
+
+@app.post("/chat/sessions/{session_id}/regenerate/stream")
+def session_regenerate_stream(session_id: str, req: Optional[SessionRegenerate] = None):
+    req = req or SessionRegenerate()
+    return _session_stream(session_id, None, request_params(CHAT_PARAMS, req, "chat"))
+
+
 # NOTE: This mount is intentionally placed AFTER the explicit weights.bin route
 # so MediaPipe range requests use the handler above.
 if os.path.isdir(NANO_UI_DIR):
@@ -673,7 +1438,12 @@ if __name__ == "__main__":
     print("  EdgeWriter - Dual Engine Server")
     print("=" * 50)
     print(f"\nPhi-3 model path: {MODEL_PATH}")
-    print("Phi-3 will load on first /generate or /chat request.\n")
+    if PRELOAD:
+        start_preload()
+        print("Phi-3 is loading in the background (progress on /ready).\n")
+    else:
+        print("Phi-3 will load on first /generate or /chat request.\n")
+    _telemetry.start()
     print("Starting server at http://127.0.0.1:8000")
     print("Press Ctrl+C to stop\n")
     print("=" * 50)
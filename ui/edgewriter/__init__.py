@@ -0,0 +1,4 @@
+"""
+EdgeWriter - shared inference helpers
+Imported by the Integrated and Phi-3 servers (they add ``ui/`` to ``sys.path``).
+"""
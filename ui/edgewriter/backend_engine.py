@@ -0,0 +1,157 @@
+"""
+Request queue in front of a non-llama.cpp backend.
+
+The batching Scheduler drives llama.cpp's multi-sequence context directly, so
+other runtimes (see backends.py) are served by BackendEngine instead: a
+bounded queue, ordered by priority class, and ``concurrency`` worker threads
+that each run one ``backend.stream()`` at a time. A running generation is
+not preempted, since the backend holds one KV state. It has the Scheduler interface (``submit``,
+``__call__``, ``tokenize``, ``stats``, ``drop_session``), so the routes,
+long-document and incremental helpers work unchanged, and completions carry
+the same usage and timings blocks.
+"""
+import math
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from .cancellation import track
+from .scheduler import DEFAULT_PARAMS, Job, QueueFullError, enqueue, priority_rank
+from .templates import Prompt
+
+
+class _EngineJob(Job):
+    """Job whose usage and timings come from the backend's Generation."""
+
+    generation = None
+
+    def usage(self) -> Dict[str, int]:
+        if self.generation is None or not self.generation.usage:
+            return super().usage()
+        return dict(self.generation.usage)
+
+    def timings(self) -> Dict[str, float]:
+        timings = dict(self.generation.timings or {}) if self.generation is not None else {}
+        if not timings:
+            return super().timings()
+        timings["queue"] = round((self.admitted_at or self.submitted_at) - self.submitted_at, 4)
+        return timings
+
+
+class BackendEngine:
+    def __init__(self, backend, max_queue: int = 16, concurrency: int = 1):
+        self.backend = backend
+        self.max_batch = max(1, concurrency)
+        self.max_queue = max(0, max_queue)
+        self.n_ctx = backend.n_ctx
+        self.n_ctx_seq = backend.n_ctx
+        self._waiting: deque = deque()
+        self._running: List[_EngineJob] = []
+        self._lock = threading.Condition()
+        self.completed = 0
+        self.rejected = 0
+        self._avg_job_seconds = 5.0
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._loop, name=f"edgewriter-engine-{i}", daemon=True) for i in range(self.max_batch)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        return self.backend.tokenize(text, add_bos=add_bos, special=special)
+
+    def detokenize(self, tokens: List[int]) -> bytes:
+        return self.backend.detokenize(tokens)
+
+    def submit(
+        self,
+        prompt: Prompt,
+        session: Optional[str] = None,
+        speculative: int = 0,
+        deadline: Optional[float] = None,
+        priority: str = "normal",
+        **params,
+    ) -> Job:
+        """Queue a completion; ``session`` and ``speculative`` are accepted for Scheduler compatibility."""
+        rank = priority_rank(priority)
+        merged = {**DEFAULT_PARAMS, **{k: v for k, v in params.items() if k in DEFAULT_PARAMS}}
+        tokens = self.tokenize(prompt.encode("utf-8"), special=True) if isinstance(prompt, str) else list(prompt)
+        if len(tokens) >= self.n_ctx_seq:
+            raise ValueError(f"Requested tokens ({len(tokens)}) exceed context window of {self.n_ctx_seq}")
+        merged["max_tokens"] = min(merged["max_tokens"] or self.n_ctx_seq, self.n_ctx_seq - len(tokens))
+        job = _EngineJob(prompt, tokens, merged, session=session, deadline=deadline, priority=rank)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Engine is closed (model unloaded)")
+            if len(self._waiting) >= self.max_queue:
+                self.rejected += 1
+                ahead = len(self._waiting) + len(self._running)
+                raise QueueFullError(len(self._waiting), max(1, math.ceil(self._avg_job_seconds * ahead / self.max_batch)))
+            enqueue(self._waiting, job)
+            self._lock.notify()
+        return track(job)
+
+    def drop_session(self, session: str):
+        pass
+
+    def __call__(self, prompt: Prompt, stream: bool = False, echo: bool = False, **params):
+        job = self.submit(prompt, **params)
+        return job.stream() if stream else job.result()
+
+    def close(self):
+        """Stop accepting jobs, let queued ones finish, then release the backend."""
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self.backend.close()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            waiting = len(self._waiting)
+            running = len(self._running)
+        return {
+            "mode": "backend",
+            "backend": self.backend.name,
+            "queueDepth": waiting,
+            "running": running,
+            "maxBatch": self.max_batch,
+            "maxQueue": self.max_queue,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                while not self._waiting:
+                    if self._closed:
+                        return
+                    self._lock.wait()
+                job = self._waiting.popleft()
+                reason = job.stop_reason(time.time())
+                if reason:
+                    job._close(reason)
+                    continue
+                self._running.append(job)
+            job.admitted_at = time.time()
+            try:
+                job.generation = self.backend.stream(job.prompt, **job.params)
+                # The Generation checks both before decoding each next piece
+                job.generation.stop_reason = job.stop_reason
+                for piece in job.generation:
+                    if job.first_token_at is None:
+                        job.first_token_at = time.time()
+                    job._push(piece)
+                job._close(job.generation.finish_reason)
+            except Exception as e:
+                print(f"[engine] {self.backend.name} generation failed: {e}")
+                job._close(None, e)
+            with self._lock:
+                self._running.remove(job)
+            if job.error is None and not job.cancelled:
+                self.completed += 1
+                self._avg_job_seconds = 0.8 * self._avg_job_seconds + 0.2 * (job.finished_at - job.admitted_at)
@@ -0,0 +1,499 @@
+"""
+Inference backends shared by the front ends.
+
+A Backend wraps one loaded model behind a runtime-neutral interface:
+``stream()`` returns a Generation (an iterator of text pieces that knows its
+finish reason, token usage and prefill/decode timings once exhausted),
+``complete()`` collects it into a Completion, ``tokenize``/``detokenize``
+expose the vocabulary, and ``save_state``/``load_state`` snapshot the KV
+cache where the runtime supports it. ``capabilities`` says which optional
+features a backend has, so callers can check instead of guessing from the
+class.
+
+Backends are also call-compatible with ``Llama.__call__`` (llama-cpp style
+completion dicts, or chunks with ``stream=True``), which keeps
+``stream_completion``, the scheduler and the worker pool runtime-agnostic.
+Completion.from_output parses those dicts, so routes do not repeat
+``output["choices"][0]["text"]`` and the usage lookups.
+
+``load_backend`` picks an implementation by name (``EDGEWRITER_BACKEND`` in
+the servers): ``llama.cpp`` for the GGUF, or ``onnxruntime-genai`` for the
+int4 ONNX export on CPU. Runtime packages are imported only when their
+backend is loaded.
+"""
+import json
+import os
+import re
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+
+from .cancellation import track
+from .streaming import StopTrimmer
+from .templates import Prompt
+
+# Capability flags
+STREAMING = "streaming"  # stream() yields pieces as they are decoded
+KV_STATE = "kv_state"  # save_state()/load_state() work
+PREFIX_REUSE = "prefix_reuse"  # a prompt sharing a prefix with the last one skips that part of the prefill
+LLAMA_CPP = "llama_cpp"  # exposes the llama.cpp model (``.llama``) the batching Scheduler runs on
+GPU_OFFLOAD = "gpu_offload"  # n_gpu_layers is honoured
+
+
+class Completion:
+    """A finished completion, from a backend or parsed from a llama-cpp style dict."""
+
+    def __init__(
+        self,
+        text: str,
+        finish_reason: Optional[str] = None,
+        usage: Optional[Dict] = None,
+        timings: Optional[Dict] = None,
+    ):
+        self.text = text
+        self.finish_reason = finish_reason
+        self.usage = usage or {}
+        self.timings = timings
+
+    @classmethod
+    def from_output(cls, output: Dict) -> "Completion":
+        choice = output["choices"][0]
+        return cls(choice["text"], choice.get("finish_reason"), output.get("usage"), output.get("timings"))
+
+    @property
+    def prompt_tokens(self) -> int:
+        return self.usage.get("prompt_tokens", 0)
+
+    @property
+    def completion_tokens(self) -> int:
+        return self.usage.get("completion_tokens", 0)
+
+    def tokens(self) -> Dict[str, int]:
+        """The ``tokens`` block of the HTTP responses."""
+        tokens = {
+            "prompt": self.prompt_tokens,
+            "completion": self.completion_tokens,
+            "total": self.usage.get("total_tokens", self.prompt_tokens + self.completion_tokens),
+        }
+        if "cached_tokens" in self.usage:
+            tokens["cached"] = self.usage["cached_tokens"]
+        return tokens
+
+    def clean_text(self, trim: List[str]) -> str:
+        """Stripped text cut at the first trim sequence, as the routes return it."""
+        result = self.text.strip()
+        for seq in trim:
+            if seq in result:
+                result = result.split(seq)[0].strip()
+        return result
+
+    def to_output(self, created: Optional[int] = None) -> Dict:
+        output = {
+            "object": "text_completion",
+            "created": created or int(time.time()),
+            "choices": [{"text": self.text, "index": 0, "logprobs": None, "finish_reason": self.finish_reason}],
+            "usage": self.usage,
+        }
+        if self.timings is not None:
+            output["timings"] = self.timings
+        return output
+
+
+class Generation:
+    """
+    Iterator of decoded text pieces. ``finish_reason``, ``usage`` and
+    ``timings`` are filled in once it is exhausted; ``close()`` stops decoding.
+    Before each next piece it stops by itself once ``cancel()`` was called
+    ("cancelled") or ``deadline`` (a ``time.time()``) has passed ("deadline").
+    """
+
+    def __init__(self, pieces: Iterator[str], finish: Callable[["Generation"], None]):
+        self._pieces = pieces
+        self._finish = finish
+        self._start = time.time()
+        self.text: List[str] = []
+        self.first_piece_at: Optional[float] = None
+        self.finish_reason: Optional[str] = None
+        self.usage: Dict = {}
+        self.timings: Optional[Dict] = None
+        self.done = False
+        self.cancelled = False
+        self.deadline: Optional[float] = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        reason = None if self.done else self.stop_reason(time.time())
+        if reason:
+            self.finish_reason = reason
+            self.close()
+            raise StopIteration
+        try:
+            piece = next(self._pieces)
+        except StopIteration:
+            self._close()
+            raise
+        if self.first_piece_at is None:
+            self.first_piece_at = time.time()
+        self.text.append(piece)
+        return piece
+
+    def stop_reason(self, now: float) -> Optional[str]:
+        if self.cancelled:
+            return "cancelled"
+        if self.deadline is not None and now >= self.deadline:
+            return "deadline"
+        return None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def close(self):
+        close = getattr(self._pieces, "close", None)
+        if close:
+            close()
+        if not self.done:
+            self.finish_reason = self.finish_reason or "cancelled"
+            self._close()
+
+    def _close(self):
+        if self.done:
+            return
+        self.done = True
+        self._finish(self)
+
+    def completion(self) -> Completion:
+        return Completion("".join(self.text), self.finish_reason, self.usage, self.timings)
+
+
+class Backend:
+    """Base class; subclasses implement tokenize, detokenize and stream."""
+
+    name = "base"
+    capabilities = frozenset()
+
+    def __init__(self, model_path: str, n_ctx: int = 4096):
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+
+    def supports(self, capability: str) -> bool:
+        return capability in self.capabilities
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        raise NotImplementedError
+
+    def detokenize(self, tokens: List[int]) -> bytes:
+        raise NotImplementedError
+
+    def stream(self, prompt: Prompt, **params) -> Generation:
+        """Start decoding ``prompt`` (text or token ids) with llama-cpp style sampling params (max_tokens, temperature, stop, ...)."""
+        raise NotImplementedError
+
+    def complete(self, prompt: Prompt, **params) -> Completion:
+        generation = self._start_tracked(prompt, params)
+        for _ in generation:
+            pass
+        return generation.completion()
+
+    def _start_tracked(self, prompt: Prompt, params: Dict) -> Generation:
+        """``stream()`` for a caller-facing request: honours ``deadline`` and stops if the HTTP client leaves."""
+        params = dict(params)
+        deadline = params.pop("deadline", None)
+        generation = self.stream(prompt, **params)
+        generation.deadline = deadline
+        return track(generation)
+
+    def save_state(self):
+        """Opaque snapshot of the KV cache (backends with KV_STATE only)."""
+        raise NotImplementedError(f"{self.name} backend cannot save KV state")
+
+    def load_state(self, state):
+        raise NotImplementedError(f"{self.name} backend cannot load KV state")
+
+    def close(self):
+        """Release the model's memory; the backend is unusable afterwards."""
+
+    def info(self) -> Dict:
+        return {"backend": self.name, "model": self.model_path, "nCtx": self.n_ctx, "capabilities": sorted(self.capabilities)}
+
+    def _usage(self, prompt: Prompt, generation: Generation) -> Dict[str, int]:
+        prompt_tokens = len(self.tokenize(prompt.encode("utf-8"), special=True)) if isinstance(prompt, str) else len(prompt)
+        text = "".join(generation.text)
+        completion_tokens = len(self.tokenize(text.encode("utf-8"), add_bos=False, special=True)) if text else 0
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def __call__(self, prompt: Prompt, stream: bool = False, echo: bool = False, **params):
+        """``Llama.__call__`` compatibility: a completion dict, or chunks ending with usage and timings."""
+        if not stream:
+            return self.complete(prompt, **params).to_output()
+        return self._chunks(self._start_tracked(prompt, params))
+
+    @staticmethod
+    def _chunks(generation: Generation) -> Iterator[Dict]:
+        try:
+            for piece in generation:
+                yield {"choices": [{"text": piece, "index": 0, "finish_reason": None}]}
+            yield {
+                "choices": [{"text": "", "index": 0, "finish_reason": generation.finish_reason}],
+                "usage": generation.usage,
+                "timings": generation.timings,
+            }
+        finally:
+            generation.close()
+
+
+class LlamaCppBackend(Backend):
+    """llama-cpp-python ``Llama``; extra keyword arguments go to its constructor."""
+
+    name = "llama.cpp"
+    capabilities = frozenset({STREAMING, KV_STATE, PREFIX_REUSE, LLAMA_CPP, GPU_OFFLOAD})
+
+    def __init__(self, model_path: str, n_ctx: int = 4096, **llama_kwargs):
+        from llama_cpp import Llama
+
+        super().__init__(model_path, n_ctx)
+        self.llama = Llama(model_path=model_path, n_ctx=n_ctx, **llama_kwargs)
+        self.n_batch = self.llama.n_batch
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        return self.llama.tokenize(text, add_bos=add_bos, special=special)
+
+    def detokenize(self, tokens: List[int]) -> bytes:
+        return self.llama.detokenize(tokens)
+
+    def _perf(self):
+        import llama_cpp
+
+        data = llama_cpp.llama_perf_context(self.llama._ctx.ctx)
+        return data.t_p_eval_ms, data.t_eval_ms, data.n_p_eval, data.n_eval
+
+    def stream(self, prompt: Prompt, **params) -> Generation:
+        before = self._perf()
+        chunks = self.llama(prompt, stream=True, echo=False, **params)
+        state = {"finish_reason": None}
+
+        def pieces():
+            for chunk in chunks:
+                choice = chunk["choices"][0]
+                state["finish_reason"] = choice.get("finish_reason") or state["finish_reason"]
+                if choice.get("text"):
+                    yield choice["text"]
+
+        def finish(generation: Generation):
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+            generation.finish_reason = state["finish_reason"] or generation.finish_reason
+            generation.usage = self._usage(prompt, generation)
+            # llama.cpp's perf counters are cumulative; the difference is this call
+            after = self._perf()
+            generation.timings = {
+                "queue": 0.0,
+                "prefill": round((after[0] - before[0]) / 1000, 4),
+                "decode": round((after[1] - before[1]) / 1000, 4),
+                "prefill_tokens": after[2] - before[2],
+                "decode_tokens": after[3] - before[3],
+            }
+
+        return Generation(pieces(), finish)
+
+    def save_state(self):
+        return self.llama.save_state()
+
+    def load_state(self, state):
+        self.llama.load_state(state)
+
+    def close(self):
+        self.llama.close()
+
+
+class OnnxGenAIBackend(Backend):
+    """
+    ONNX Runtime GenAI on CPU, for the int4 model exported by
+    notebooks/Transformers_to_onnx.ipynb (``model_path`` is the output folder
+    with genai_config.json). llama.cpp-only options such as ``n_batch`` or
+    ``n_gpu_layers`` are accepted and ignored so the same call sites work.
+
+    ``tokenize`` follows llama.cpp: BOS only when ``add_bos`` (the BOS id
+    comes from genai_config.json), and with ``special=False`` control-token
+    text from tokenizer.json is encoded as ordinary text instead of the
+    token. The generator's EOS is not counted as a completion token.
+    """
+
+    name = "onnxruntime-genai"
+    capabilities = frozenset({STREAMING})
+
+    def __init__(self, model_path: str, n_ctx: int = 4096, vocab_only: bool = False, **_ignored):
+        import onnxruntime_genai as og
+
+        super().__init__(model_path, n_ctx)
+        self._og = og
+        config = og.Config(model_path)
+        if hasattr(config, "clear_providers"):
+            config.clear_providers()  # the export targets CUDA; run it on the CPU provider
+        self.model = og.Model(config)
+        self.tokenizer = og.Tokenizer(self.model)
+        if hasattr(self.tokenizer, "update_options"):
+            self.tokenizer.update_options(add_special_tokens="false")  # BOS/EOS are added by tokenize()
+
+        with open(os.path.join(model_path, "genai_config.json"), "r", encoding="utf-8") as f:
+            model_config = json.load(f).get("model", {})
+        self.bos_token = model_config.get("bos_token_id")
+        eos = model_config.get("eos_token_id")
+        self.eos_tokens = set(eos if isinstance(eos, list) else [] if eos is None else [eos])
+        # Older onnxruntime-genai cannot turn the tokenizer's own BOS/EOS off
+        probe = self._encode("a")
+        self._strip_bos = self.bos_token is not None and probe[:1] == [self.bos_token]
+        self._strip_eos = bool(probe) and probe[-1] in self.eos_tokens
+        self._special = _control_tokens(model_path)
+        self._newline = self._plain_encode("\n")
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        text = text.decode("utf-8", errors="ignore")
+        if special or self._special is None or not self._special.search(text):
+            tokens = self._plain_encode(text)
+        else:
+            # The tokenizer always matches control tokens, so cut each one
+            # after its first character and encode the pieces as continuations
+            cuts = [0, *(m.start() + 1 for m in self._special.finditer(text)), len(text)]
+            pieces = [text[a:b] for a, b in zip(cuts, cuts[1:])]
+            tokens = self._plain_encode(pieces[0])
+            for piece in pieces[1:]:
+                tokens += self._continuation(piece)
+        if add_bos:
+            if self.bos_token is None:
+                raise ValueError(f"{self.name}: genai_config.json has no bos_token_id to add")
+            tokens = [self.bos_token] + tokens
+        return tokens
+
+    def _encode(self, text: str) -> List[int]:
+        return [int(t) for t in self.tokenizer.encode(text)] if text else []
+
+    def _plain_encode(self, text: str) -> List[int]:
+        tokens = self._encode(text)
+        if self._strip_bos and tokens[:1] == [self.bos_token]:
+            tokens = tokens[1:]
+        if self._strip_eos and tokens and tokens[-1] in self.eos_tokens:
+            tokens = tokens[:-1]
+        return tokens
+
+    def _continuation(self, text: str) -> List[int]:
+        """``text`` tokenized as it is after other text: behind a newline whose tokens are dropped."""
+        tokens = self._plain_encode("\n" + text)
+        n = len(self._newline)
+        if n and tokens[:n] == self._newline:
+            return tokens[n:]
+        return self._plain_encode(text)
+
+    def detokenize(self, tokens: List[int]) -> bytes:
+        return self.tokenizer.decode(np.array(tokens, dtype=np.int32)).encode("utf-8") if tokens else b""
+
+    def close(self):
+        self.tokenizer = self.model = None
+
+    def stream(self, prompt: Prompt, **params) -> Generation:
+        og = self._og
+        if isinstance(prompt, str):
+            prompt = self.tokenize(prompt.encode("utf-8"), special=True)
+        input_tokens = np.array(prompt, dtype=np.int32)
+        max_tokens = params.get("max_tokens") or self.n_ctx
+        max_length = min(self.n_ctx, len(input_tokens) + max_tokens)
+        if len(input_tokens) >= max_length:
+            raise ValueError(f"Requested tokens ({len(input_tokens)}) exceed context window of {self.n_ctx}")
+
+        temperature = params.get("temperature", 0.8)
+        options = {"max_length": max_length, "do_sample": temperature > 0}
+        if temperature > 0:
+            options.update(temperature=temperature, top_p=params.get("top_p", 0.95), top_k=params.get("top_k", 40))
+        if params.get("repeat_penalty"):
+            options["repetition_penalty"] = params["repeat_penalty"]
+        gen_params = og.GeneratorParams(self.model)
+        gen_params.set_search_options(**options)
+        generator = og.Generator(self.model, gen_params)
+        decoder = self.tokenizer.create_stream()
+        trimmer = StopTrimmer(params.get("stop") or [], strip=False)
+        state = {"tokens": 0, "reason": None, "start": time.time(), "first": None}
+
+        def pieces():
+            generator.append_tokens(input_tokens)
+            while not generator.is_done():
+                generator.generate_next_token()
+                token = generator.get_next_tokens()[0]
+                if state["first"] is None:
+                    state["first"] = time.time()
+                if int(token) in self.eos_tokens:
+                    break  # like llama.cpp, EOS ends the completion without being part of it
+                state["tokens"] += 1
+                text = trimmer.feed(decoder.decode(token))
+                if text:
+                    yield text
+                if trimmer.stopped:
+                    state["reason"] = "stop"
+                    return
+                if state["tokens"] >= max_tokens:
+                    state["reason"] = "length"
+                    break
+            tail = trimmer.flush()
+            if tail:
+                yield tail
+            # is_done() is set by EOS or by reaching max_length
+            state["reason"] = state["reason"] or ("length" if len(input_tokens) + state["tokens"] >= max_length else "stop")
+
+        def finish(generation: Generation):
+            generation.finish_reason = state["reason"] or generation.finish_reason
+            prompt_tokens = len(input_tokens)
+            generation.usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": state["tokens"],
+                "total_tokens": prompt_tokens + state["tokens"],
+            }
+            first = state["first"] or time.time()
+            generation.timings = {
+                "queue": 0.0,
+                "prefill": round(first - state["start"], 4),
+                "decode": round(time.time() - first, 4),
+                "prefill_tokens": prompt_tokens,
+                "decode_tokens": max(0, state["tokens"] - 1),
+            }
+
+        return Generation(pieces(), finish)
+
+
+def _control_tokens(model_path: str) -> Optional["re.Pattern"]:
+    """Pattern matching the special added tokens in the model folder's tokenizer.json (None if it has none)."""
+    try:
+        with open(os.path.join(model_path, "tokenizer.json"), "r", encoding="utf-8") as f:
+            added = json.load(f).get("added_tokens") or []
+    except (OSError, ValueError):
+        return None
+    contents = sorted({t["content"] for t in added if t.get("special") and t.get("content")}, key=len, reverse=True)
+    return re.compile("|".join(map(re.escape, contents))) if contents else None
+
+
+def _daemon_backend(model_path: str, **kwargs) -> Backend:
+    """Client of a running inference daemon; ``model_path`` is its address."""
+    from .daemon import DaemonBackend
+
+    return DaemonBackend(model_path, **kwargs)
+
+
+BACKENDS: Dict[str, Callable[..., Backend]] = {
+    LlamaCppBackend.name: LlamaCppBackend,
+    OnnxGenAIBackend.name: OnnxGenAIBackend,
+    "daemon": _daemon_backend,
+}
+
+
+def load_backend(name: str, model_path: str, **kwargs) -> Backend:
+    """Instantiate a backend by name; ``kwargs`` are passed to its constructor."""
+    try:
+        factory = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown inference backend {name!r} (available: {', '.join(sorted(BACKENDS))})") from None
+    return factory(model_path, **kwargs)
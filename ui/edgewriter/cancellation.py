@@ -0,0 +1,109 @@
+"""
+Stop generating for HTTP clients that went away.
+
+CancelOnDisconnect (ASGI middleware) gives every HTTP request a RequestJobs
+registry in a context variable, and the engines register each job they
+accept with ``track()``. Once the request body has been read, the middleware
+watches for ``http.disconnect``: if the client leaves (tab closed, stop
+clicked, a fetch timeout) before the response is finished, the request's jobs
+are cancelled and the decode loop drops them at its next step instead of
+generating up to max_tokens for nobody.
+
+Context variables follow the request into the thread pool that runs sync
+routes and streamed bodies, so jobs submitted from there are tracked too;
+jobs started outside a request (batch runs, warm-up, chat compaction) are not.
+"""
+import contextvars
+import threading
+from typing import List, Optional
+
+import anyio
+
+_current: "contextvars.ContextVar[Optional[RequestJobs]]" = contextvars.ContextVar("edgewriter_request_jobs", default=None)
+
+
+class RequestJobs:
+    """Jobs (anything with ``cancel()``) started on behalf of one HTTP request."""
+
+    def __init__(self):
+        self._jobs: List = []
+        self._lock = threading.Lock()
+        self.cancelled = False
+
+    def add(self, job):
+        with self._lock:
+            if not self.cancelled:
+                self._jobs.append(job)
+                return
+        job.cancel()  # the client is already gone
+
+    def cancel(self) -> int:
+        """Cancel every job still registered; returns how many there were."""
+        with self._lock:
+            self.cancelled = True
+            jobs, self._jobs = self._jobs, []
+        for job in jobs:
+            job.cancel()
+        return sum(1 for job in jobs if not getattr(job, "done", False))
+
+
+def track(job):
+    """Register ``job`` with the current HTTP request, if any, and return it."""
+    jobs = _current.get()
+    if jobs is not None:
+        jobs.add(job)
+    return job
+
+
+class CancelOnDisconnect:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        jobs = RequestJobs()
+        state = {"complete": False}
+        body_read = anyio.Event()
+
+        def disconnected():
+            if state["complete"]:
+                return
+            stopped = jobs.cancel()
+            if stopped:
+                print(f"[cancel] Client left {scope.get('path')}; stopped {stopped} generation(s)")
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request" and not message.get("more_body", False):
+                body_read.set()
+            elif message["type"] == "http.disconnect":
+                disconnected()
+            return message
+
+        async def send_wrapper(message):
+            await send(message)
+            if message["type"] == "http.response.pathsend" or (
+                message["type"] in ("http.response.body", "http.response.zerocopysend")
+                and not message.get("more_body", False)
+            ):
+                state["complete"] = True
+
+        async def watch():
+            # Routes read the body before generating; after that the only
+            # message left to receive is the disconnect
+            await body_read.wait()
+            while not state["complete"]:
+                if (await receive())["type"] == "http.disconnect":
+                    disconnected()
+                    return
+
+        token = _current.set(jobs)
+        try:
+            async with anyio.create_task_group() as tg:
+                tg.start_soon(watch)
+                await self.app(scope, receive_wrapper, send_wrapper)
+                tg.cancel_scope.cancel()
+        finally:
+            _current.reset(token)
@@ -0,0 +1,153 @@
+"""
+Token-budgeted chat history.
+
+ContextBudget decides how much history fits in a prompt by counting real
+tokens (room for the reply is reserved by the caller's budget): the oldest
+messages are dropped first, and a single message that is too long on its own
+keeps only its tail.
+
+Compactor runs in the background for server-held sessions. When the live part
+of a session's history grows past a threshold and the engine has nothing else
+to do, it folds the oldest turns into the session's running summary, so
+prompts stay a bounded size without silently losing earlier context.
+"""
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+
+class ContextBudget:
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        render: Callable[[List[Dict[str, str]], str], str],
+        budget: int,
+        truncate: Optional[Callable[[str, int], str]] = None,
+    ):
+        """
+        ``render(messages, summary)`` builds the prompt, ``truncate(text, n)``
+        keeps the last ``n`` tokens of a message.
+        """
+        self.count_tokens = count_tokens
+        self.render = render
+        self.budget = budget
+        self.truncate = truncate
+
+    def tokens(self, messages: List[Dict[str, str]], summary: str = "") -> int:
+        return self.count_tokens(self.render(messages, summary))
+
+    def drop_count(self, messages: List[Dict[str, str]], summary: str = "", target: Optional[int] = None) -> int:
+        """
+        Number of oldest messages to leave out so the prompt fits the budget.
+        When trimming is needed it goes down to ``target`` tokens (default:
+        the budget) so callers can trim in blocks. The last message is never dropped.
+        """
+        if self.tokens(messages, summary) <= self.budget:
+            return 0
+        target = min(target or self.budget, self.budget)
+        # Per-message costs are close to additive; confirm with a real count
+        base = self.tokens([], summary)
+        costs = [self.tokens([m]) - self.tokens([]) for m in messages]
+        total = base + sum(costs)
+        drop = 0
+        while drop < len(messages) - 1 and total > target:
+            total -= costs[drop]
+            drop += 1
+        while drop < len(messages) - 1 and self.tokens(messages[drop:], summary) > self.budget:
+            drop += 1
+        return drop
+
+    def fit(self, messages: List[Dict[str, str]], summary: str = "") -> str:
+        """Render the newest messages that fit; shorten the last one if it alone is too long."""
+        messages = messages[self.drop_count(messages, summary):]
+        prompt = self.render(messages, summary)
+        overflow = self.count_tokens(prompt) - self.budget
+        if overflow > 0 and messages and self.truncate:
+            last = messages[-1]
+            keep = max(1, self.count_tokens(last["content"]) - overflow - 8)
+            messages = messages[:-1] + [dict(last, content=self.truncate(last["content"], keep))]
+            prompt = self.render(messages, summary)
+        return prompt
+
+
+class Compactor:
+    """
+    Background folding of old session turns into a running summary.
+
+    ``plan(session)`` returns how many messages after ``session.window`` to
+    fold (0 when the session is small enough), ``summarize(session, messages)``
+    returns the new summary (it runs the session's model; None when that model
+    is no longer loaded, and the fold is skipped), and ``is_idle()`` says whether
+    the engine has queued or running work. ``store.compact`` applies the result.
+    """
+
+    def __init__(
+        self,
+        store,
+        plan: Callable[[object], int],
+        summarize: Callable[[object, List[Dict[str, str]]], Optional[str]],
+        is_idle: Callable[[], bool],
+        poll: float = 0.5,
+    ):
+        self.store = store
+        self.plan = plan
+        self.summarize = summarize
+        self.is_idle = is_idle
+        self.poll = poll
+        self.compactions = 0
+        self.folded_messages = 0
+        self.failures = 0
+        self.last_seconds: Optional[float] = None
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._loop, name="edgewriter-compactor", daemon=True).start()
+
+    def request(self, session_id: str):
+        """Check this session once the engine is idle."""
+        with self._lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+        self._queue.put(session_id)
+
+    def stats(self) -> Dict:
+        return {
+            "pending": len(self._pending),
+            "compactions": self.compactions,
+            "foldedMessages": self.folded_messages,
+            "failures": self.failures,
+            "lastSeconds": self.last_seconds,
+        }
+
+    def _loop(self):
+        while True:
+            session_id = self._queue.get()
+            while not self.is_idle():
+                time.sleep(self.poll)
+            with self._lock:
+                self._pending.discard(session_id)
+            try:
+                self._compact(session_id)
+            except Exception as e:
+                self.failures += 1
+                print(f"[compactor] Could not compact session {session_id[:8]}: {e}")
+
+    def _compact(self, session_id: str):
+        session = self.store.get(session_id)
+        if session is None or session.busy:
+            return
+        start = session.window
+        count = self.plan(session)
+        if count <= 0:
+            return
+        t0 = time.time()
+        summary = self.summarize(session, session.messages[start : start + count])
+        if summary is None:
+            return
+        if self.store.compact(session, start, start + count, summary):
+            self.compactions += 1
+            self.folded_messages += count
+            self.last_seconds = round(time.time() - t0, 2)
+            print(f"[compactor] Folded {count} messages of session {session_id[:8]} in {self.last_seconds}s")
@@ -0,0 +1,491 @@
+"""
+Shared inference daemon: one process loads the model and the front ends talk
+to it over a local socket.
+
+Start it once (from ``ui/``)::
+
+    python -m edgewriter.daemon --model phi_model_UI/phi3-writing-Q8.gguf
+
+then run the Integrated server, the Phi server or the Gradio app with
+``EDGEWRITER_DAEMON`` set to the same address. They load no model of their
+own: generation runs in the daemon's Scheduler (BackendEngine for runtimes
+other than llama.cpp), so requests from every front end are batched,
+prioritised and queued together against a single copy of the weights.
+
+The address is a Unix domain socket path (default
+``<tempdir>/edgewriter.sock``, readable by its owner only), or ``host:port``
+for loopback TCP where Python has no AF_UNIX (Windows).
+
+Protocol: one request per connection, a JSON object on one line, answered
+with JSON lines. ``complete`` replies ``{"accepted": <job id>}`` or an error
+(a full queue carries ``depth`` and ``retryAfter``), then one
+``{"chunk": ...}`` line per llama-cpp style chunk; the last one has the
+finish reason, usage and timings. The client closing the connection, or
+just its write side, cancels the generation at the next token. The other
+ops are ``info``, ``stats``, ``tokenize`` and ``detokenize`` (bytes as
+base64), ``drop_session`` and ``model_hash``.
+
+DaemonEngine is the client with the Scheduler interface (the Integrated
+server's model registry uses it as an engine); DaemonBackend wraps it as a
+Backend (``load_backend("daemon", address)``) for the Phi server and the
+Gradio app.
+"""
+import argparse
+import base64
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from .backends import LLAMA_CPP, STREAMING, Backend, Generation, load_backend
+from .cancellation import track
+from .scheduler import QueueFullError
+from .templates import Prompt
+
+DEFAULT_ADDRESS = (
+    os.path.join(tempfile.gettempdir(), "edgewriter.sock") if hasattr(socket, "AF_UNIX") else "127.0.0.1:8765"
+)
+CONNECT_TIMEOUT = 5.0
+
+
+def _address(address: str):
+    """(family, sockaddr) for a socket path or ``host:port``."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    if not hasattr(socket, "AF_UNIX"):
+        raise ValueError(f"Unix domain sockets are not available here; use host:port instead of {address!r}")
+    return socket.AF_UNIX, address
+
+
+def _encode(message: Dict) -> bytes:
+    return (json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+# --- daemon ---
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline() or b"null")
+        except ValueError:
+            request = None
+        if not isinstance(request, dict):
+            self._send({"error": "Malformed request", "type": "ValueError"})
+            return
+        daemon: InferenceDaemon = self.server.daemon
+        op = request.get("op")
+        try:
+            if op == "complete":
+                self._complete(daemon.engine, request)
+            elif op == "info":
+                self._send({"info": daemon.info()})
+            elif op == "stats":
+                self._send({"stats": daemon.engine.stats()})
+            elif op == "tokenize":
+                text = base64.b64decode(request["bytes"])
+                tokens = daemon.engine.tokenize(text, add_bos=request.get("add_bos", True), special=request.get("special", False))
+                self._send({"tokens": tokens})
+            elif op == "detokenize":
+                self._send({"bytes": base64.b64encode(daemon.engine.detokenize(request["tokens"])).decode("ascii")})
+            elif op == "drop_session":
+                daemon.engine.drop_session(request["session"])
+                self._send({"ok": True})
+            elif op == "model_hash":
+                self._send({"hash": daemon.model_hash()})
+            else:
+                self._send({"error": f"Unknown op: {op!r}", "type": "ValueError"})
+        except QueueFullError as e:
+            self._send({"error": str(e), "type": "QueueFullError", "depth": e.depth, "retryAfter": e.retry_after})
+        except ValueError as e:
+            self._send({"error": str(e), "type": "ValueError"})
+        except OSError:
+            pass  # the client went away
+        except Exception as e:
+            print(f"[daemon] {op} failed: {e}")
+            try:
+                self._send({"error": str(e), "type": "RuntimeError"})
+            except OSError:
+                pass
+
+    def _send(self, message: Dict):
+        self.wfile.write(_encode(message))
+
+    def _complete(self, engine, request: Dict):
+        job = engine.submit(request["prompt"], **(request.get("params") or {}))
+        self._send({"accepted": job.id})
+        threading.Thread(target=self._watch, args=(job,), daemon=True).start()
+        chunks = job.stream()
+        try:
+            for chunk in chunks:
+                self._send({"chunk": chunk})
+        finally:
+            chunks.close()  # cancels the job if the client could not be written to
+
+    def _watch(self, job):
+        """The client sends nothing after its request; EOF means it closed or cancelled."""
+        try:
+            while self.connection.recv(4096):
+                pass
+        except OSError:
+            pass
+        if not job.done:
+            job.cancel()
+
+
+class InferenceDaemon:
+    """Serves ``engine`` (a Scheduler or BackendEngine) on ``address``; see module docstring."""
+
+    def __init__(self, engine, address: str, model_path: str, backend: str, cache_dir: Optional[str] = None):
+        self.engine = engine
+        self.address = address
+        self.model_path = model_path
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self._hash: Optional[str] = None
+        self._hash_lock = threading.Lock()
+
+        family, sockaddr = _address(address)
+        if family == socket.AF_INET:
+            server_class = socketserver.ThreadingTCPServer
+            server_class.allow_reuse_address = True
+            self.server = server_class(sockaddr, _Handler)
+        else:
+            self._remove_stale_socket(sockaddr)
+            # Only this user may connect: the socket is created with mode 0600
+            umask = os.umask(0o177)
+            try:
+                self.server = socketserver.ThreadingUnixStreamServer(sockaddr, _Handler)
+            finally:
+                os.umask(umask)
+        self.server.daemon_threads = True
+        self.server.daemon = self
+
+    @staticmethod
+    def _remove_stale_socket(path: str):
+        if not os.path.exists(path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)  # left behind by a daemon that did not exit cleanly
+            return
+        finally:
+            probe.close()
+        raise RuntimeError(f"Another inference daemon is already listening on {path}")
+
+    def info(self) -> Dict:
+        return {
+            "backend": self.backend,
+            "model": self.model_path,
+            "pid": os.getpid(),
+            "nCtx": self.engine.n_ctx,
+            "nCtxSeq": self.engine.n_ctx_seq,
+            "maxBatch": self.engine.max_batch,
+            "maxQueue": self.engine.max_queue,
+        }
+
+    def model_hash(self) -> str:
+        """SHA-256 of the model file(s), computed on the first request for it."""
+        with self._hash_lock:
+            if self._hash is None:
+                from .prefix_cache import model_file_hash
+
+                self._hash = model_file_hash(self.model_path, self.cache_dir)
+            return self._hash
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def close(self):
+        self.server.server_close()
+        if isinstance(self.server.server_address, str) and os.path.exists(self.server.server_address):
+            os.unlink(self.server.server_address)
+        self.engine.close()
+
+
+# --- clients ---
+
+
+def _connect(address: str) -> socket.socket:
+    family, sockaddr = _address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(CONNECT_TIMEOUT)
+    try:
+        sock.connect(sockaddr)
+    except OSError as e:
+        sock.close()
+        raise ConnectionError(f"Inference daemon not reachable at {address} ({e}); start it with `python -m edgewriter.daemon`") from e
+    sock.settimeout(None)  # a long prefill is not a timeout
+    return sock
+
+
+def _reply(stream) -> Dict:
+    """Next message from the daemon, raising the error it reports."""
+    line = stream.readline()
+    if not line:
+        raise RuntimeError("Inference daemon closed the connection")
+    message = json.loads(line)
+    if "error" in message:
+        kind = message.get("type")
+        if kind == "QueueFullError":
+            raise QueueFullError(message["depth"], message["retryAfter"])
+        if kind == "ValueError":
+            raise ValueError(message["error"])
+        raise RuntimeError(message["error"])
+    return message
+
+
+class DaemonJob:
+    """A completion running in the daemon. Produced by DaemonEngine.submit()."""
+
+    def __init__(self, address: str, prompt: Prompt, params: Dict):
+        self._sock = _connect(address)
+        self._stream = self._sock.makefile("rb")
+        try:
+            self._sock.sendall(_encode({"op": "complete", "prompt": prompt, "params": params}))
+            self.id = _reply(self._stream)["accepted"]
+        except Exception:
+            self._release()
+            raise
+        self.submitted_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.finish_reason: Optional[str] = None
+        self.cancelled = False
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def cancel(self):
+        """Ask the daemon to stop; it still sends the final ("cancelled") chunk."""
+        if self.done or self.cancelled:
+            return
+        self.cancelled = True
+        try:
+            self._sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def _release(self):
+        self._stream.close()
+        self._sock.close()
+
+    def stream(self) -> Iterator[Dict]:
+        """Yield llama-cpp style chunks; the last one carries finish_reason, usage and timings."""
+        try:
+            while True:
+                try:
+                    chunk = _reply(self._stream)["chunk"]
+                except (RuntimeError, OSError):
+                    if not self.cancelled:
+                        raise
+                    chunk = {"choices": [{"text": "", "index": 0, "finish_reason": "cancelled"}], "usage": {}}
+                if "usage" in chunk:
+                    self.finish_reason = chunk["choices"][0].get("finish_reason")
+                    self.finished_at = time.time()
+                    yield chunk
+                    return
+                yield chunk
+        finally:
+            if not self.done:
+                self.cancel()
+                self.finished_at = time.time()
+            self._release()
+
+    def result(self) -> Dict:
+        """Block until the daemon finishes and return a llama-cpp style completion."""
+        text: List[str] = []
+        last: Dict = {}
+        for chunk in self.stream():
+            text.append(chunk["choices"][0].get("text") or "")
+            last = chunk
+        return {
+            "id": f"cmpl-daemon-{self.id}",
+            "object": "text_completion",
+            "created": int(self.submitted_at),
+            "choices": [{"text": "".join(text), "index": 0, "logprobs": None, "finish_reason": self.finish_reason}],
+            "usage": last.get("usage"),
+            "timings": last.get("timings"),
+        }
+
+
+class DaemonEngine:
+    """Scheduler-compatible client of a running daemon; holds no model memory."""
+
+    def __init__(self, address: str = DEFAULT_ADDRESS):
+        self.address = address
+        self.info = self._call({"op": "info"})["info"]
+        self.n_ctx = self.info["nCtx"]
+        self.n_ctx_seq = self.info["nCtxSeq"]
+        self.max_batch = self.info["maxBatch"]
+        self.max_queue = self.info["maxQueue"]
+
+    def _call(self, request: Dict) -> Dict:
+        sock = _connect(self.address)
+        try:
+            sock.sendall(_encode(request))
+            with sock.makefile("rb") as stream:
+                return _reply(stream)
+        finally:
+            sock.close()
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        request = {"op": "tokenize", "bytes": base64.b64encode(text).decode("ascii"), "add_bos": add_bos, "special": special}
+        return self._call(request)["tokens"]
+
+    def detokenize(self, tokens: List[int]) -> bytes:
+        return base64.b64decode(self._call({"op": "detokenize", "tokens": list(tokens)})["bytes"])
+
+    def submit(self, prompt: Prompt, **params) -> DaemonJob:
+        """
+        Queue a completion in the daemon. Takes Scheduler.submit()'s arguments
+        (``session``, ``speculative``, ``deadline``, ``priority``, sampling
+        params) and raises QueueFullError when the daemon's queue is full.
+        """
+        return track(DaemonJob(self.address, prompt, params))
+
+    def __call__(self, prompt: Prompt, stream: bool = False, echo: bool = False, **params):
+        job = self.submit(prompt, **params)
+        return job.stream() if stream else job.result()
+
+    def drop_session(self, session: str):
+        self._call({"op": "drop_session", "session": session})
+
+    def model_hash(self) -> str:
+        return self._call({"op": "model_hash"})["hash"]
+
+    def stats(self) -> Dict:
+        return {**self._call({"op": "stats"})["stats"], "mode": "daemon", "address": self.address}
+
+    def close(self):
+        """Nothing to release here: the daemon keeps the model."""
+
+
+class DaemonBackend(Backend):
+    """A Backend whose generation runs in the daemon (for the Phi server and Gradio app)."""
+
+    name = "daemon"
+    capabilities = frozenset({STREAMING})
+
+    def __init__(self, model_path: str = DEFAULT_ADDRESS, **_ignored):
+        """``model_path`` is the daemon's address; loading options belong to the daemon."""
+        self.engine = DaemonEngine(model_path)
+        super().__init__(self.engine.info["model"], self.engine.n_ctx_seq)
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        return self.engine.tokenize(text, add_bos=add_bos, special=special)
+
+    def detokenize(self, tokens: List[int]) -> bytes:
+        return self.engine.detokenize(tokens)
+
+    def stream(self, prompt: Prompt, **params) -> Generation:
+        chunks = self.engine.submit(prompt, **params).stream()
+        state: Dict = {}
+
+        def pieces():
+            for chunk in chunks:
+                if "usage" in chunk:
+                    state["final"] = chunk
+                    return
+                yield chunk["choices"][0]["text"]
+
+        def finish(generation: Generation):
+            chunks.close()  # cancels the daemon's job if it is still running
+            final = state.get("final")
+            if final is not None:
+                generation.finish_reason = generation.finish_reason or final["choices"][0].get("finish_reason")
+                generation.usage = final.get("usage") or {}
+                generation.timings = final.get("timings")
+
+        return Generation(pieces(), finish)
+
+    def info(self) -> Dict:
+        return {**super().info(), "address": self.engine.address, "daemon": self.engine.info}
+
+
+# --- command line ---
+
+
+def build_engine(args):
+    """Load the model and start the engine the daemon serves, as the Integrated server does."""
+    from .backend_engine import BackendEngine
+    from .scheduler import Scheduler
+
+    llama = args.backend == "llama.cpp"
+    llm = load_backend(
+        args.backend,
+        args.model,
+        # The Scheduler decodes in its own multi-sequence context
+        n_ctx=512 if llama else args.kv_ctx,
+        n_batch=512,
+        n_gpu_layers=args.gpu_layers,
+        use_mlock=args.mlock,
+        verbose=False,
+    )
+    if not llm.supports(LLAMA_CPP):
+        return BackendEngine(llm, max_queue=args.max_queue)
+    return Scheduler(
+        llm.llama,
+        max_batch=args.max_batch,
+        max_queue=args.max_queue,
+        n_ctx=args.kv_ctx,
+        session_slots=args.session_slots,
+        pause_slots=args.pause_slots,
+    )
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    env = os.environ.get
+    default_model = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "phi_model_UI", "phi3-writing-Q8.gguf")
+    parser = argparse.ArgumentParser(description="Serve one EdgeWriter model to every front end over a local socket")
+    parser.add_argument("--address", default=env("EDGEWRITER_DAEMON") or DEFAULT_ADDRESS, help=f"Socket path or host:port (default: {DEFAULT_ADDRESS})")
+    parser.add_argument("--model", default=env("EDGEWRITER_MODEL_PATH") or default_model, help="GGUF file, or the ONNX export folder")
+    parser.add_argument("--backend", default=env("EDGEWRITER_BACKEND", "llama.cpp"), help="llama.cpp or onnxruntime-genai")
+    parser.add_argument("--kv-ctx", type=int, default=int(env("EDGEWRITER_KV_CTX", "4096")), help="KV cells shared by all requests")
+    parser.add_argument("--max-batch", type=int, default=int(env("EDGEWRITER_MAX_BATCH", "4")), help="Sequences decoded together")
+    parser.add_argument("--max-queue", type=int, default=int(env("EDGEWRITER_MAX_QUEUE", "16")), help="Waiting requests before 429")
+    parser.add_argument("--session-slots", type=int, default=int(env("EDGEWRITER_SESSION_KV_SLOTS", "4")), help="Chat sessions that keep their KV")
+    parser.add_argument("--pause-slots", type=int, default=int(env("EDGEWRITER_PAUSE_SLOTS") or -1), help="Preempted generations kept paused (default: max batch)")
+    parser.add_argument("--gpu-layers", type=int, default=-1, help="Layers offloaded to the GPU (-1 = all)")
+    parser.add_argument("--mlock", action="store_true", default=env("EDGEWRITER_MLOCK", "0") != "0", help="Lock the weights in RAM")
+    parser.add_argument("--cache-dir", default=env("EDGEWRITER_PREFIX_CACHE_DIR") or None, help="Where the model hash is remembered")
+    args = parser.parse_args(argv)
+    if args.backend == "daemon":
+        parser.error("the daemon needs a real backend")
+    if args.pause_slots < 0:
+        args.pause_slots = None
+    return args
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    if not os.path.exists(args.model):
+        raise SystemExit(f"Model not found: {args.model}")
+    print(f"Loading {args.model} ({args.backend})...")
+    start = time.time()
+    engine = build_engine(args)
+    daemon = InferenceDaemon(engine, args.address, os.path.abspath(args.model), args.backend, args.cache_dir)
+    print(f"✓ Model loaded in {time.time() - start:.1f}s; serving on {args.address}")
+    print(f"  Start the front ends with EDGEWRITER_DAEMON={args.address}")
+    # Exit through the finally below (removing the socket file) on `kill` too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Stopping inference daemon")
+        daemon.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Deterministic stand-in for the Phi-3 scheduler, for benchmarking the servers.
+
+FakeScheduler has the same interface as Scheduler (submit/__call__,
+tokenize/detokenize, stats, drop_session) and the same batching shape: up to
+``max_batch`` jobs advance one token per step, new jobs pay a per-token
+prefill cost on their first step, and a full queue raises QueueFullError.
+Jobs are queued by priority class and a higher-class job pauses a lower-class
+one when the batch is full; deadlines and client disconnects stop a job at
+its next step. Instead of running a model it sleeps ``token_delay`` per step
+and emits words picked from the prompt, so HTTP, queueing, streaming,
+preemption and cancellation overhead can be measured on any machine without
+the GGUF.
+"""
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Dict, List, Optional
+
+from .cancellation import track
+from .scheduler import DEFAULT_PARAMS, PRIORITIES, Job, QueueFullError, enqueue, priority_rank
+from .templates import Prompt
+
+# Bytes per fake token; roughly what the Phi-3 tokenizer averages on English
+_TOKEN_BYTES = 4
+
+
+class FakeScheduler:
+    def __init__(
+        self,
+        max_batch: int = 4,
+        max_queue: int = 16,
+        n_ctx: int = 4096,
+        token_delay: float = 0.02,
+        prefill_delay: float = 0.0002,
+        output_tokens: int = 128,
+        pause_slots: Optional[int] = None,
+    ):
+        """
+        ``token_delay`` is the duration of one decode step (shared by the whole
+        batch), ``prefill_delay`` the cost per prompt token, and
+        ``output_tokens`` the reply length unless ``max_tokens`` is smaller.
+        ``pause_slots`` is how many preempted jobs may be paused at once
+        (default ``max_batch``; 0 never preempts).
+        """
+        self.max_batch = max(1, max_batch)
+        self.max_queue = max(0, max_queue)
+        self.n_ctx = n_ctx
+        self.n_ctx_seq = n_ctx
+        self.token_delay = token_delay
+        self.prefill_delay = prefill_delay
+        self.output_tokens = output_tokens
+        self.pause_slots = self.max_batch if pause_slots is None else max(0, pause_slots)
+
+        self._waiting: deque = deque()
+        self._running: List[Job] = []
+        self._paused: List[Job] = []
+        self._words: Dict[int, List[str]] = {}
+        self._lock = threading.Condition()
+        self.completed = 0
+        self.rejected = 0
+        self.preempted = 0
+        self._thread = threading.Thread(target=self._loop, name="edgewriter-fake-scheduler", daemon=True)
+        self._thread.start()
+
+    # --- Scheduler interface ---
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        # Lossless: every token carries its bytes behind a 0x01 length marker
+        return [int.from_bytes(b"\x01" + text[i : i + _TOKEN_BYTES], "big") for i in range(0, len(text), _TOKEN_BYTES)]
+
+    def detokenize(self, tokens: List[int]) -> bytes:
+        return b"".join(t.to_bytes((t.bit_length() + 7) // 8, "big")[1:] for t in tokens)
+
+    def submit(
+        self,
+        prompt: Prompt,
+        session: Optional[str] = None,
+        speculative: int = 0,
+        deadline: Optional[float] = None,
+        priority: str = "normal",
+        **params,
+    ) -> Job:
+        rank = priority_rank(priority)
+        merged = {**DEFAULT_PARAMS, **{k: v for k, v in params.items() if k in DEFAULT_PARAMS}}
+        tokens = self.tokenize(prompt.encode("utf-8"), special=True) if isinstance(prompt, str) else list(prompt)
+        if len(tokens) >= self.n_ctx_seq:
+            raise ValueError(f"Requested tokens ({len(tokens)}) exceed context window of {self.n_ctx_seq}")
+        merged["max_tokens"] = min(merged["max_tokens"] or self.n_ctx_seq, self.n_ctx_seq - len(tokens))
+        job = Job(prompt, tokens, merged, session=session, deadline=deadline, priority=rank)
+        with self._lock:
+            if len(self._waiting) >= self.max_queue:
+                self.rejected += 1
+                retry_after = max(1, int(len(self._waiting) * self.output_tokens * self.token_delay / self.max_batch))
+                raise QueueFullError(len(self._waiting), retry_after)
+            enqueue(self._waiting, job)
+            self._lock.notify()
+        return track(job)
+
+    def drop_session(self, session: str):
+        pass
+
+    def __call__(self, prompt: Prompt, stream: bool = False, echo: bool = False, **params):
+        job = self.submit(prompt, **params)
+        return job.stream() if stream else job.result()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            waiting = len(self._waiting)
+            queued = {name: sum(1 for j in self._waiting if j.priority == rank) for rank, name in enumerate(PRIORITIES)}
+        return {
+            "mode": "fake",
+            "queueDepth": waiting,
+            "queued": queued,
+            "running": len(self._running),
+            "paused": len(self._paused),
+            "preempted": self.preempted,
+            "maxBatch": self.max_batch,
+            "maxQueue": self.max_queue,
+            "kvCells": self.n_ctx,
+            "tokenDelay": self.token_delay,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    # --- worker ---
+
+    def _reply_words(self, job: Job) -> List[str]:
+        """Words of the prompt (minus template markup), rotated by a hash of the prompt."""
+        prompt = job.prompt if isinstance(job.prompt, str) else self.detokenize(job.prompt).decode("utf-8", errors="ignore")
+        words = [w for w in prompt.split() if "<|" not in w] or ["lorem", "ipsum"]
+        offset = zlib.crc32(prompt.encode("utf-8")) % len(words)
+        return words[offset:] + words[:offset]
+
+    def _admit(self) -> int:
+        """Fill the batch highest class first, pausing lower-class jobs as Scheduler does; returns the prefill tokens."""
+        now = time.time()
+        for job in [j for j in self._waiting if j.stop_reason(now)]:
+            self._waiting.remove(job)
+            job._close(job.stop_reason(now))
+        for job in [j for j in self._paused if j.stop_reason(now)]:
+            self._paused.remove(job)
+            job.paused = False
+            self._close(job, job.stop_reason(now))
+
+        prefill = 0
+        while True:
+            candidates = self._paused[:1] + list(self._waiting)[:1]
+            job = min(candidates, key=lambda j: (j.priority, not j.paused, j.id), default=None)
+            if job is None:
+                break
+            if len(self._running) >= self.max_batch:
+                victims = [j for j in self._running if j.priority > job.priority]
+                if not victims or len(self._paused) >= self.pause_slots:
+                    break
+                victim = max(victims, key=lambda j: (j.priority, j.admitted_at or 0))
+                self._running.remove(victim)
+                victim.paused = True
+                victim.preemptions += 1
+                self._paused.append(victim)
+                self._paused.sort(key=lambda j: (j.priority, j.id))
+                self.preempted += 1
+            if job.paused:
+                self._paused.remove(job)
+                job.paused = False
+            else:
+                self._waiting.popleft()
+                job.admitted_at = time.time()
+                prefill += len(job.prompt_tokens)
+                self._words[job.id] = self._reply_words(job)
+            self._running.append(job)
+        return prefill
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                while not self._waiting and not self._running and not self._paused:
+                    self._lock.wait()
+                prefill = self._admit()
+            time.sleep(self.token_delay + prefill * self.prefill_delay)
+
+            now = time.time()
+            for job in list(self._running):
+                reason = job.stop_reason(now)
+                if reason:
+                    self._finish(job, reason)
+                    continue
+                if job.first_token_at is None:
+                    job.first_token_at = time.time()
+                    job.n_past = len(job.prompt_tokens)
+                words = self._words[job.id]
+                n = len(job.completion_tokens)
+                job.completion_tokens.append(n)
+                job.n_past += 1
+                job._push(job._trimmer.feed((" " if n else "") + words[n % len(words)]))
+                if job._trimmer.stopped:
+                    self._finish(job, "stop")
+                elif n + 1 >= job.max_tokens:
+                    self._finish(job, "length")
+                elif n + 1 >= self.output_tokens:
+                    self._finish(job, "stop")
+
+    def _finish(self, job: Job, reason: str):
+        with self._lock:
+            self._running.remove(job)
+        self._close(job, reason)
+
+    def _close(self, job: Job, reason: str):
+        self._words.pop(job.id, None)
+        if reason != "cancelled":
+            job._push(job._trimmer.flush())
+            self.completed += 1
+        job._close(reason)
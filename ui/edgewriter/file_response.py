@@ -0,0 +1,180 @@
+"""
+HTTP responses for large static model files (MediaPipe's weights.bin).
+
+FileRangeResponse serves one file for GET/HEAD with:
+
+- validators: a strong ETag built from size and mtime (as nginx does) plus
+  Last-Modified, so a reload revalidates with If-None-Match /
+  If-Modified-Since and gets a 304 instead of the whole file;
+- byte ranges: one range is a 206 with Content-Range, several (``bytes=a-b,c-d``)
+  a ``multipart/byteranges`` body, If-Range falls back to the full file when
+  the validator changed, and an unsatisfiable range is a 416;
+- a body that avoids Python copies where the server allows it: with the ASGI
+  zero-copy send extension the server gets the file descriptor and offsets
+  and uses sendfile(2); a whole-file body uses ``http.response.pathsend``
+  when offered. Otherwise the file is read with os.pread in large blocks on a
+  worker thread.
+"""
+import os
+import stat
+import uuid
+from email.utils import formatdate
+from typing import Dict, List, Optional, Tuple
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import Response
+
+from .http_ranges import file_etag, multipart_parts, not_modified, parse_ranges, range_applies
+
+_CHUNK = 1024 * 1024
+
+
+def _read_at(f, n: int, pos: int) -> bytes:
+    if hasattr(os, "pread"):
+        return os.pread(f.fileno(), n, pos)
+    f.seek(pos)  # Windows: no pread; each response has its own file object
+    return f.read(n)
+
+
+class FileRangeResponse(Response):
+    def __init__(
+        self,
+        path: str,
+        headers: Optional[Dict[str, str]] = None,
+        media_type: str = "application/octet-stream",
+        stat_result: Optional[os.stat_result] = None,
+    ):
+        """``headers`` are added to every answer (e.g. Cache-Control); the file is stat'ed at send time if needed."""
+        self.path = path
+        self.status_code = 200
+        self.media_type = media_type
+        self.background = None
+        self.extra_headers = dict(headers or {})
+        self.stat_result = stat_result
+        self.init_headers(self.extra_headers)
+
+    async def __call__(self, scope, receive, send):
+        st = self.stat_result or await anyio.to_thread.run_sync(os.stat, self.path)
+        if not stat.S_ISREG(st.st_mode):
+            raise RuntimeError(f"Not a regular file: {self.path}")
+        size = st.st_size
+        etag = file_etag(st)
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+        request = Headers(scope=scope)
+        head_only = scope.get("method", "GET").upper() == "HEAD"
+        base = {**self.extra_headers, "Accept-Ranges": "bytes", "ETag": etag, "Last-Modified": last_modified}
+
+        if not_modified(request.get("if-none-match"), request.get("if-modified-since"), etag, st.st_mtime):
+            await self._send_head(send, 304, base, final=True)
+            return
+
+        ranges = None
+        range_header = request.get("range")
+        if range_header and range_applies(request.get("if-range"), etag, last_modified):
+            ranges = parse_ranges(range_header, size)
+        if ranges == []:
+            headers = {**base, "Content-Range": f"bytes */{size}", "Content-Length": "0"}
+            await self._send_head(send, 416, headers, final=True)
+            return
+
+        if not ranges:
+            headers = {**base, "Content-Type": self.media_type, "Content-Length": str(size)}
+            await self._send_head(send, 200, headers, final=head_only)
+            if not head_only:
+                await self._until_disconnect(
+                    scope, receive, lambda: self._send_file(scope, send, [(0, size - 1)] if size else [], whole=True)
+                )
+            return
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers = {
+                **base,
+                "Content-Type": self.media_type,
+                "Content-Range": f"bytes {start}-{end}/{size}",
+                "Content-Length": str(end - start + 1),
+            }
+            await self._send_head(send, 206, headers, final=head_only)
+            if not head_only:
+                await self._until_disconnect(scope, receive, lambda: self._send_file(scope, send, ranges))
+            return
+
+        boundary = uuid.uuid4().hex
+        parts, closing, length = multipart_parts(ranges, size, self.media_type, boundary)
+        headers = {
+            **base,
+            "Content-Type": f"multipart/byteranges; boundary={boundary}",
+            "Content-Length": str(length),
+        }
+        await self._send_head(send, 206, headers, final=head_only)
+        if head_only:
+            return
+
+        async def send_parts():
+            for i, (part, rng) in enumerate(zip(parts, ranges)):
+                await send({"type": "http.response.body", "body": (b"\r\n" if i else b"") + part, "more_body": True})
+                await self._send_file(scope, send, [rng], last=False)
+            await send({"type": "http.response.body", "body": closing, "more_body": False})
+
+        await self._until_disconnect(scope, receive, send_parts)
+
+    @staticmethod
+    async def _until_disconnect(scope, receive, send_body):
+        """
+        Run ``send_body()``, stopping early if the client goes away. Servers
+        before ASGI spec 2.4 silently drop sends after a disconnect, so the
+        file would otherwise be read to the end for nobody.
+        """
+        spec_version = tuple(int(v) for v in scope.get("asgi", {}).get("spec_version", "2.0").split("."))
+        if spec_version >= (2, 4):
+            await send_body()
+            return
+        async with anyio.create_task_group() as tg:
+
+            async def run():
+                await send_body()
+                tg.cancel_scope.cancel()
+
+            tg.start_soon(run)
+            while True:
+                if (await receive())["type"] == "http.disconnect":
+                    tg.cancel_scope.cancel()
+                    break
+
+    def _raw(self, headers: Dict[str, str]) -> List[Tuple[bytes, bytes]]:
+        return [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in headers.items()]
+
+    async def _send_head(self, send, status: int, headers: Dict[str, str], final: bool):
+        await send({"type": "http.response.start", "status": status, "headers": self._raw(headers)})
+        if final:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _send_file(self, scope, send, ranges: List[Tuple[int, int]], whole: bool = False, last: bool = True):
+        extensions = scope.get("extensions") or {}
+        if not ranges:
+            await send({"type": "http.response.body", "body": b"", "more_body": not last})
+            return
+        if whole and last and "http.response.pathsend" in extensions:
+            await send({"type": "http.response.pathsend", "path": os.path.abspath(self.path)})
+            return
+        with open(self.path, "rb", buffering=0) as f:
+            for i, (start, end) in enumerate(ranges):
+                more = not last or i < len(ranges) - 1
+                if "http.response.zerocopysend" in extensions:
+                    await send({
+                        "type": "http.response.zerocopysend",
+                        "file": f,
+                        "offset": start,
+                        "count": end - start + 1,
+                        "more_body": more,
+                    })
+                    continue
+                pos = start
+                while pos <= end:
+                    n = min(_CHUNK, end - pos + 1)
+                    chunk = await anyio.to_thread.run_sync(_read_at, f, n, pos)
+                    if not chunk:
+                        raise RuntimeError(f"{self.path} shrank while being sent")
+                    pos += len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": more or pos <= end})
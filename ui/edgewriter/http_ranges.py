@@ -0,0 +1,100 @@
+"""
+Byte ranges and validators for serving large static files.
+
+Standard library only: shared by FileRangeResponse (file_response.py) and
+the standalone nano_model_UI server, which runs without FastAPI.
+"""
+from email.utils import parsedate_to_datetime
+from typing import List, Optional, Tuple
+
+# More ranges than this (or overlapping ones that merge into fewer) are served as the whole file
+MAX_RANGES = 64
+
+
+def file_etag(st) -> str:
+    """Strong ETag from an ``os.stat_result``: size and mtime, as nginx does."""
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def parse_ranges(header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Inclusive (start, end) byte ranges from a Range header, sorted with
+    overlapping/adjacent ones merged. None means "ignore the header and send
+    the whole file" (not a bytes range, malformed, too many parts); an empty
+    list means nothing in it is satisfiable.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(","):
+        first, dash, last = part.strip().partition("-")
+        first, last = first.strip(), last.strip()
+        if not dash or not (first or last) or not (first + last).isdigit():
+            return None
+        if not first:
+            # bytes=-N: the last N bytes
+            if int(last) == 0:
+                continue
+            ranges.append((max(size - int(last), 0), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < size:
+            ranges.append((start, min(int(last), size - 1) if last else size - 1))
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def http_date(value: Optional[str]) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(value).timestamp() if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def not_modified(if_none_match: Optional[str], if_modified_since: Optional[str], etag: str, mtime: float) -> bool:
+    """Whether a conditional GET can be answered with 304."""
+    if if_none_match is not None:
+        # Weak comparison, as RFC 9110 prescribes for If-None-Match
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+    since = http_date(if_modified_since)
+    return since is not None and int(mtime) <= since
+
+
+def range_applies(if_range: Optional[str], etag: str, last_modified: str) -> bool:
+    """If-Range: ranges only apply while the client's copy is still current (strong comparison)."""
+    if if_range is None:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag
+    return if_range == last_modified
+
+
+def multipart_parts(ranges: List[Tuple[int, int]], size: int, media_type: str, boundary: str):
+    """
+    Part headers and closing delimiter of a ``multipart/byteranges`` body,
+    plus its total length. The body is ``part[0] + range 0 + "\\r\\n" + part[1]
+    + range 1 ... + closing``.
+    """
+    parts = [
+        (
+            f"--{boundary}\r\nContent-Type: {media_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+        ).encode("latin-1")
+        for start, end in ranges
+    ]
+    closing = f"\r\n--{boundary}--\r\n".encode("latin-1")
+    length = sum(len(p) for p in parts) + sum(end - start + 1 for start, end in ranges)
+    length += 2 * (len(ranges) - 1) + len(closing)
+    return parts, closing, length
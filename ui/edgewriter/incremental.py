@@ -0,0 +1,116 @@
+"""
+Paragraph-level incremental processing for iterative editing.
+
+The input is split on blank lines and every paragraph is run through the task
+template on its own. A paragraph's output is stored in the response cache
+under the same key a /generate request for just that paragraph would use, so
+re-running a task after a small edit only sends the changed paragraphs to
+the model. The result is reassembled with the original paragraph breaks and
+returned with per-paragraph provenance.
+"""
+import hashlib
+import re
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from .longdoc import run_batch
+from .response_cache import ResponseCache
+from .templates import Prompt
+
+_PARAGRAPH_BREAK = re.compile(r"(\n[ \t]*\n\s*)")
+
+
+def split_paragraphs(text: str) -> Tuple[List[str], List[str]]:
+    """Return (paragraphs, separators); separators[i] sits between paragraphs i and i+1."""
+    parts = _PARAGRAPH_BREAK.split(text.strip())
+    return parts[0::2], parts[1::2]
+
+
+def paragraph_hash(paragraph: str) -> str:
+    return hashlib.sha256(paragraph.strip().encode("utf-8")).hexdigest()[:16]
+
+
+def process_incremental(
+    scheduler,
+    text: str,
+    render: Callable[[str], str],
+    cache_key: Callable[[str], str],
+    params: Dict,
+    trim: List[str],
+    cache: Optional[ResponseCache],
+    window: int,
+    build: Optional[Callable[[str], Prompt]] = None,
+) -> Iterator[Tuple[str, Dict]]:
+    """
+    Yield ``("paragraph", {...})`` for every paragraph produced by the model
+    and a final ``("done", {...})`` with the reassembled text, per-paragraph
+    provenance (``source`` is ``cache``, ``model`` or ``empty``) and token totals.
+    ``cache_key`` maps a rendered prompt to its response-cache key;
+    ``build`` makes the prompt submitted for a paragraph that missed the
+    cache (default: the rendered text).
+
+    The cache lookups and prompts are done when this is called, not on the
+    first iteration, so an exception from ``build`` (a paragraph that does
+    not fit the context) reaches the caller before anything is submitted or
+    a response has started.
+    """
+    start = time.time()
+    paragraphs, separators = split_paragraphs(text)
+    results: List[str] = [""] * len(paragraphs)
+    provenance: List[Dict] = []
+    todo: List[Tuple[int, Prompt, str]] = []  # (index, prompt, cache key)
+
+    for i, paragraph in enumerate(paragraphs):
+        entry = {"index": i, "hash": paragraph_hash(paragraph), "chars": len(paragraph)}
+        provenance.append(entry)
+        if not paragraph.strip():
+            entry["source"] = "empty"
+            continue
+        prompt = render(paragraph)
+        key = cache_key(prompt)
+        hit = cache.get(key) if cache is not None else None
+        if hit is not None:
+            results[i] = hit["text"]
+            entry["source"] = "cache"
+        else:
+            entry["source"] = "model"
+            todo.append((i, build(paragraph) if build else prompt, key))
+    return _run(scheduler, todo, results, separators, provenance, params, trim, cache, window, start)
+
+
+def _run(scheduler, todo, results, separators, provenance, params, trim, cache, window, start) -> Iterator[Tuple[str, Dict]]:
+    tokens = {"prompt": 0, "completion": 0, "total": 0}
+    outputs = run_batch(scheduler, [prompt for _, prompt, _ in todo], params, trim, window)
+    for j, result, output in outputs:
+        i, _, key = todo[j]
+        usage = output["usage"]
+        results[i] = result
+        entry = provenance[i]
+        entry["tokens"] = {
+            "prompt": usage.get("prompt_tokens", 0),
+            "completion": usage.get("completion_tokens", 0),
+            "total": usage.get("total_tokens", 0),
+        }
+        for name in tokens:
+            tokens[name] += entry["tokens"][name]
+        if cache is not None:
+            cache.put(key, {
+                "text": result,
+                "tokens": entry["tokens"],
+                "raw_output": output["choices"][0]["text"],
+                "finish_reason": output["choices"][0].get("finish_reason"),
+            })
+        yield "paragraph", {**entry, "text": result}
+
+    assembled = results[0] if results else ""
+    for separator, result in zip(separators, results[1:]):
+        assembled += separator + result
+
+    yield "done", {
+        "text": assembled,
+        "latency": round(time.time() - start, 2),
+        "paragraphs": provenance,
+        "reused": sum(1 for e in provenance if e["source"] == "cache"),
+        "processed": len(todo),
+        "tokens": tokens,
+    }
@@ -0,0 +1,168 @@
+"""
+Map-reduce summarization for documents that do not fit in one prompt.
+
+The text is split into chunks on paragraph, then sentence, then word
+boundaries using real token counts. Every chunk is summarized as its own
+scheduler job, so the chunks are decoded together in the same batches, and
+the partial summaries are merged (recursively, if they still do not fit)
+into one final summary. ``summarize_long`` yields progress events as it goes.
+"""
+import re
+import time
+from collections import deque
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from .backends import Completion
+from .scheduler import QueueFullError
+from .templates import Prompt
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+MAX_LEVELS = 6
+
+
+def split_chunks(text: str, count_tokens: Callable[[str], int], max_tokens: int) -> List[str]:
+    """Greedily pack paragraphs (or sentences/words of oversized ones) into chunks of <= max_tokens."""
+    units: List[Tuple[str, str]] = []  # (text, separator used to join it to the previous unit)
+    for paragraph in re.split(r"\n\s*\n", text.strip()):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if count_tokens(paragraph) <= max_tokens:
+            units.append((paragraph, "\n\n"))
+            continue
+        sep = "\n\n"
+        for sentence in _SENTENCE_END.split(paragraph):
+            if count_tokens(sentence) <= max_tokens:
+                units.append((sentence, sep))
+            else:
+                words = sentence.split()
+                # Words are ~1-3 tokens; halve until a slice fits
+                step = max(1, max_tokens // 3)
+                i = 0
+                while i < len(words):
+                    n = step
+                    while n > 1 and count_tokens(" ".join(words[i : i + n])) > max_tokens:
+                        n //= 2
+                    units.append((" ".join(words[i : i + n]), sep if i == 0 else " "))
+                    i += n
+            sep = " "
+
+    chunks: List[str] = []
+    current = ""
+    for unit, sep in units:
+        candidate = f"{current}{sep}{unit}" if current else unit
+        if current and count_tokens(candidate) > max_tokens:
+            chunks.append(current)
+            current = unit
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def clean_output(output: Dict, trim: List[str]) -> str:
+    return Completion.from_output(output).clean_text(trim)
+
+
+def run_batch(scheduler, prompts: List[Prompt], params: Dict, trim: List[str], window: int) -> Iterator[Tuple[int, str, Dict]]:
+    """
+    Submit ``prompts`` keeping at most ``window`` jobs in flight and yield
+    (index, trimmed text, completion) in order. Outstanding jobs are
+    cancelled if the consumer stops early.
+    """
+    pending = deque(enumerate(prompts))
+    inflight = deque()
+    try:
+        while pending or inflight:
+            while pending and len(inflight) < window:
+                try:
+                    job = scheduler.submit(pending[0][1], **params)
+                except QueueFullError as e:
+                    if inflight:
+                        break
+                    time.sleep(min(e.retry_after, 2))
+                    continue
+                inflight.append((pending.popleft()[0], job))
+            index, job = inflight.popleft()
+            output = job.result()
+            yield index, clean_output(output, trim), output
+    finally:
+        for _, job in inflight:
+            job.cancel()
+
+
+def summarize_long(
+    scheduler,
+    text: str,
+    map_prompt: Callable[[str], Prompt],
+    merge_prompt: Callable[[str], Prompt],
+    params: Dict,
+    trim: List[str],
+    chunk_tokens: int,
+    window: int,
+    count_tokens: Optional[Callable[[str], int]] = None,
+) -> Iterator[Tuple[str, Dict]]:
+    """
+    Yield ``("progress", {...})`` after every finished chunk and a final
+    ``("done", {...})`` with the summary, latency, chunk/level counts and
+    token totals. ``count_tokens`` sizes chunks as they will appear in the
+    prompt (default: the scheduler's tokenizer on the chunk alone).
+
+    If the summaries still do not fit one chunk after MAX_LEVELS merge
+    levels, the final prompt gets an equal share of the chunk from the start
+    of each remaining summary, and ``done`` reports ``truncated: true``.
+    """
+    start = time.time()
+    count = count_tokens or (lambda s: len(scheduler.tokenize(s.encode("utf-8"), add_bos=False)))
+    tokens = {"prompt": 0, "completion": 0, "total": 0}
+
+    def add_usage(usage):
+        tokens["prompt"] += usage.get("prompt_tokens", 0)
+        tokens["completion"] += usage.get("completion_tokens", 0)
+        tokens["total"] += usage.get("total_tokens", 0)
+
+    pieces = split_chunks(text, count, chunk_tokens)
+    n_chunks = len(pieces)
+    level = 0
+    render = map_prompt
+    while len(pieces) > 1 and level < MAX_LEVELS:
+        stage = "map" if level == 0 else "merge"
+        yield "progress", {"stage": stage, "level": level, "done": 0, "total": len(pieces)}
+        summaries = [""] * len(pieces)
+        for done, (index, summary, output) in enumerate(
+            run_batch(scheduler, [render(p) for p in pieces], params, trim, window), start=1
+        ):
+            summaries[index] = summary
+            add_usage(output["usage"])
+            yield "progress", {
+                "stage": stage,
+                "level": level,
+                "done": done,
+                "total": len(pieces),
+                "chunk": index,
+                "summary": summary,
+            }
+        level += 1
+        render = merge_prompt
+        pieces = split_chunks("\n\n".join(s for s in summaries if s), count, chunk_tokens)
+
+    truncated = len(pieces) > 1
+    if truncated:
+        # Out of levels: keep the start of every remaining summary instead of only the first one
+        share = max(chunk_tokens // len(pieces), 1)
+        pieces = ["\n\n".join(split_chunks(piece, count, share)[0] for piece in pieces)]
+    # One chunk left: either the document was short, or the merged summaries now fit
+    yield "progress", {"stage": "final", "level": level, "done": 0, "total": 1}
+    source = pieces[0] if pieces else ""
+    _, summary, output = next(run_batch(scheduler, [render(source)], params, trim, 1))
+    add_usage(output["usage"])
+
+    yield "done", {
+        "text": summary,
+        "latency": round(time.time() - start, 2),
+        "chunks": n_chunks,
+        "levels": level + 1,
+        "truncated": truncated,
+        "tokens": tokens,
+    }
@@ -0,0 +1,97 @@
+"""
+Chunk manifests for the model files the servers hand to browsers.
+
+A manifest lists a file's size, validator (the same ETag the file route
+sends) and SHA-256, plus fixed-size chunks with their own SHA-256. A client
+can then download the chunks in parallel with Range requests, keep the ones
+it already verified, and resume an interrupted download where it stopped.
+
+Hashing a few hundred MB takes a couple of seconds, so each manifest is
+computed once and reused while the file's size and mtime stay the same
+(optionally also across restarts through ``cache_dir``).
+"""
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+from .http_ranges import file_etag
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class ManifestCache:
+    def __init__(self, chunk_size: int = DEFAULT_CHUNK_SIZE, cache_dir: Optional[str] = None):
+        self.chunk_size = chunk_size
+        self.cache_dir = cache_dir
+        self._manifests: Dict[str, Dict] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.computed = 0
+
+    def get(self, path: str, url: str) -> Dict:
+        """Manifest for ``path`` (served at ``url``), computing it if the file changed."""
+        path = os.path.abspath(path)
+        with self._lock:
+            lock = self._locks.setdefault(path, threading.Lock())
+        # One hash per file at a time; other requests for it wait for the result
+        with lock:
+            st = os.stat(path)
+            etag = file_etag(st)
+            manifest = self._manifests.get(path)
+            if manifest is None or manifest["etag"] != etag:
+                manifest = self._load(path, etag) or self._compute(path, st, etag)
+                self._manifests[path] = manifest
+        return dict(manifest, url=url)
+
+    def _disk_path(self, path: str) -> Optional[str]:
+        if not self.cache_dir:
+            return None
+        key = hashlib.sha256(path.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"manifest-{key}.json")
+
+    def _load(self, path: str, etag: str) -> Optional[Dict]:
+        disk_path = self._disk_path(path)
+        if not disk_path or not os.path.isfile(disk_path):
+            return None
+        try:
+            with open(disk_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("etag") != etag or manifest.get("chunkSize") != self.chunk_size:
+            return None
+        return manifest
+
+    def _compute(self, path: str, st: os.stat_result, etag: str) -> Dict:
+        whole = hashlib.sha256()
+        chunks = []
+        with open(path, "rb") as f:
+            offset = 0
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                whole.update(data)
+                chunks.append({"offset": offset, "length": len(data), "sha256": hashlib.sha256(data).hexdigest()})
+                offset += len(data)
+        manifest = {
+            "name": os.path.basename(path),
+            "size": st.st_size,
+            "etag": etag,
+            "sha256": whole.hexdigest(),
+            "chunkSize": self.chunk_size,
+            "chunks": chunks,
+        }
+        self.computed += 1
+        print(f"[manifest] {manifest['name']}: {len(chunks)} chunks hashed")
+
+        disk_path = self._disk_path(path)
+        if disk_path:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = disk_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+            os.replace(tmp, disk_path)
+        return manifest
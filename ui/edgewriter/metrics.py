@@ -0,0 +1,304 @@
+"""
+Prometheus-style metrics for the inference servers.
+
+A small registry (counters, gauges, histograms with labels) rendered in the
+Prometheus text exposition format, so ``/metrics`` can be scraped without an
+extra dependency. ServerMetrics defines the series both servers export:
+per-task queue wait, time to first token, prefill/decode throughput, latency
+and token counts, plus model state, in-flight HTTP requests and process RSS.
+
+Completions report where their time went in a ``timings`` block (seconds
+queued, prefilling and decoding, and the tokens processed in each phase),
+filled in by the scheduler, the worker pool and the backends (backends.py).
+"""
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import psutil
+
+# Seconds: from a cache hit up to a long generation on a slow CPU
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+THROUGHPUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), fn: Optional[Callable[[], float]] = None):
+        """With ``fn`` the (unlabelled) value is read at scrape time; None skips the series."""
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.fn = fn
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if self.fn is not None:
+            value = self.fn()
+            if value is None:
+                return []
+            with self._lock:
+                self._values[()] = value
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key: Tuple[str, ...], value) -> Iterable[str]:
+        yield f"{self.name}{_labels(self.label_names, key)} {_number(value)}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self, key: Tuple[str, ...], state) -> Iterable[str]:
+        counts, total, count = state
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            le = 'le="%s"' % _number(bound)
+            yield f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}"
+        le = 'le="+Inf"'
+        yield f"{self.name}_bucket{_labels(self.label_names, key, le)} {count}"
+        yield f"{self.name}_sum{_labels(self.label_names, key)} {_number(round(total, 6))}"
+        yield f"{self.name}_count{_labels(self.label_names, key)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def add(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {e}")
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics:
+    """
+    The series exported on ``/metrics``. ``model_loaded()`` reports whether
+    the model is in memory; ``engine_stats()`` (optional) returns the
+    scheduler/pool ``stats()`` dict, or None before the engine starts.
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(
+        self,
+        model: str,
+        model_loaded: Callable[[], bool],
+        engine_stats: Optional[Callable[[], Optional[Dict]]] = None,
+        prefix: str = "edgewriter",
+    ):
+        self.registry = Registry()
+        self._process = psutil.Process()
+        add = self.registry.add
+        p = prefix
+
+        self.queue_wait = add(Histogram(f"{p}_queue_wait_seconds", "Time a completion waited for a batch slot", ["task"]))
+        self.ttft = add(Histogram(f"{p}_time_to_first_token_seconds", "Time from request to the first generated token", ["task"]))
+        self.prefill_rate = add(Histogram(
+            f"{p}_prefill_tokens_per_second", "Prompt tokens evaluated per second", ["task"], THROUGHPUT_BUCKETS
+        ))
+        self.decode_rate = add(Histogram(
+            f"{p}_decode_tokens_per_second", "Completion tokens generated per second", ["task"], THROUGHPUT_BUCKETS
+        ))
+        self.latency = add(Histogram(f"{p}_request_latency_seconds", "End-to-end request latency", ["task", "tone"]))
+        self.prompt_tokens = add(Histogram(f"{p}_prompt_tokens", "Prompt tokens per completion", ["task"], TOKEN_BUCKETS))
+        self.completion_tokens = add(Histogram(
+            f"{p}_completion_tokens", "Completion tokens per completion", ["task"], TOKEN_BUCKETS
+        ))
+        self.cache_hits = add(Counter(f"{p}_response_cache_hits_total", "Requests answered from the response cache", ["task"]))
+        self.stopped = add(Counter(
+            f"{p}_generations_stopped_total", "Completions stopped early by a client disconnect or deadline", ["task", "reason"]
+        ))
+        self.http_requests = add(Counter(f"{p}_http_requests_total", "HTTP requests handled", ["method", "route", "status"]))
+        self.http_duration = add(Histogram(
+            f"{p}_http_request_duration_seconds", "HTTP request duration, including streamed bodies", ["method", "route"]
+        ))
+        self.inflight = add(Gauge(f"{p}_http_requests_in_flight", "HTTP requests currently being served"))
+        self.inflight.set(0)
+        add(Gauge(f"{p}_model_info", "Model served by this process", ["model"])).set(1, model=model)
+        add(Gauge(f"{p}_model_loaded", "1 when the model is loaded", fn=lambda: 1 if model_loaded() else 0))
+        add(Gauge(f"{p}_process_resident_memory_bytes", "Resident set size of the server process", fn=self._rss))
+        add(Counter(f"{p}_process_cpu_seconds_total", "CPU time used by the server process", fn=self._cpu))
+        if engine_stats is not None:
+            def stat(name):
+                return lambda: (engine_stats() or {}).get(name)
+
+            add(Gauge(f"{p}_engine_queue_depth", "Completions waiting for a batch slot", fn=stat("queueDepth")))
+            add(Gauge(f"{p}_engine_running", "Completions being decoded", fn=stat("running")))
+            add(Counter(f"{p}_engine_completed_total", "Completions finished", fn=stat("completed")))
+            add(Counter(f"{p}_engine_rejected_total", "Requests rejected with 429", fn=stat("rejected")))
+
+    def _rss(self) -> float:
+        return self._process.memory_info().rss
+
+    def _cpu(self) -> float:
+        times = self._process.cpu_times()
+        return round(times.user + times.system, 3)
+
+    def render(self) -> str:
+        return self.registry.render()
+
+    def observe_completion(
+        self,
+        task: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        timings: Optional[Dict] = None,
+        ttft: Optional[float] = None,
+        finish_reason: Optional[str] = None,
+    ):
+        """Record one model completion; ``ttft`` defaults to queue + prefill time."""
+        if finish_reason in ("cancelled", "deadline"):
+            self.stopped.inc(task=task, reason=finish_reason)
+        self.prompt_tokens.observe(prompt_tokens, task=task)
+        self.completion_tokens.observe(completion_tokens, task=task)
+        if timings:
+            self.queue_wait.observe(timings["queue"], task=task)
+            if ttft is None:
+                ttft = timings["queue"] + timings["prefill"]
+            if timings["prefill"] > 0 and timings["prefill_tokens"]:
+                self.prefill_rate.observe(timings["prefill_tokens"] / timings["prefill"], task=task)
+            if timings["decode"] > 0 and timings["decode_tokens"]:
+                self.decode_rate.observe(timings["decode_tokens"] / timings["decode"], task=task)
+        if ttft is not None:
+            self.ttft.observe(ttft, task=task)
+
+    def observe_stream(self, task: str, tone: str, done: Dict, latency: Optional[float] = None):
+        """
+        Record a streamed completion from its SSE ``done`` payload; ``latency``
+        (unrounded seconds) replaces the payload's, which is rounded for display.
+        """
+        tokens = done["tokens"]
+        self.observe_completion(
+            task, tokens["prompt"], tokens["completion"], done.get("timings"), done.get("ttft"), done.get("finish_reason")
+        )
+        self.observe_request(task, tone, done["latency"] if latency is None else latency)
+
+    def observe_request(self, task: str, tone: str, latency: float, cached: bool = False):
+        self.latency.observe(latency, task=task, tone=tone)
+        if cached:
+            self.cache_hits.inc(task=task)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting HTTP requests for ServerMetrics. Streamed
+    responses stay in flight until their last chunk is sent; routes are
+    labelled by their path template so session ids do not add series.
+    """
+
+    def __init__(self, app, metrics: ServerMetrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        metrics = self.metrics
+        start = time.perf_counter()
+        state = {"status": 500, "finished": False}
+
+        def finish():
+            if state["finished"]:
+                return
+            state["finished"] = True
+            metrics.inflight.dec()
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            method = scope.get("method", "")
+            metrics.http_requests.inc(method=method, route=route, status=str(state["status"]))
+            metrics.http_duration.observe(time.perf_counter() - start, method=method, route=route)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            await send(message)
+            if message["type"] == "http.response.pathsend" or (
+                message["type"] in ("http.response.body", "http.response.zerocopysend")
+                and not message.get("more_body", False)
+            ):
+                finish()
+
+        metrics.inflight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            finish()
@@ -0,0 +1,345 @@
+"""
+Several models behind one server.
+
+The registry is described in a JSON file (or inline JSON)::
+
+    {
+      "models": {
+        "q8": {"path": "phi3-writing-Q8.gguf"},
+        "q4": {"path": "phi3-writing-Q4_K_M.gguf", "backend": "llama.cpp"}
+      },
+      "routes": [
+        {"task": ["Proofread", "Paraphrase"], "model": "q4"},
+        {"task": "Rewrite", "tone": "Casual", "model": "q4"}
+      ],
+      "default": "q8"
+    }
+
+Relative paths are resolved against the file's directory; a model with
+``"backend": "daemon"`` has the inference daemon's address as its path and
+holds no weights in this process (see daemon.py). Routes are checked
+in order and the first whose ``task``/``tone`` lists match wins (a missing
+key matches anything); a request may also name a model explicitly.
+
+Models are loaded on first use through the caller's ``loader`` and kept in
+LRU order. Before a load, idle models are unloaded (least recently used
+first) until the new one fits the memory budget and the memory the OS
+reports as available. A model's memory is its weight files, or what the
+process grew by while loading it when that is more.
+
+A model is busy (never unloaded) while it has queued, running or paused
+jobs, or while a request holds a ``lease`` on it: routes lease the engine
+before tokenizing their prompt and release it once the job is submitted, so
+another model's load cannot close it in between.
+"""
+import json
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import psutil
+
+from .preload import model_files
+
+
+class UnknownModelError(ValueError):
+    """A request or route named a model that is not in the registry."""
+
+
+class ModelBudgetError(RuntimeError):
+    """The model does not fit the memory budget and every loaded model is busy."""
+
+
+class ModelSpec:
+    def __init__(self, name: str, path: str, backend: str = "llama.cpp", options: Optional[Dict[str, Any]] = None):
+        """``options`` are passed to the loader (e.g. ``n_ctx``, ``max_batch``)."""
+        self.name = name
+        self.path = path
+        self.backend = backend
+        self.options = dict(options or {})
+        self.hash: Optional[str] = None
+
+    @property
+    def weight_bytes(self) -> int:
+        if self.backend == "daemon":
+            return 0  # the weights live in the daemon process
+        try:
+            return sum(os.path.getsize(f) for f in model_files(self.path))
+        except OSError:
+            return 0
+
+    def to_dict(self) -> Dict:
+        return {"path": self.path, "backend": self.backend, "weightsBytes": self.weight_bytes}
+
+
+class _Loaded:
+    def __init__(self, engine, memory: int, load_seconds: float):
+        self.engine = engine
+        self.memory = memory
+        self.load_seconds = load_seconds
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.uses = 0
+        self.leases = 0
+
+
+class Lease:
+    """
+    A loaded engine that stays loaded until ``release()`` (later calls do
+    nothing). As a context manager it yields the engine and releases on exit.
+    """
+
+    def __init__(self, registry: "ModelRegistry", name: str, entry: _Loaded):
+        self.name = name
+        self.engine = entry.engine
+        self._registry = registry
+        self._entry = entry
+        self._released = False
+
+    def release(self):
+        with self._registry._lock:
+            if not self._released:
+                self._released = True
+                self._entry.leases -= 1
+
+    def bind(self, owner):
+        """Release once ``owner`` (e.g. a response's event generator) is garbage collected."""
+        weakref.finalize(owner, self.release)
+        return owner
+
+    def __enter__(self):
+        return self.engine
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _matches(value: Optional[str], wanted) -> bool:
+    if wanted is None:
+        return True
+    if isinstance(wanted, str):
+        wanted = [wanted]
+    return value is not None and value.lower() in {w.lower() for w in wanted}
+
+
+def _busy(entry: _Loaded) -> bool:
+    if entry.leases:
+        return True
+    stats = entry.engine.stats()
+    return bool(stats.get("queueDepth") or stats.get("running") or stats.get("paused"))
+
+
+def load_registry_config(source: str) -> Dict:
+    """Parse ``source`` (a JSON file path or a JSON string) into specs, routes and the default name."""
+    base_dir = os.getcwd()
+    if source.lstrip().startswith("{"):
+        config = json.loads(source)
+    else:
+        with open(source, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(source))
+
+    specs = {}
+    for name, entry in (config.get("models") or {}).items():
+        if isinstance(entry, str):
+            entry = {"path": entry}
+        entry = dict(entry)
+        path = entry.pop("path")
+        backend = entry.pop("backend", "llama.cpp")
+        if backend != "daemon":
+            path = os.path.join(base_dir, os.path.expanduser(path))
+        specs[name] = ModelSpec(name, path, backend, entry)
+    if not specs:
+        raise ValueError("Model registry config has no models")
+    default = config.get("default") or next(iter(specs))
+    routes = list(config.get("routes") or [])
+    for route in [{"model": default}, *routes]:
+        if route.get("model") not in specs:
+            raise UnknownModelError(f"Model registry route points at unknown model: {route.get('model')}")
+    return {"specs": specs, "routes": routes, "default": default}
+
+
+class ModelRegistry:
+    def __init__(
+        self,
+        specs: Dict[str, ModelSpec],
+        loader: Callable[[ModelSpec], Any],
+        routes: Optional[List[Dict]] = None,
+        default: Optional[str] = None,
+        memory_budget: Optional[int] = None,
+        unload: Optional[Callable[[ModelSpec, Any], None]] = None,
+    ):
+        """
+        ``loader(spec)`` returns the engine (Scheduler, WorkerPool, ...) for a
+        model and ``unload(spec, engine)`` releases it (default: ``engine.close()``).
+        ``memory_budget`` is in bytes; None means no budget beyond available RAM.
+        """
+        self.specs: "OrderedDict[str, ModelSpec]" = OrderedDict(specs)
+        self.routes = list(routes or [])
+        self.default = default or next(iter(self.specs))
+        self.memory_budget = memory_budget
+        self._loader = loader
+        self._unload = unload
+        self._loaded: "OrderedDict[str, _Loaded]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+
+    def add(self, spec: ModelSpec, default: bool = False):
+        self.specs[spec.name] = spec
+        if default:
+            self.default = spec.name
+
+    def install(self, name: str, engine, spec: Optional[ModelSpec] = None, default: bool = True):
+        """Register an already constructed engine (e.g. a fake one for benchmarks)."""
+        self.add(spec or ModelSpec(name, "", backend="custom"), default=default)
+        with self._lock:
+            self._loaded[name] = _Loaded(engine, 0, 0.0)
+
+    def resolve(self, task: Optional[str] = None, tone: Optional[str] = None, model: Optional[str] = None) -> str:
+        """Name of the model that serves a request: the explicit one, the first matching route, or the default."""
+        if model:
+            if model not in self.specs:
+                raise UnknownModelError(f"Unknown model: {model} (available: {', '.join(self.specs)})")
+            return model
+        for route in self.routes:
+            if _matches(task, route.get("task")) and _matches(tone, route.get("tone")):
+                return route["model"]
+        return self.default
+
+    def loaded(self, name: str):
+        """The engine for ``name`` if it is loaded (does not load it)."""
+        entry = self._loaded.get(name)
+        return entry.engine if entry is not None else None
+
+    def engines(self) -> Dict[str, Any]:
+        with self._lock:
+            return {name: entry.engine for name, entry in self._loaded.items()}
+
+    def get(self, name: str):
+        """
+        The engine for ``name``, loading it (and unloading idle ones to make
+        room) if needed. Nothing keeps it loaded afterwards; use ``lease`` to
+        submit to it.
+        """
+        return self._acquire(name, lease=False).engine
+
+    def lease(self, name: str) -> Lease:
+        """Like ``get``, but the model is not unloaded until the lease is released."""
+        return Lease(self, name, self._acquire(name, lease=True))
+
+    def _acquire(self, name: str, lease: bool) -> _Loaded:
+        entry = self._touch(name, lease)
+        if entry is not None:
+            return entry
+        if name not in self.specs:
+            raise UnknownModelError(f"Unknown model: {name}")
+        with self._load_lock:
+            entry = self._touch(name, lease)
+            if entry is not None:
+                return entry
+            spec = self.specs[name]
+            self._make_room(spec)
+            process = psutil.Process()
+            rss_before = process.memory_info().rss
+            start = time.time()
+            engine = self._loader(spec)
+            grown = max(0, process.memory_info().rss - rss_before)
+            entry = _Loaded(engine, max(spec.weight_bytes, grown), time.time() - start)
+            entry.uses = 1
+            entry.leases = int(lease)
+            with self._lock:
+                self._loaded[name] = entry
+            self.loads += 1
+            print(f"[models] Loaded {name} in {entry.load_seconds:.1f}s ({entry.memory / 2**30:.2f} GiB)")
+            return entry
+
+    def unload(self, name: str) -> bool:
+        with self._lock:
+            entry = self._loaded.pop(name, None)
+        if entry is None:
+            return False
+        self._close(name, entry)
+        return True
+
+    def _close(self, name: str, entry: _Loaded):
+        spec = self.specs.get(name)
+        try:
+            if self._unload is not None:
+                self._unload(spec, entry.engine)
+            elif hasattr(entry.engine, "close"):
+                entry.engine.close()
+        except Exception as e:
+            print(f"[models] Unloading {name} failed: {e}")
+        print(f"[models] Unloaded {name}")
+
+    def stats(self) -> Dict:
+        vm = psutil.virtual_memory()
+        with self._lock:
+            loaded = dict(self._loaded)
+        models = {}
+        for name, spec in self.specs.items():
+            info = {**spec.to_dict(), "loaded": name in loaded}
+            entry = loaded.get(name)
+            if entry is not None:
+                info.update(
+                    memoryBytes=entry.memory,
+                    loadSeconds=round(entry.load_seconds, 2),
+                    lastUsed=entry.last_used,
+                    uses=entry.uses,
+                    leases=entry.leases,
+                )
+            models[name] = info
+        return {
+            "default": self.default,
+            "routes": self.routes,
+            "models": models,
+            "memory": {
+                "budgetBytes": self.memory_budget,
+                "usedBytes": sum(entry.memory for entry in loaded.values()),
+                "availableBytes": vm.available,
+                "totalBytes": vm.total,
+            },
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
+
+    def _touch(self, name: str, lease: bool = False) -> Optional[_Loaded]:
+        with self._lock:
+            entry = self._loaded.get(name)
+            if entry is not None:
+                self._loaded.move_to_end(name)
+                entry.last_used = time.time()
+                entry.uses += 1
+                entry.leases += int(lease)
+            return entry
+
+    def _fits(self, need: int) -> bool:
+        with self._lock:
+            used = sum(entry.memory for entry in self._loaded.values())
+        if self.memory_budget is not None and used + need > self.memory_budget:
+            return False
+        return need <= psutil.virtual_memory().available
+
+    def _make_room(self, spec: ModelSpec):
+        need = spec.weight_bytes
+        while not self._fits(need):
+            with self._lock:
+                # Picked and removed under one lock so no lease lands on it in between
+                victim = next((name for name, entry in self._loaded.items() if not _busy(entry)), None)
+                entry = self._loaded.pop(victim) if victim is not None else None
+                busy = len(self._loaded)
+            if victim is None:
+                if busy:
+                    raise ModelBudgetError(
+                        f"Not enough memory to load {spec.name} ({need / 2**30:.2f} GiB) while {busy} loaded model(s) are busy"
+                    )
+                # Nothing left to unload: try anyway rather than never serving it
+                print(f"[models] {spec.name} ({need / 2**30:.2f} GiB) exceeds the memory budget; loading anyway")
+                return
+            self._close(victim, entry)
+            self.evictions += 1
@@ -0,0 +1,169 @@
+"""
+KV-cache snapshots for the fixed prompt prefixes (task templates, chat system prompt).
+
+Each prefix is prefilled once into its own llama.cpp sequence and kept there.
+When a request's prompt starts with one of them, the scheduler copies those
+KV cells into the request's sequence (``seq_cp`` only tags the cells, nothing
+is recomputed) and prefills just the remaining tokens.
+
+Snapshots can also be written to disk under ``<cache_dir>/<model hash>/`` so a
+restarted server skips the warm-up prefill.
+"""
+import ctypes
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import llama_cpp
+
+from .preload import model_files
+
+
+def model_file_hash(path: str, cache_dir: Optional[str] = None) -> str:
+    """
+    SHA-256 of the model file. Hashing a multi-GB GGUF takes a few seconds, so
+    the digest is remembered in ``cache_dir/model_hashes.json`` keyed by
+    path, size and mtime. A directory (e.g. an ONNX export) is hashed as its
+    sorted relative file names and contents.
+    """
+    files = model_files(path)
+    stats = [os.stat(f) for f in files]
+    size = sum(st.st_size for st in stats)
+    mtime = max((st.st_mtime_ns for st in stats), default=0)
+    key = f"{os.path.abspath(path)}|{size}|{mtime}"
+    index_path = os.path.join(cache_dir, "model_hashes.json") if cache_dir else None
+
+    index = {}
+    if index_path and os.path.isfile(index_path):
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+    if key in index:
+        return index[key]
+
+    digest = hashlib.sha256()
+    for file in files:
+        if file != path:
+            digest.update(os.path.relpath(file, path).replace(os.sep, "/").encode("utf-8") + b"\0")
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(8 * 1024 * 1024), b""):
+                digest.update(chunk)
+    value = digest.hexdigest()
+
+    if index_path:
+        index[key] = value
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp, index_path)
+    return value
+
+
+class PrefixEntry:
+    def __init__(self, name: str, tokens: List[int], seq_id: int):
+        self.name = name
+        self.tokens = tokens
+        self.seq_id = seq_id
+        self.ready = False
+        self.source = None  # "prefill" or "disk"
+
+
+class PrefixCache:
+    """Bookkeeping for prefix sequences; the scheduler owns the actual context."""
+
+    def __init__(
+        self,
+        prefixes: Dict[str, List[int]],
+        first_seq_id: int,
+        cache_dir: Optional[str] = None,
+        model_hash: Optional[str] = None,
+    ):
+        self.entries = [
+            PrefixEntry(name, tokens, first_seq_id + i) for i, (name, tokens) in enumerate(prefixes.items())
+        ]
+        self.snapshot_dir = os.path.join(cache_dir, model_hash[:16]) if cache_dir and model_hash else None
+        self.hits = 0
+        self.misses = 0
+        self.tokens_reused = 0
+
+    @property
+    def n_tokens(self) -> int:
+        return sum(len(e.tokens) for e in self.entries)
+
+    def match(self, tokens: List[int]) -> Tuple[Optional[PrefixEntry], int]:
+        """Return the entry sharing the longest token prefix with ``tokens``."""
+        best, best_n = None, 0
+        for entry in self.entries:
+            if not entry.ready:
+                continue
+            n = 0
+            for a, b in zip(entry.tokens, tokens):
+                if a != b:
+                    break
+                n += 1
+            if n > best_n:
+                best, best_n = entry, n
+        # Always leave one prompt token to decode so the request gets logits
+        best_n = min(best_n, len(tokens) - 1)
+        if best is None or best_n <= 1:
+            self.misses += 1
+            return None, 0
+        self.hits += 1
+        self.tokens_reused += best_n
+        return best, best_n
+
+    def _snapshot_path(self, entry: PrefixEntry) -> Optional[str]:
+        if not self.snapshot_dir:
+            return None
+        key = hashlib.sha256(json.dumps(entry.tokens).encode("utf-8")).hexdigest()[:24]
+        return os.path.join(self.snapshot_dir, f"{key}.kv")
+
+    def load(self, ctx, entry: PrefixEntry) -> bool:
+        """Restore a saved snapshot into ``entry.seq_id``; False if none/incompatible."""
+        path = self._snapshot_path(entry)
+        if not path or not os.path.isfile(path):
+            return False
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return False
+        buf = (ctypes.c_uint8 * len(data)).from_buffer_copy(data)
+        if llama_cpp.llama_state_seq_set_data(ctx.ctx, buf, len(data), entry.seq_id) == 0:
+            print(f"[prefix-cache] Ignoring incompatible snapshot for {entry.name}")
+            ctx.kv_cache_seq_rm(entry.seq_id, -1, -1)
+            return False
+        entry.ready = True
+        entry.source = "disk"
+        return True
+
+    def save(self, ctx, entry: PrefixEntry):
+        path = self._snapshot_path(entry)
+        if not path:
+            return
+        size = llama_cpp.llama_state_seq_get_size(ctx.ctx, entry.seq_id)
+        buf = (ctypes.c_uint8 * size)()
+        written = llama_cpp.llama_state_seq_get_data(ctx.ctx, buf, size, entry.seq_id)
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(bytes(buf[:written]))
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[prefix-cache] Could not save snapshot for {entry.name}: {e}")
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self.entries),
+            "ready": sum(1 for e in self.entries if e.ready),
+            "tokens": self.n_tokens,
+            "hits": self.hits,
+            "misses": self.misses,
+            "tokensReused": self.tokens_reused,
+            "persistent": self.snapshot_dir is not None,
+        }
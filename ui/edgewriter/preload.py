@@ -0,0 +1,136 @@
+"""
+Eager model loading at server start.
+
+Without it the first /generate or /chat pays for the whole cold start: pages
+of a multi-GB GGUF faulted in from disk, the llama.cpp load, and the first
+prefill's graph allocation. Preloader runs those phases on a background
+thread as soon as the server starts:
+
+``readahead``
+    reads the model file(s) sequentially so the later mmap load hits the page
+    cache instead of doing random reads;
+``load``
+    the caller's loader (e.g. the server's ``get_scheduler``);
+``warmup``
+    the caller's warm-up, typically a one-token generation.
+
+``status()`` reports the current phase, read-ahead progress and how long each
+phase took, and ``wait()`` lets request threads block until the load has
+finished (on an Event, so no request sits on the loader's lock).
+"""
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+_READ_CHUNK = 16 * 1024 * 1024
+
+
+def model_files(path: str) -> List[str]:
+    """The file itself, or every file under a model directory (sorted)."""
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+
+
+class Preloader:
+    def __init__(self, path: str, steps: List[Tuple[str, Callable[[], None]]], readahead: bool = True):
+        """``steps`` are ``(phase, fn)`` pairs run in order after the read-ahead."""
+        self.path = path
+        self.steps = ([("readahead", self._readahead)] if readahead else []) + list(steps)
+        self.state = "pending"
+        self.phase: Optional[str] = None
+        self.error: Optional[str] = None
+        self.bytes_total = 0
+        self.bytes_read = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._phases: Dict[str, Dict[str, float]] = {}
+        self._done = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "Preloader":
+        if self._thread is None:
+            self.state = "loading"
+            self.started_at = time.time()
+            self._thread = threading.Thread(target=self._run, name="edgewriter-preload", daemon=True)
+            self._thread.start()
+        return self
+
+    @property
+    def active(self) -> bool:
+        """True while the load is running on another thread (requests should wait for it)."""
+        return (
+            self._thread is not None
+            and not self._done.is_set()
+            and threading.current_thread() is not self._thread
+        )
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until the preload has finished (either way); False on timeout."""
+        return self._done.wait(timeout)
+
+    def status(self) -> Dict:
+        now = time.time()
+        phases = {}
+        for name, span in self._phases.items():
+            phases[name] = round(span.get("end", now) - span["start"], 3)
+        out = {
+            "state": self.state,
+            "phase": self.phase,
+            "progress": self._progress(),
+            "elapsed": round((self.finished_at or now) - self.started_at, 3) if self.started_at else None,
+            "phases": phases,
+            "error": self.error,
+        }
+        if self.bytes_total:
+            out["readahead"] = {"bytesRead": self.bytes_read, "bytesTotal": self.bytes_total}
+        return out
+
+    def _progress(self) -> float:
+        """Overall progress: finished phases plus the read-ahead's byte fraction."""
+        if self.state == "ready":
+            return 1.0
+        if not self.steps:
+            return 0.0
+        finished = sum(1 for span in self._phases.values() if "end" in span)
+        partial = 0.0
+        if self.phase == "readahead" and self.bytes_total:
+            partial = self.bytes_read / self.bytes_total
+        return round(min(1.0, (finished + partial) / len(self.steps)), 3)
+
+    def _run(self):
+        try:
+            for name, fn in self.steps:
+                self.phase = name
+                self._phases[name] = {"start": time.time()}
+                fn()
+                self._phases[name]["end"] = time.time()
+                print(f"[preload] {name} done in {self._phases[name]['end'] - self._phases[name]['start']:.2f}s")
+            self.state = "ready"
+            self.phase = None
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            print(f"[preload] {self.phase} failed: {e}")
+        finally:
+            self.finished_at = time.time()
+            self._done.set()
+
+    def _readahead(self):
+        files = model_files(self.path)
+        self.bytes_total = sum(os.path.getsize(f) for f in files)
+        for file in files:
+            with open(file, "rb", buffering=0) as f:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                buf = bytearray(_READ_CHUNK)
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    self.bytes_read += n
@@ -0,0 +1,787 @@
+"""
+Continuous-batching request scheduler for a shared llama.cpp model.
+
+A single worker thread owns a multi-sequence llama.cpp context built on the
+already-loaded model weights. Requests wait in a bounded FIFO queue; on every
+step the worker decodes one token for each running sequence, plus a chunk of
+prompt for sequences that are still prefilling, in one ``llama_decode`` call.
+When the queue is full ``submit()`` raises QueueFullError so the HTTP layer
+can answer 429 with a Retry-After estimate.
+
+Optional fixed prompt prefixes are kept prefilled in extra sequences (see
+prefix_cache.py) and shared into new requests instead of being recomputed.
+Chat sessions can likewise keep their sequence after a turn finishes, so the
+next turn only prefills the tokens that differ from what is already cached.
+Jobs submitted with ``speculative=k`` draft up to k tokens per step by prompt
+lookup (see speculative.py) and verify them in the same batch.
+
+A job stops early at the next step when it is cancelled (finish reason
+"cancelled", e.g. its HTTP client disconnected; see cancellation.py) or when
+its ``deadline`` passes ("deadline", with the text generated so far).
+
+Every job has a priority class (PRIORITIES: interactive, normal,
+background). The queue is ordered by class, FIFO within a class, and when a
+higher-class job cannot be admitted because the batch or the KV budget is
+full, lower-class running jobs are paused between decode steps. A paused job
+keeps its sequence and KV cells (up to ``pause_slots`` of them) and resumes
+where it stopped once nothing of a higher class is waiting.
+
+The scheduler is call-compatible with ``Llama.__call__`` (``stream=True``
+yields completion chunks, otherwise a completion dict is returned), so the
+routes and ``stream_completion`` work with either object.
+"""
+import codecs
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Iterator, List, Optional
+
+import llama_cpp
+from llama_cpp import _internals as internals
+
+from .cancellation import track
+from .prefix_cache import PrefixCache
+from .speculative import PromptLookup
+from .streaming import StopTrimmer
+from .templates import Prompt
+
+# Llama.__call__ defaults, used when a request does not override them
+DEFAULT_PARAMS = {
+    "max_tokens": 16,
+    "temperature": 0.8,
+    "top_p": 0.95,
+    "top_k": 40,
+    "min_p": 0.05,
+    "repeat_penalty": 1.0,
+    "stop": [],
+    "seed": None,
+}
+PENALTY_LAST_N = 64
+
+# Priority classes, highest first; a job's ``priority`` is its index here
+PRIORITIES = ("interactive", "normal", "background")
+
+
+def priority_rank(priority: str) -> int:
+    try:
+        return PRIORITIES.index(priority)
+    except ValueError:
+        raise ValueError(f"Unknown priority {priority!r}; expected one of {', '.join(PRIORITIES)}") from None
+
+
+def enqueue(waiting: deque, job):
+    """Insert ``job`` behind every queued job of its class or higher, ahead of lower ones."""
+    i = len(waiting)
+    while i and waiting[i - 1].priority > job.priority:
+        i -= 1
+    waiting.insert(i, job)
+
+
+class QueueFullError(RuntimeError):
+    """Raised by Scheduler.submit() when the wait queue is at its bound."""
+
+    def __init__(self, depth: int, retry_after: int):
+        super().__init__(f"Server busy: {depth} requests queued, retry in {retry_after}s")
+        self.depth = depth
+        self.retry_after = retry_after
+
+
+class Job:
+    """One queued/running completion. Produced by Scheduler.submit()."""
+
+    _ids = itertools.count(1)
+
+    def __init__(
+        self,
+        prompt: Prompt,
+        prompt_tokens: List[int],
+        params: Dict,
+        session: Optional[str] = None,
+        speculative: int = 0,
+        deadline: Optional[float] = None,
+        priority: int = 1,
+    ):
+        self.id = next(Job._ids)
+        self.session = session
+        self.deadline = deadline
+        self.priority = priority
+        self.prompt = prompt
+        self.prompt_tokens = prompt_tokens
+        self.params = params
+        self.max_tokens = params["max_tokens"]
+
+        self.seq_id: Optional[int] = None
+        self.n_past = 0
+        self.cached_tokens = 0
+        self._kv: Optional["SessionKV"] = None
+        self.last_token: Optional[int] = None
+        self.sampler = None
+        self.completion_tokens: List[int] = []
+        self.finish_reason: Optional[str] = None
+        self.error: Optional[Exception] = None
+        self.cancelled = False
+        self.paused = False
+        self.preemptions = 0
+
+        self.speculative = speculative
+        self.lookup = PromptLookup(prompt_tokens) if speculative > 0 else None
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+
+        self.submitted_at = time.time()
+        self.admitted_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+        self._trimmer = StopTrimmer(params["stop"] or [], strip=False)
+        self._utf8 = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self._pieces: List[str] = []
+        self._cond = threading.Condition()
+
+    @property
+    def reserve(self) -> int:
+        """KV cells this job may occupy at most (cells shared with a prefix are free)."""
+        return len(self.prompt_tokens) - self.cached_tokens + self.max_tokens
+
+    @property
+    def held_cells(self) -> int:
+        """KV cells a paused job keeps for when it resumes."""
+        return self.n_past - self.cached_tokens
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def cancel(self):
+        """Ask the worker to drop this job at its next step."""
+        self.cancelled = True
+
+    def stop_reason(self, now: float) -> Optional[str]:
+        """Why the job should stop before finishing on its own, if it should."""
+        if self.cancelled:
+            return "cancelled"
+        if self.deadline is not None and now >= self.deadline:
+            return "deadline"
+        return None
+
+    def _push(self, text: str):
+        if text:
+            with self._cond:
+                self._pieces.append(text)
+                self._cond.notify_all()
+
+    def _close(self, reason: Optional[str], error: Optional[Exception] = None):
+        with self._cond:
+            self.finish_reason = reason
+            self.error = error
+            self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def usage(self) -> Dict[str, int]:
+        prompt_tokens = len(self.prompt_tokens)
+        completion_tokens = len(self.completion_tokens)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "cached_tokens": self.cached_tokens,
+        }
+        if self.lookup is not None:
+            usage["draft_tokens"] = self.draft_tokens
+            usage["accepted_tokens"] = self.accepted_tokens
+        return usage
+
+    def timings(self) -> Dict[str, float]:
+        """Seconds spent queued, prefilling (up to the first token) and decoding."""
+        admitted = self.admitted_at or self.submitted_at
+        first = self.first_token_at or self.finished_at or admitted
+        finished = self.finished_at or first
+        return {
+            "queue": round(admitted - self.submitted_at, 4),
+            "prefill": round(first - admitted, 4),
+            "decode": round(finished - first, 4),
+            "prefill_tokens": len(self.prompt_tokens) - self.cached_tokens,
+            "decode_tokens": max(0, len(self.completion_tokens) - 1),
+        }
+
+    def stream(self) -> Iterator[Dict]:
+        """Yield llama-cpp style completion chunks as text becomes available."""
+        sent = 0
+        try:
+            while True:
+                with self._cond:
+                    while sent == len(self._pieces) and not self.done:
+                        self._cond.wait()
+                    pieces = self._pieces[sent:]
+                    sent = len(self._pieces)
+                    finished = self.done
+                for text in pieces:
+                    yield {"choices": [{"text": text, "index": 0, "finish_reason": None}]}
+                if finished:
+                    break
+            if self.error is not None:
+                raise self.error
+            yield {
+                "choices": [{"text": "", "index": 0, "finish_reason": self.finish_reason}],
+                "usage": self.usage(),
+                "timings": self.timings(),
+            }
+        finally:
+            if not self.done:
+                self.cancel()
+
+    def result(self) -> Dict:
+        """Block until the job finishes and return a llama-cpp style completion."""
+        with self._cond:
+            while not self.done:
+                self._cond.wait()
+        if self.error is not None:
+            raise self.error
+        return {
+            "id": f"cmpl-{self.id}",
+            "object": "text_completion",
+            "created": int(self.submitted_at),
+            "choices": [
+                {"text": "".join(self._pieces), "index": 0, "logprobs": None, "finish_reason": self.finish_reason}
+            ],
+            "usage": self.usage(),
+            "timings": self.timings(),
+        }
+
+
+class SessionKV:
+    """KV sequence retained for a chat session between turns."""
+
+    def __init__(self, seq_id: int):
+        self.seq_id = seq_id
+        self.tokens: List[int] = []
+        self.busy = False
+        self.dropped = False
+
+
+def _common_prefix(a: List[int], b: List[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class Scheduler:
+    """Owns the model's decode loop; see module docstring."""
+
+    def __init__(
+        self,
+        llm,
+        max_batch: int = 4,
+        max_queue: int = 16,
+        n_ctx: Optional[int] = None,
+        prefixes: Optional[Dict[str, str]] = None,
+        prefix_cache_dir: Optional[str] = None,
+        model_hash: Optional[str] = None,
+        session_slots: int = 0,
+        pause_slots: Optional[int] = None,
+    ):
+        """
+        ``n_ctx`` is the KV budget for requests and retained sessions; cells
+        pinned by ``prefixes`` (name -> prompt text) are allocated on top of it.
+        ``session_slots`` is how many chat sessions may keep their KV between turns.
+        ``pause_slots`` is how many preempted jobs may be paused at once
+        (default ``max_batch``; 0 turns preemption off).
+        """
+        self.llm = llm
+        self.max_batch = max(1, max_batch)
+        self.max_queue = max(0, max_queue)
+        self.session_slots = max(0, session_slots)
+        self.pause_slots = self.max_batch if pause_slots is None else max(0, pause_slots)
+        # Paused jobs keep their sequence, so job sequences come after them too
+        n_job_seqs = self.max_batch + self.pause_slots
+        self.n_batch = llm.n_batch
+
+        self.prefix_cache = None
+        if prefixes:
+            self.prefix_cache = PrefixCache(
+                {name: self.tokenize(text.encode("utf-8"), special=True) for name, text in prefixes.items()},
+                first_seq_id=n_job_seqs + self.session_slots,
+                cache_dir=prefix_cache_dir,
+                model_hash=model_hash,
+            )
+        n_pinned = self.prefix_cache.n_tokens if self.prefix_cache else 0
+        n_prefix_seqs = len(self.prefix_cache.entries) if self.prefix_cache else 0
+
+        params = llama_cpp.llama_context_params.from_buffer_copy(llm.context_params)
+        params.n_ctx = (n_ctx or llm.context_params.n_ctx) + n_pinned
+        params.n_seq_max = n_job_seqs + self.session_slots + n_prefix_seqs
+        if hasattr(params, "kv_unified"):
+            # Let sequences share one KV pool instead of n_ctx / n_seq_max each
+            params.kv_unified = True
+        self._ctx = internals.LlamaContext(model=llm._model, params=params, verbose=False)
+        self.n_ctx = self._ctx.n_ctx() - n_pinned
+        # Longest single sequence: the model's own window (Phi-3 mini: 4096)
+        self.n_ctx_seq = min(self.n_ctx, llm._model.n_ctx_train())
+        self._batch = internals.LlamaBatch(n_tokens=self.n_batch, embd=0, n_seq_max=1, verbose=False)
+        self._eog = {t for t in (llm._model.token_eos(), llm._model.token_eot()) if t is not None and t >= 0}
+
+        self._waiting: deque = deque()
+        self._running: List[Job] = []
+        self._paused: List[Job] = []
+        self._free_seqs = list(range(n_job_seqs))
+        self._sessions: "OrderedDict[str, SessionKV]" = OrderedDict()
+        self._free_session_seqs = list(range(n_job_seqs, n_job_seqs + self.session_slots))
+        self._dropped_sessions: List[str] = []
+        self.session_tokens_reused = 0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self._lock = threading.Condition()
+
+        self.completed = 0
+        self.rejected = 0
+        self.preempted = 0
+        self._avg_job_seconds = 5.0
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._loop, name="edgewriter-scheduler", daemon=True)
+        self._thread.start()
+
+    # --- public API ---
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        return self.llm.tokenize(text, add_bos=add_bos, special=special)
+
+    def detokenize(self, tokens: List[int]) -> bytes:
+        return self.llm.detokenize(tokens)
+
+    def submit(
+        self,
+        prompt: Prompt,
+        session: Optional[str] = None,
+        speculative: int = 0,
+        deadline: Optional[float] = None,
+        priority: str = "normal",
+        **params,
+    ) -> Job:
+        """
+        Queue a completion of ``prompt`` (text, or token ids from
+        templates.py). Raises QueueFullError when the queue is at its bound.
+        Jobs with the same ``session`` id reuse that session's cached KV;
+        ``speculative`` is the prompt-lookup draft length (0 disables it);
+        ``deadline`` is a ``time.time()`` after which the job stops;
+        ``priority`` is one of PRIORITIES.
+        """
+        rank = priority_rank(priority)
+        merged = {**DEFAULT_PARAMS, **{k: v for k, v in params.items() if k in DEFAULT_PARAMS}}
+        tokens = self.tokenize(prompt.encode("utf-8"), special=True) if isinstance(prompt, str) else list(prompt)
+        if len(tokens) >= self.n_ctx_seq:
+            raise ValueError(
+                f"Requested tokens ({len(tokens)}) exceed context window of {self.n_ctx_seq}"
+            )
+        merged["max_tokens"] = min(merged["max_tokens"] or self.n_ctx_seq, self.n_ctx_seq - len(tokens))
+        job = Job(prompt, tokens, merged, session=session, speculative=speculative, deadline=deadline, priority=rank)
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Scheduler is closed (model unloaded)")
+            if len(self._waiting) >= self.max_queue:
+                self.rejected += 1
+                raise QueueFullError(len(self._waiting), self._retry_after())
+            enqueue(self._waiting, job)
+            self._lock.notify()
+        return track(job)
+
+    def drop_session(self, session: str):
+        """Forget a session's cached KV (applied by the worker before its next admission)."""
+        with self._lock:
+            self._dropped_sessions.append(session)
+            self._lock.notify()
+
+    def __call__(self, prompt: Prompt, stream: bool = False, echo: bool = False, **params):
+        job = self.submit(prompt, **params)
+        return job.stream() if stream else job.result()
+
+    def close(self):
+        """Stop accepting jobs, let queued ones finish, then free the context and the model."""
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+        self._thread.join()
+        self._batch.close()
+        self._ctx.close()
+        self.llm.close()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            waiting = len(self._waiting)
+            queued = {name: sum(1 for j in self._waiting if j.priority == rank) for rank, name in enumerate(PRIORITIES)}
+        running = list(self._running)
+        paused = list(self._paused)
+        return {
+            "prefixCache": self.prefix_cache.stats() if self.prefix_cache else None,
+            "sessions": {
+                "slots": self.session_slots,
+                "retained": len(self._sessions),
+                "cells": self._retained_cells(),
+                "tokensReused": self.session_tokens_reused,
+            },
+            "speculative": {"drafted": self.draft_tokens, "accepted": self.accepted_tokens},
+            "queueDepth": waiting,
+            "queued": queued,
+            "running": len(running),
+            "paused": len(paused),
+            "preempted": self.preempted,
+            "maxBatch": self.max_batch,
+            "maxQueue": self.max_queue,
+            "kvCells": self.n_ctx,
+            "kvReserved": sum(j.reserve for j in running) + sum(j.held_cells for j in paused) + self._retained_cells(),
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    # --- worker ---
+
+    def _retry_after(self) -> int:
+        ahead = len(self._waiting) + len(self._running) + len(self._paused)
+        return max(1, math.ceil(self._avg_job_seconds * ahead / self.max_batch))
+
+    def _warm_prefixes(self):
+        """Load or prefill every prefix sequence before serving requests."""
+        start = time.time()
+        for entry in self.prefix_cache.entries:
+            try:
+                if self.prefix_cache.load(self._ctx, entry):
+                    continue
+                for i in range(0, len(entry.tokens), self.n_batch):
+                    n = 0
+                    for pos, token in enumerate(entry.tokens[i : i + self.n_batch], start=i):
+                        n = self._add(n, token, pos, entry.seq_id, False)
+                    self._batch.batch.n_tokens = n
+                    ret = llama_cpp.llama_decode(self._ctx.ctx, self._batch.batch)
+                    if ret != 0:
+                        raise RuntimeError(f"llama_decode returned {ret}")
+                entry.ready = True
+                entry.source = "prefill"
+                self.prefix_cache.save(self._ctx, entry)
+            except Exception as e:
+                print(f"[prefix-cache] Skipping {entry.name}: {e}")
+                self._ctx.kv_cache_seq_rm(entry.seq_id, -1, -1)
+        stats = self.prefix_cache.stats()
+        print(f"[prefix-cache] {stats['ready']}/{stats['entries']} prefixes ({stats['tokens']} tokens) ready in {time.time() - start:.2f}s")
+
+    def _loop(self):
+        if self.prefix_cache:
+            self._warm_prefixes()
+        while True:
+            with self._lock:
+                while not self._waiting and not self._running and not self._paused:
+                    if self._closed:
+                        return
+                    self._lock.wait()
+                self._admit()
+            if not self._running:
+                continue
+            try:
+                self._step()
+            except Exception as e:
+                print(f"[scheduler] Decode step failed: {e}")
+                for job in list(self._running):
+                    self._finish(job, None, e)
+
+    def _retained_cells(self) -> int:
+        return sum(len(kv.tokens) for kv in list(self._sessions.values()) if not kv.busy)
+
+    def _release_session(self, key: str):
+        kv = self._sessions.pop(key, None)
+        if kv is None:
+            return
+        if kv.busy:
+            kv.dropped = True  # freed when its running job finishes
+            return
+        self._ctx.kv_cache_seq_rm(kv.seq_id, -1, -1)
+        self._free_session_seqs.append(kv.seq_id)
+
+    def _evict_idle_session(self, keep: Optional[str] = None) -> bool:
+        """Drop the least recently used idle session's KV; False if none."""
+        for key, kv in self._sessions.items():
+            if not kv.busy and key != keep:
+                self._release_session(key)
+                return True
+        return False
+
+    def _session_kv(self, key: str) -> Optional[SessionKV]:
+        kv = self._sessions.get(key)
+        if kv is None:
+            if not self._free_session_seqs and not self._evict_idle_session():
+                return None
+            kv = self._sessions[key] = SessionKV(self._free_session_seqs.pop())
+        if kv.busy:
+            return None
+        self._sessions.move_to_end(key)
+        return kv
+
+    def _admit(self):
+        """Move waiting jobs into free sequence slots while the KV budget allows."""
+        while self._dropped_sessions:
+            self._release_session(self._dropped_sessions.pop())
+
+        # Queued jobs whose client left or whose deadline passed never start
+        now = time.time()
+        for job in [j for j in self._waiting if j.stop_reason(now)]:
+            self._waiting.remove(job)
+            job._close(job.stop_reason(now))
+        for job in [j for j in self._paused if j.stop_reason(now)]:
+            self._finish(job, job.stop_reason(now))
+
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+            need = job.reserve - (job.held_cells if job.paused else 0)
+            # Idle sessions give their cells back before new work is refused
+            while self._kv_used() + need > self.n_ctx:
+                if not self._evict_idle_session(keep=job.session):
+                    break
+            if not self._fits(need) and not self._preempt_for(job, need):
+                if self._running:
+                    break
+                if not job.paused and self._paused:
+                    # Nothing runs: paused work finishes first and frees its cells
+                    job = self._paused[0]
+            if job.paused:
+                self._paused.remove(job)
+                job.paused = False
+                self._running.append(job)
+                continue
+            self._waiting.popleft()
+            job.admitted_at = time.time()
+            job.sampler = self._make_sampler(job)
+
+            kv = self._session_kv(job.session) if job.session and self.session_slots else None
+            if kv is not None:
+                kv.busy = True
+                job._kv = kv
+                job.seq_id = kv.seq_id
+                n_reuse = min(_common_prefix(kv.tokens, job.prompt_tokens), len(job.prompt_tokens) - 1)
+                if n_reuse > 1:
+                    self._ctx.kv_cache_seq_rm(job.seq_id, n_reuse, -1)
+                    job.n_past = job.cached_tokens = n_reuse
+                    self.session_tokens_reused += n_reuse
+                    self._running.append(job)
+                    continue
+            else:
+                job.seq_id = self._free_seqs.pop()
+
+            self._ctx.kv_cache_seq_rm(job.seq_id, -1, -1)
+            if self.prefix_cache:
+                entry, n_reuse = self.prefix_cache.match(job.prompt_tokens)
+                if entry is not None:
+                    self._ctx.kv_cache_seq_cp(entry.seq_id, job.seq_id, 0, n_reuse)
+                    job.n_past = job.cached_tokens = n_reuse
+            self._running.append(job)
+
+    def _next_job(self) -> Optional[Job]:
+        """Highest class first; a paused job goes before queued ones of its class."""
+        candidates = self._paused[:1] + list(itertools.islice(self._waiting, 1))
+        return min(candidates, key=lambda j: (j.priority, not j.paused, j.id), default=None)
+
+    def _fits(self, need: int) -> bool:
+        if len(self._running) >= self.max_batch:
+            return False
+        # A job larger than the whole budget still runs once it would be alone
+        return self._kv_used() + need <= self.n_ctx or not (self._running or self._paused)
+
+    def _preempt_for(self, job: Job, need: int) -> bool:
+        """
+        Pause lower-class running jobs, lowest class and latest admitted
+        first, until ``job`` fits; nothing is paused if it would not fit anyway.
+        """
+        victims = sorted(
+            (j for j in self._running if j.priority > job.priority),
+            key=lambda j: (j.priority, j.admitted_at or 0),
+            reverse=True,
+        )
+        running, used = len(self._running), self._kv_used()
+        for n, victim in enumerate(victims, start=1):
+            if len(self._paused) + n > self.pause_slots:
+                return False
+            running -= 1
+            used -= victim.reserve - victim.held_cells
+            if running < self.max_batch and used + need <= self.n_ctx:
+                for victim in victims[:n]:
+                    self._running.remove(victim)
+                    victim.paused = True
+                    victim.preemptions += 1
+                    self._paused.append(victim)
+                self._paused.sort(key=lambda j: (j.priority, j.id))
+                self.preempted += n
+                return True
+        return False
+
+    def _kv_used(self) -> int:
+        return sum(j.reserve for j in self._running) + sum(j.held_cells for j in self._paused) + self._retained_cells()
+
+    def _make_sampler(self, job: Job):
+        p = job.params
+        sampler = internals.LlamaSampler()
+        try:
+            sampler.add_penalties(
+                penalty_last_n=PENALTY_LAST_N,
+                penalty_repeat=p["repeat_penalty"],
+                penalty_freq=0.0,
+                penalty_present=0.0,
+            )
+        except TypeError:
+            # llama-cpp-python < 0.3.6 still takes the vocab/newline arguments
+            model = self.llm._model
+            sampler.add_penalties(
+                model.n_vocab(), model.token_eos(), model.token_nl(),
+                PENALTY_LAST_N, p["repeat_penalty"], 0.0, 0.0, True, False,
+            )
+        if p["temperature"] <= 0:
+            sampler.add_greedy()
+        else:
+            sampler.add_top_k(p["top_k"])
+            sampler.add_top_p(p["top_p"], 1)
+            sampler.add_min_p(p["min_p"], 1)
+            sampler.add_temp(p["temperature"])
+            seed = p["seed"] if p["seed"] is not None else llama_cpp.LLAMA_DEFAULT_SEED
+            sampler.add_dist(seed)
+        for token in job.prompt_tokens[-PENALTY_LAST_N:]:
+            sampler.accept(token)
+        return sampler
+
+    def _add(self, n: int, token: int, pos: int, seq_id: int, logits: bool) -> int:
+        batch = self._batch.batch
+        batch.token[n] = token
+        batch.pos[n] = pos
+        batch.n_seq_id[n] = 1
+        batch.seq_id[n][0] = seq_id
+        batch.logits[n] = logits
+        return n + 1
+
+    def _step(self):
+        now = time.time()
+        for job in list(self._running):
+            reason = job.stop_reason(now)
+            if reason:
+                self._finish(job, reason)
+
+        n = 0
+        outputs = []
+        decoding = [j for j in self._running if j.n_past >= len(j.prompt_tokens)]
+        prefilling = [j for j in self._running if j.n_past < len(j.prompt_tokens)]
+
+        for job in decoding:
+            draft = self._draft(job, self.n_batch - n - 1)
+            n = self._add(n, job.last_token, job.n_past, job.seq_id, True)
+            outputs.append((job, n - 1, draft))
+            for i, token in enumerate(draft):
+                n = self._add(n, token, job.n_past + 1 + i, job.seq_id, True)
+            job.n_past += 1
+
+        # Chunked prefill fills whatever room the decode tokens leave
+        budget = self.n_batch - n
+        for job in prefilling:
+            if budget <= 0:
+                break
+            chunk = job.prompt_tokens[job.n_past : job.n_past + budget]
+            for token in chunk:
+                last = job.n_past == len(job.prompt_tokens) - 1
+                n = self._add(n, token, job.n_past, job.seq_id, last)
+                job.n_past += 1
+                if last:
+                    outputs.append((job, n - 1, []))
+            budget -= len(chunk)
+
+        if n == 0:
+            return
+        self._batch.batch.n_tokens = n
+        ret = llama_cpp.llama_decode(self._ctx.ctx, self._batch.batch)
+        if ret != 0:
+            raise RuntimeError(f"llama_decode returned {ret}")
+
+        for job, idx, draft in outputs:
+            self._sample(job, idx, draft)
+
+    def _draft(self, job: Job, room: int) -> List[int]:
+        if job.lookup is None:
+            return []
+        # Drafts stay inside the job's KV reservation and the batch
+        limit = min(
+            job.speculative,
+            room,
+            job.max_tokens - len(job.completion_tokens) - 1,
+            self.n_ctx_seq - job.n_past - 2,
+        )
+        return job.lookup.draft(limit) if limit > 0 else []
+
+    def _sample(self, job: Job, idx: int, draft: List[int]):
+        """Sample at ``idx``, then keep walking the draft while the model agrees with it."""
+        token = job.sampler.sample(self._ctx, idx)
+        self._accept(job, token)
+        if not draft:
+            return
+        job.draft_tokens += len(draft)
+        self.draft_tokens += len(draft)
+        for i, expected in enumerate(draft):
+            if job.done or token != expected:
+                break
+            # The draft token's KV is valid, and its logits give the next token
+            job.accepted_tokens += 1
+            self.accepted_tokens += 1
+            job.n_past += 1
+            token = job.sampler.sample(self._ctx, idx + 1 + i)
+            self._accept(job, token)
+        if not job.done:
+            self._ctx.kv_cache_seq_rm(job.seq_id, job.n_past, -1)
+
+    def _accept(self, job: Job, token: int):
+        if job.first_token_at is None:
+            job.first_token_at = time.time()
+        if token in self._eog:
+            self._finish(job, "stop")
+            return
+
+        job.completion_tokens.append(token)
+        if job.lookup is not None:
+            job.lookup.append(token)
+        piece = job._utf8.decode(self.llm.detokenize([token], special=True))
+        job._push(job._trimmer.feed(piece))
+
+        if job._trimmer.stopped:
+            self._finish(job, "stop")
+        elif len(job.completion_tokens) >= job.max_tokens or job.n_past + 1 >= self.n_ctx_seq:
+            self._finish(job, "length")
+        else:
+            job.last_token = token
+
+    def _finish(self, job: Job, reason: Optional[str], error: Optional[Exception] = None):
+        if job in self._running or job in self._paused:
+            (self._paused if job.paused else self._running).remove(job)
+            job.paused = False
+            kv = job._kv
+            if kv is None:
+                self._ctx.kv_cache_seq_rm(job.seq_id, -1, -1)
+                self._free_seqs.append(job.seq_id)
+            elif kv.dropped or error is not None:
+                kv.busy = False
+                self._ctx.kv_cache_seq_rm(kv.seq_id, -1, -1)
+                kv.tokens = []
+                if kv.dropped:
+                    self._free_session_seqs.append(kv.seq_id)
+            else:
+                # Keep what was decoded: prompt + reply tokens up to n_past
+                self._ctx.kv_cache_seq_rm(kv.seq_id, job.n_past, -1)
+                kv.tokens = (job.prompt_tokens + job.completion_tokens)[: job.n_past]
+                kv.busy = False
+        if error is None and reason != "cancelled":
+            job._push(job._trimmer.feed(job._utf8.decode(b"", final=True)))
+            job._push(job._trimmer.flush())
+        job._close(reason, error)
+        if error is not None or reason == "cancelled":
+            return
+
+        self.completed += 1
+        elapsed = job.finished_at - (job.admitted_at or job.submitted_at)
+        self._avg_job_seconds = 0.8 * self._avg_job_seconds + 0.2 * elapsed
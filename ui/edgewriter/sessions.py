@@ -0,0 +1,121 @@
+"""
+Server-held chat sessions.
+
+The store only keeps the conversation text; the matching KV cache lives in
+the scheduler under the same session id, so each new turn only has to
+prefill the tokens that were not already decoded.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+
+class SessionBusyError(RuntimeError):
+    """A turn is already being generated for this session."""
+
+
+class ChatSession:
+    def __init__(self, messages: Optional[List[Dict[str, str]]] = None, model: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.model = model  # registry model pinned for the whole conversation
+        self.messages: List[Dict[str, str]] = list(messages or [])
+        self.created = time.time()
+        self.updated = self.created
+        self.busy = False
+        self.window = 0  # index of the first message still sent to the model
+        self.summary = ""  # running summary of the messages before window
+
+    def to_dict(self) -> Dict:
+        return {
+            "session_id": self.id,
+            "messages": self.messages,
+            "window": self.window,
+            "summary": self.summary,
+            "model": self.model,
+            "created": self.created,
+            "updated": self.updated,
+        }
+
+
+class SessionStore:
+    """
+    In-memory sessions with an idle TTL and a size bound (least recently used
+    first). ``on_evict`` is called with the session id so the caller can drop
+    the KV state as well.
+    """
+
+    def __init__(self, max_sessions: int = 64, ttl: float = 3600.0, on_evict: Optional[Callable[[str], None]] = None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        now = time.time()
+        expired = [s.id for s in self._sessions.values() if not s.busy and now - s.updated > self.ttl]
+        while len(self._sessions) - len(expired) >= self.max_sessions:
+            oldest = next((s.id for s in self._sessions.values() if s.id not in expired and not s.busy), None)
+            if oldest is None:
+                break
+            expired.append(oldest)
+        for session_id in expired:
+            self._drop(session_id)
+
+    def _drop(self, session_id: str) -> bool:
+        session = self._sessions.pop(session_id, None)
+        if session is not None and self.on_evict:
+            self.on_evict(session_id)
+        return session is not None
+
+    def create(self, messages: Optional[List[Dict[str, str]]] = None, model: Optional[str] = None) -> ChatSession:
+        with self._lock:
+            self._expire()
+            session = ChatSession(messages, model)
+            self._sessions[session.id] = session
+            return session
+
+    def get(self, session_id: str) -> Optional[ChatSession]:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._drop(session_id)
+
+    def acquire(self, session_id: str) -> Optional[ChatSession]:
+        """Mark a session busy for one turn; raises SessionBusyError if it already is."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if session.busy:
+                raise SessionBusyError(f"Session {session_id} is already generating a reply")
+            session.busy = True
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def release(self, session: ChatSession):
+        with self._lock:
+            session.busy = False
+            session.updated = time.time()
+
+    def compact(self, session: ChatSession, start: int, end: int, summary: str) -> bool:
+        """
+        Replace messages[start:end] in the prompt by ``summary``. Skipped (False)
+        if a turn started or the window moved since the summary was computed.
+        """
+        with self._lock:
+            if session.busy or session.window != start or self._sessions.get(session.id) is not session:
+                return False
+            session.summary = summary
+            session.window = end
+            return True
+
+    def __len__(self) -> int:
+        return len(self._sessions)
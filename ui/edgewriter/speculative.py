@@ -0,0 +1,52 @@
+"""
+Prompt-lookup drafting for speculative decoding.
+
+Copy-heavy tasks (proofreading, light paraphrasing) mostly repeat spans of
+their input. PromptLookup finds the latest earlier occurrence of the last few
+generated tokens in prompt + output and proposes the tokens that followed it;
+the scheduler verifies the whole draft in one batched forward pass and keeps
+the prefix the model agrees with. Every position is still sampled from the
+model's own logits, so the output is the same as plain decoding.
+"""
+from typing import Dict, List, Optional, Tuple
+
+
+class PromptLookup:
+    def __init__(self, tokens: List[int], max_ngram: int = 3, min_ngram: int = 2):
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        self.tokens: List[int] = []
+        # n-gram -> index of the token that followed its latest occurrence
+        self._index: Dict[Tuple[int, ...], int] = {}
+        for token in tokens:
+            self.append(token)
+
+    def append(self, token: int):
+        i = len(self.tokens)
+        self.tokens.append(token)
+        for n in range(self.min_ngram, self.max_ngram + 1):
+            if i >= n:
+                self._index[tuple(self.tokens[i - n : i])] = i
+
+    def draft(self, max_tokens: int) -> List[int]:
+        """Tokens that followed the longest matching tail n-gram (empty if none)."""
+        for n in range(self.max_ngram, self.min_ngram - 1, -1):
+            if len(self.tokens) < n:
+                continue
+            pos = self._index.get(tuple(self.tokens[-n:]))
+            if pos is not None:
+                return self.tokens[pos : pos + max_tokens]
+        return []
+
+
+def speculative_stats(usage: Dict) -> Optional[Dict]:
+    """Response block for a completion's draft/accept counts (None when speculation was off)."""
+    if "draft_tokens" not in usage:
+        return None
+    drafted = usage["draft_tokens"]
+    accepted = usage["accepted_tokens"]
+    return {
+        "drafted": drafted,
+        "accepted": accepted,
+        "acceptanceRate": round(accepted / drafted, 3) if drafted else 0.0,
+    }
@@ -0,0 +1,188 @@
+"""
+Server-Sent Events helpers for token streaming.
+
+The non-streaming routes strip the output and cut it at the first stop/trim
+sequence once generation is finished. StopTrimmer does the same thing on the
+fly: text that could still turn into a stop sequence (or trailing whitespace
+that .strip() would remove) is held back until the next piece arrives.
+"""
+import json
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+
+from .speculative import speculative_stats
+from .templates import Prompt
+
+
+def sse_event(event: str, data: dict) -> str:
+    """Format one SSE frame."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class StopTrimmer:
+    """
+    Incremental equivalent of ``text.strip()`` + cut at the first trim sequence.
+    With ``strip=False`` only the stop-sequence cut is applied.
+    """
+
+    def __init__(self, sequences: List[str], strip: bool = True):
+        self.sequences = [s for s in sequences if s]
+        self.strip = strip
+        self.stopped = False
+        self.text = ""
+        self._pending = ""
+        self._started = False
+
+    def _held_suffix(self, buf: str) -> int:
+        """Length of the longest tail of buf that is a prefix of some sequence."""
+        hold = 0
+        for seq in self.sequences:
+            for k in range(min(len(seq) - 1, len(buf)), hold, -1):
+                if buf.endswith(seq[:k]):
+                    hold = k
+                    break
+        return hold
+
+    def _emit(self, out: str) -> str:
+        self.text += out
+        return out
+
+    def feed(self, piece: str) -> str:
+        """Add raw model text, return the part that is now safe to send."""
+        if self.stopped or not piece:
+            return ""
+
+        buf = self._pending + piece
+        if self.strip and not self._started:
+            buf = buf.lstrip()
+            if not buf:
+                self._pending = ""
+                return ""
+            self._started = True
+
+        hits = [buf.find(seq) for seq in self.sequences if seq in buf]
+        if hits:
+            self.stopped = True
+            self._pending = ""
+            out = buf[: min(hits)]
+            return self._emit(out.rstrip() if self.strip else out)
+
+        hold = self._held_suffix(buf)
+        safe = buf[: len(buf) - hold]
+        visible = safe.rstrip() if self.strip else safe
+        self._pending = buf[len(visible):]
+        return self._emit(visible)
+
+    def flush(self) -> str:
+        """Release whatever is still held back once generation has ended."""
+        if self.stopped:
+            return ""
+        out = self._pending.rstrip() if self.strip else self._pending
+        self._pending = ""
+        return self._emit(out)
+
+
+def stream_completion(
+    llm,
+    prompt: Prompt,
+    params: Dict,
+    trim: List[str],
+    label: str = "stream",
+    start: Optional[float] = None,
+    on_done: Optional[Callable[[Dict], None]] = None,
+) -> Iterator[str]:
+    """
+    Start ``llm(prompt, stream=True, **params)`` and return an iterator of SSE
+    frames: ``token`` events with incremental text, then one ``done`` event
+    carrying the same text/latency/tokens block the non-streaming routes return
+    plus ``ttft`` (seconds until the first visible token) and the engine's
+    ``timings`` block when it reports one.
+
+    ``llm`` is called before the iterator is returned so that admission errors
+    (e.g. a full scheduler queue) surface while the route can still answer
+    with a proper status code. ``on_done`` receives the ``done`` payload just
+    before it is sent (not called when the stream fails or is abandoned).
+    """
+    start = start or time.time()
+    chunks = llm(prompt, stream=True, echo=False, **params)
+    return _sse_frames(llm, prompt, chunks, trim, label, start, on_done)
+
+
+def _sse_frames(
+    llm, prompt: Prompt, chunks, trim: List[str], label: str, start: float, on_done: Optional[Callable[[Dict], None]] = None
+) -> Iterator[str]:
+    trimmer = StopTrimmer(trim)
+    raw_parts: List[str] = []
+    usage = None
+    timings = None
+    ttft = None
+    finish_reason = None
+
+    try:
+        for chunk in chunks:
+            choice = chunk["choices"][0]
+            raw_parts.append(choice.get("text") or "")
+            finish_reason = choice.get("finish_reason") or finish_reason
+            usage = chunk.get("usage") or usage
+            timings = chunk.get("timings") or timings
+
+            delta = trimmer.feed(raw_parts[-1])
+            if delta:
+                if ttft is None:
+                    ttft = round(time.time() - start, 3)
+                yield sse_event("token", {"text": delta})
+            if trimmer.stopped:
+                finish_reason = "stop"
+                break
+
+        tail = trimmer.flush()
+        if tail:
+            if ttft is None:
+                ttft = round(time.time() - start, 3)
+            yield sse_event("token", {"text": tail})
+    except Exception as e:
+        print(f"[{label}] Streaming failed: {e}")
+        yield sse_event("error", {"detail": str(e)})
+        return
+    finally:
+        # Stops decoding when we break early or the client goes away
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+
+    raw_result = "".join(raw_parts)
+    if usage:
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+    else:
+        # llama-cpp-python does not report usage for streamed completions
+        prompt_tokens = len(llm.tokenize(prompt.encode("utf-8"), special=True)) if isinstance(prompt, str) else len(prompt)
+        completion_tokens = (
+            len(llm.tokenize(raw_result.encode("utf-8"), add_bos=False, special=True)) if raw_result else 0
+        )
+    latency = round(time.time() - start, 2)
+    result = trimmer.text
+
+    print(f"[{label}] Streamed in {latency}s (TTFT {ttft}s) | Tokens: {prompt_tokens}+{completion_tokens}={prompt_tokens + completion_tokens} | Output: {result[:80]}{'...' if len(result)>80 else ''}")
+
+    done = {
+        "text": result,
+        "latency": latency,
+        "ttft": ttft,
+        "finish_reason": finish_reason,
+        "tokens": {
+            "prompt": prompt_tokens,
+            "completion": completion_tokens,
+            "total": prompt_tokens + completion_tokens,
+        },
+        "raw_output": raw_result,
+    }
+    if usage and "cached_tokens" in usage:
+        done["tokens"]["cached"] = usage["cached_tokens"]
+    if usage and "draft_tokens" in usage:
+        done["speculative"] = speculative_stats(usage)
+    if timings:
+        done["timings"] = timings
+    if on_done:
+        on_done(done)
+    yield sse_event("done", done)
@@ -0,0 +1,168 @@
+"""
+Background hardware telemetry for the UI's hardware and telemetry panels.
+
+TelemetrySampler collects CPU, RAM and process RSS (psutil) plus GPU memory
+and utilization on a fixed interval, keeps the recent samples in a ring
+buffer, and hands out the latest one without doing any work in the request.
+
+GPU details come from NVML (``pip install nvidia-ml-py``) when it is
+installed. Otherwise the server's own detection (nvidia-smi / wmic) runs
+once, in the sampler thread, for the GPU names and total memory, and no
+subprocess is started per sample.
+
+Standard library + psutil only, so the stdlib nano_model_UI server can use it.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+import psutil
+
+try:
+    import pynvml
+except ImportError:  # optional: live NVIDIA memory/utilization
+    pynvml = None
+
+
+def _wake(future: "asyncio.Future"):
+    if not future.done():
+        future.set_result(None)
+
+
+class TelemetrySampler:
+    def __init__(
+        self,
+        inventory: Optional[Callable[[], List[Dict]]] = None,
+        interval: float = 2.0,
+        history: int = 300,
+    ):
+        """``inventory()`` lists the GPUs as ``/api/gpu-info`` always has; it is called once."""
+        self.inventory = inventory
+        self.interval = interval
+        self._samples = deque(maxlen=history)
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._gpus: List[Dict] = []
+        self._nvml: List = []
+        self._process = psutil.Process()
+        self._waiters = set()  # (event loop, future) pairs of next_sample() callers
+        self.seq = 0
+
+    def start(self) -> "TelemetrySampler":
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+                self._thread.start()
+        return self
+
+    def latest(self, timeout: float = 10.0) -> Optional[Dict]:
+        """Most recent sample, waiting for the first one after start."""
+        self.start()
+        with self._cond:
+            self._cond.wait_for(lambda: self._samples, timeout)
+            return self._samples[-1] if self._samples else None
+
+    def history(self, limit: Optional[int] = None) -> List[Dict]:
+        with self._cond:
+            samples = list(self._samples)
+        return samples[-limit:] if limit else samples
+
+    def wait(self, seq: int, timeout: float) -> Optional[Dict]:
+        """Block until a sample newer than ``seq`` arrives; None on timeout."""
+        self.start()
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.seq > seq, timeout):
+                return None
+            return self._samples[-1]
+
+    async def next_sample(self, seq: int, timeout: float) -> Optional[Dict]:
+        """``wait`` for async code: the caller's event loop is woken, no thread is held meanwhile."""
+        self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._cond:
+            if self.seq > seq:
+                return self._samples[-1]
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                self._waiters.discard(waiter)
+        with self._cond:
+            return self._samples[-1] if self.seq > seq else None
+
+    def _run(self):
+        psutil.cpu_percent(None)  # the first call only sets the baseline
+        self._detect_gpus()
+        while True:
+            started = time.monotonic()
+            try:
+                sample = self._sample()
+            except Exception as e:
+                print(f"[telemetry] sample failed: {e}")
+            else:
+                with self._cond:
+                    self.seq += 1
+                    sample["seq"] = self.seq
+                    self._samples.append(sample)
+                    self._cond.notify_all()
+                    waiters, self._waiters = self._waiters, set()
+                for loop, future in waiters:
+                    try:
+                        loop.call_soon_threadsafe(_wake, future)
+                    except RuntimeError:  # its event loop has closed
+                        pass
+            time.sleep(max(self.interval - (time.monotonic() - started), 0.05))
+
+    def _detect_gpus(self):
+        if pynvml is not None:
+            try:
+                pynvml.nvmlInit()
+                for i in range(pynvml.nvmlDeviceGetCount()):
+                    handle = pynvml.nvmlDeviceGetHandleByIndex(i)
+                    name = pynvml.nvmlDeviceGetName(handle)
+                    total = pynvml.nvmlDeviceGetMemoryInfo(handle).total
+                    self._nvml.append(handle)
+                    self._gpus.append({
+                        "name": name.decode() if isinstance(name, bytes) else name,
+                        "type": "NVIDIA",
+                        "memory": f"{total // 2 ** 20} MiB",
+                    })
+            except Exception as e:
+                print(f"[telemetry] NVML unavailable: {e}")
+                self._nvml, self._gpus = [], []
+        if self.inventory is not None:
+            try:
+                detected = self.inventory()
+            except Exception as e:
+                print(f"[telemetry] GPU detection failed: {e}")
+                detected = []
+            # NVML already covers the NVIDIA cards; keep the others (integrated, AMD)
+            self._gpus += [g for g in detected if not (self._nvml and g.get("type") == "NVIDIA")]
+
+    def _sample(self) -> Dict:
+        mem = psutil.virtual_memory()
+        gpus = []
+        for i, gpu in enumerate(self._gpus):
+            gpu = dict(gpu, memoryUsedMB=None, memoryTotalMB=None, utilization=None)
+            if i < len(self._nvml):
+                info = pynvml.nvmlDeviceGetMemoryInfo(self._nvml[i])
+                gpu["memoryUsedMB"] = info.used // 2 ** 20
+                gpu["memoryTotalMB"] = info.total // 2 ** 20
+                gpu["utilization"] = pynvml.nvmlDeviceGetUtilizationRates(self._nvml[i]).gpu
+            gpus.append(gpu)
+        return {
+            "time": time.time(),
+            "cpuPercent": psutil.cpu_percent(None),
+            "ramGB": round(mem.total / 2 ** 30),
+            "ramUsedGB": round((mem.total - mem.available) / 2 ** 30, 2),
+            "ramPercent": mem.percent,
+            "processRssMB": round(self._process.memory_info().rss / 2 ** 20, 1),
+            "gpus": gpus,
+        }
@@ -0,0 +1,347 @@
+"""
+Task prompt templates: one registry loaded from versioned files, with
+prompts assembled as token ids.
+
+Template sets live in ``prompts/<set>-v<N>/``, one ``<Name>.txt`` per
+template, written as plain text with ``{field}`` placeholders (``{{`` and
+``}}`` for literal braces; the file's final newline is not part of the
+template). A published version is not edited: new wording goes into the next
+version directory, so the templates behind any prompt can be traced.
+
+- ``fewshot``: instructions with example input/output pairs (Integrated UI)
+- ``guarded``: the input fenced in triple quotes with explicit "do not
+  execute" guidance (Phi-3 server)
+- ``gradio``: shorter ``guarded``-style wording (Gradio app)
+
+Template names are the task (``Summarize``, ``Proofread``, ``Paraphrase``,
+``MergeSummaries``), ``Rewrite.<Tone>`` for the built-in tones,
+``RewriteCustom`` and ``Rewrite`` for a custom or any other tone (both with
+a ``{tone}`` field) and ``Process`` for any other task.
+
+Each template's static text is tokenized once per model (see
+TemplateSet.tokenized), and a prompt is built by joining those token arrays
+around the tokenized field values. A request then tokenizes only its own
+text, and the exact prompt length is known before it is queued. Field values
+are tokenized as plain text, so control tokens such as ``<|end|>`` typed by
+a user stay text instead of ending the turn. Otherwise the tokens equal those
+of the whole rendered prompt: every template is checked against that when it
+is tokenized, and one that differs with the model's vocabulary (byte-level
+BPE merges across the split points) is tokenized whole instead.
+"""
+import hashlib
+import os
+import re
+import string
+import threading
+import weakref
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+# Prompt text, or token ids from TemplateSet.tokens(); every engine accepts both
+Prompt = Union[str, List[int]]
+
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
+TASKS = ("Summarize", "Proofread", "Paraphrase")
+
+_VERSIONED = re.compile(r"^(?P<name>.+)-v(?P<version>\d+)$")
+
+
+# Where tokenization cannot merge across: after a newline (a byte token of
+# its own) and around control tokens such as <|end|>
+_SAFE_SPLIT = re.compile(r"\n|<\||\|>")
+
+Run = List[Tuple[str, Optional[str]]]  # (literal, following field or None)
+
+
+def _runs(parts: Run) -> List[Run]:
+    """
+    Split a template into runs at safe split points. Static runs hold no
+    field; a field's run also holds the text on the same line around it, so
+    a value that merges with its neighbours (``\"\"\"text\"\"\"``) is tokenized
+    as it would be in the whole prompt.
+    """
+    runs: List[Run] = [[]]
+    for literal, field in parts:
+        pos = 0
+        for match in _SAFE_SPLIT.finditer(literal):
+            point = match.start() if match.group() == "<|" else match.end()
+            runs[-1].append((literal[pos:point], None))
+            runs.append([])
+            pos = point
+        runs[-1].append((literal[pos:], field))
+
+    merged: List[Run] = []
+    for run in runs:
+        run = [(literal, field) for literal, field in run if literal or field]
+        if not run:
+            continue
+        if any(field for _, field in run):
+            merged.append(run)
+        elif merged and not any(field for _, field in merged[-1]):
+            merged[-1] = [(merged[-1][0][0] + "".join(literal for literal, _ in run), None)]
+        else:
+            merged.append([("".join(literal for literal, _ in run), None)])
+    return merged
+
+
+class Template:
+    """One template: literal text segments around ``{field}`` placeholders."""
+
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = text
+        self.parts: Run = []
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if field is not None and (spec or conversion or not field.isidentifier()):
+                raise ValueError(f"Template {name}: unsupported placeholder {{{field}}}")
+            self.parts.append((literal, field))
+        self.fields = [field for _, field in self.parts if field]
+        self.runs = _runs(self.parts)
+
+    @property
+    def head(self) -> str:
+        """Static text the prompt starts with (what the prefix cache keeps prefilled)."""
+        first = self.runs[0] if self.runs else []
+        return first[0][0] if len(first) == 1 and first[0][1] is None else ""
+
+    def value(self, values: Dict[str, str], field: str) -> str:
+        try:
+            return values[field]
+        except KeyError:
+            raise ValueError(f"Template {self.name} needs a value for {{{field}}}") from None
+
+    def render(self, parts: Optional[Run] = None, **values: str) -> str:
+        parts = self.parts if parts is None else parts
+        return "".join(literal + (self.value(values, field) if field else "") for literal, field in parts)
+
+
+class TemplateSet:
+    """One version of a template set; see the module docstring."""
+
+    def __init__(self, name: str, version: int, templates: Dict[str, Template], path: Optional[str] = None):
+        self.name = name
+        self.version = version
+        self.templates = templates
+        self.path = path
+        digest = hashlib.sha256()
+        for key in sorted(templates):
+            digest.update(f"{key}\0{templates[key].text}\0".encode("utf-8"))
+        self.digest = digest.hexdigest()
+        # Per engine/backend (anything with tokenize()); dropped when the model is unloaded
+        self._tokenized: "weakref.WeakKeyDictionary[object, TokenizedTemplates]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> "TemplateSet":
+        match = _VERSIONED.match(os.path.basename(os.path.normpath(path)))
+        if not match:
+            raise ValueError(f"Template directory {path} is not named <set>-v<version>")
+        templates = {}
+        for filename in sorted(os.listdir(path)):
+            if not filename.endswith(".txt"):
+                continue
+            with open(os.path.join(path, filename), "r", encoding="utf-8") as f:
+                text = f.read()
+            name = filename[: -len(".txt")]
+            templates[name] = Template(name, text[:-1] if text.endswith("\n") else text)
+        if not templates:
+            raise ValueError(f"No templates in {path}")
+        return cls(match["name"], int(match["version"]), templates, path)
+
+    @property
+    def label(self) -> str:
+        return f"{self.name}-v{self.version}"
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.templates
+
+    def __getitem__(self, name: str) -> Template:
+        try:
+            return self.templates[name]
+        except KeyError:
+            raise ValueError(f"No template {name!r} in {self.label}") from None
+
+    def select(self, task: str, tone: str = "", custom_tone: str = "") -> Tuple[str, Dict[str, str]]:
+        """Template name and its field values other than ``text`` for a task/tone request."""
+        if task == "Rewrite":
+            if tone == "Custom" and custom_tone:
+                return "RewriteCustom", {"tone": custom_tone}
+            if f"Rewrite.{tone}" in self.templates:
+                return f"Rewrite.{tone}", {}
+            return "Rewrite", {"tone": tone}
+        return (task if task in TASKS else "Process"), {}
+
+    @staticmethod
+    def labels(name: str) -> Tuple[str, str]:
+        """
+        Task and tone of a template name from ``select`` as metric labels: a
+        fixed set, so request strings cannot add series (a free-form
+        ``Rewrite`` tone is "other").
+        """
+        if name == "RewriteCustom":
+            return "Rewrite", "Custom"
+        task, _, tone = name.partition(".")
+        if task == "Rewrite" and not tone:
+            tone = "other"
+        return task, tone
+
+    def render(self, name: str, **values: str) -> str:
+        """The prompt as text (what response cache keys are built from)."""
+        return self[name].render(**values)
+
+    def tokenized(self, tokenizer) -> "TokenizedTemplates":
+        """The templates tokenized with ``tokenizer``'s vocabulary, on first use."""
+        with self._lock:
+            tokenized = self._tokenized.get(tokenizer)
+            if tokenized is None:
+                tokenized = self._tokenized[tokenizer] = TokenizedTemplates(self, tokenizer.tokenize)
+            return tokenized
+
+    def tokens(self, tokenizer, name: str, **values: str) -> List[int]:
+        """The prompt as token ids for the model behind ``tokenizer``."""
+        return self.tokenized(tokenizer).build(name, **values)
+
+    def info(self) -> Dict:
+        return {"name": self.name, "version": self.version, "digest": self.digest[:16], "templates": sorted(self.templates)}
+
+
+class TokenizedTemplates:
+    """A TemplateSet's static runs, tokenized once with one model's tokenizer."""
+
+    # Values every template is checked with at load (see verify)
+    SAMPLE = {"text": "Sample text, with \"quotes\".\nSecond line.", "tone": "formal"}
+
+    def __init__(self, templates: TemplateSet, tokenize: Callable[..., List[int]]):
+        self.templates = templates
+        self._tokenize = tokenize
+        self._newline = tokenize(b"\n", add_bos=False, special=False)
+        # Per template: static tokens, or (run, starts the prompt, follows a
+        # control token, static head tokenized along with it or None)
+        self._runs: Dict[str, List[Union[List[int], Tuple[Run, bool, bool, Optional[Tuple[str, List[int]]]]]]] = {}
+        self._static: Dict[str, int] = {}
+        self._whole: set = set()
+        for name, template in templates.templates.items():
+            runs = []
+            flags = []  # (starts the prompt, follows a control token) per static run
+            previous = ""
+            for i, run in enumerate(template.runs):
+                after_special = previous.endswith("|>")
+                if any(field for _, field in run):
+                    if runs and isinstance(runs[-1], list) and previous.rstrip().endswith("|>"):
+                        # A control token starts a new fragment and may strip
+                        # the whitespace after it (Phi-3's do), so the static
+                        # text from there on is tokenized with this run
+                        first, after_special = flags.pop()
+                        runs.append((run, first, after_special, (previous, runs.pop())))
+                    else:
+                        runs.append((run, i == 0, after_special, None))
+                    previous = run[-1][0]
+                    continue
+                text = run[0][0]
+                if i == 0:
+                    runs.append(tokenize(text.encode("utf-8"), add_bos=True, special=True))
+                else:
+                    runs.append(self._inner(text, True, after_special))
+                flags.append((i == 0, after_special))
+                previous = text
+            self._runs[name] = runs
+        # Tokenizers that merge across the split points (byte-level BPE)
+        # get these templates tokenized whole, unless a value has control tokens
+        self._whole = set(self.verify())
+        if self._whole:
+            print(f"[templates] {templates.label}: tokenizing {', '.join(sorted(self._whole))} as whole prompts (split tokenization differs with this vocabulary)")
+        for name, template in templates.templates.items():
+            self._static[name] = len(self.build(name, **{field: "" for field in template.fields}))
+
+    def _inner(self, text: str, special: bool, after_special: bool = False) -> List[int]:
+        """
+        ``text`` tokenized as it is inside a prompt. After plain text, the
+        tokenizer must not treat it as the start of its input (SentencePiece
+        would add a leading space), so it is tokenized after a newline whose
+        tokens are then dropped. After a control token llama.cpp does start
+        a new fragment, which is what tokenizing it alone gives.
+        """
+        if not text:
+            return []
+        data = text.encode("utf-8")
+        if not after_special:
+            tokens = self._tokenize(b"\n" + data, add_bos=False, special=special)
+            n = len(self._newline)
+            if n and tokens[:n] == self._newline:
+                return tokens[n:]
+        return self._tokenize(data, add_bos=False, special=special)
+
+    def _plain(self, value: str) -> bool:
+        """Whether ``value`` holds no control tokens (parsing them changes nothing)."""
+        data = value.encode("utf-8")
+        return self._tokenize(data, add_bos=False, special=True) == self._tokenize(data, add_bos=False, special=False)
+
+    def _template_runs(self, name: str):
+        runs = self._runs.get(name)
+        if runs is None:
+            raise ValueError(f"No template {name!r} in {self.templates.label}")
+        return runs
+
+    def text_tokens(self, text: str) -> List[int]:
+        """Tokens of ``text`` in the middle of a prompt (for sizing field values)."""
+        return self._inner(text, special=False)
+
+    def build(self, name: str, **values: str) -> List[int]:
+        runs = self._template_runs(name)
+        template = self.templates[name]
+        if name in self._whole and all(self._plain(template.value(values, field)) for field in template.fields):
+            return self._tokenize(template.render(**values).encode("utf-8"), add_bos=True, special=True)
+        tokens: List[int] = []
+        for run in runs:
+            if isinstance(run, list):
+                tokens += run
+                continue
+            parts, first, after_special, head = run
+            text = template.render(parts, **values)
+            if head is not None:
+                head_text, head_tokens = head
+                if all(self._plain(template.value(values, field)) for _, field in parts if field):
+                    text = head_text + text
+                    tokens += self._tokenize(text.encode("utf-8"), add_bos=True, special=True) if first else self._inner(text, True, after_special)
+                    continue
+                tokens += head_tokens
+                first, after_special = False, head_text.endswith("|>")
+            # Values are plain text: control tokens in user input are not parsed
+            if first:
+                tokens += self._tokenize(text.encode("utf-8"), add_bos=True, special=False)
+            else:
+                tokens += self._inner(text, False, after_special)
+        return tokens
+
+    def verify(self) -> List[str]:
+        """Templates whose assembled tokens differ from tokenizing the whole rendered prompt (SAMPLE values)."""
+        mismatched = []
+        for name, template in self.templates.templates.items():
+            values = {field: self.SAMPLE.get(field, "sample") for field in template.fields}
+            whole = self._tokenize(template.render(**values).encode("utf-8"), add_bos=True, special=True)
+            if name not in self._whole and self.build(name, **values) != whole:
+                mismatched.append(name)
+        return mismatched
+
+    def static_tokens(self, name: str) -> int:
+        """Length of the prompt for empty field values: the template's own share of it."""
+        self._template_runs(name)
+        return self._static[name]
+
+
+def load_templates(spec: str) -> TemplateSet:
+    """
+    ``spec`` is ``<set>`` (its highest version under prompts/), a pinned
+    ``<set>-v<N>``, or a template directory elsewhere.
+    """
+    for path in (spec, os.path.join(PROMPTS_DIR, spec)):
+        if os.path.isdir(path):
+            return TemplateSet.load(path)
+    versions = {}
+    for entry in os.listdir(PROMPTS_DIR):
+        match = _VERSIONED.match(entry)
+        if match and match["name"] == spec:
+            versions[int(match["version"])] = entry
+    if not versions:
+        available = sorted({m["name"] for m in map(_VERSIONED.match, os.listdir(PROMPTS_DIR)) if m})
+        raise ValueError(f"Unknown template set {spec!r} (available: {', '.join(available)})")
+    return TemplateSet.load(os.path.join(PROMPTS_DIR, versions[max(versions)]))
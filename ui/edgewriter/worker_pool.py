@@ -0,0 +1,432 @@
+"""
+Multi-process Llama worker pool for CPU-only servers.
+
+Each worker process loads the GGUF itself (``use_mmap`` lets the OS share the
+weight pages between them) and gets its own slice of the CPU threads. The
+HTTP process keeps one feeder thread per worker that sends it requests over a
+``multiprocessing`` pipe and relays the streamed chunks back, so generation
+never competes with request handling for the GIL.
+
+A worker that dies is restarted and its in-flight request is retried, unless
+tokens of a streamed reply were already sent to the client. Cancelled jobs and
+jobs past their deadline are stopped in the worker after its current token.
+Each worker's queue is ordered by priority class; a running generation is not
+preempted.
+Chat sessions stick to one worker so the backend's own prefix reuse keeps
+their history cached.
+
+The pool is call-compatible with ``Scheduler`` (``submit``, ``__call__``,
+``tokenize``, ``stats``, ``drop_session``) so the routes work with either.
+"""
+import itertools
+import math
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional
+
+from .backends import load_backend
+from .cancellation import track
+from .scheduler import PRIORITIES, QueueFullError, priority_rank
+from .templates import Prompt
+
+MAX_AFFINITY = 1024
+
+
+def _worker_main(conn, backend: str, model_path: str, llama_kwargs: Dict):
+    """Worker process: load the model, then serve one request at a time."""
+    llm = load_backend(backend, model_path, **llama_kwargs)
+    conn.send(("ready", None, os.getpid()))
+    while True:
+        try:
+            kind, req_id, payload = conn.recv()
+        except EOFError:
+            return
+        if kind == "stop":
+            return
+        if kind != "run":
+            continue  # a cancel that arrived after the request finished
+
+        prompt, params = payload
+        try:
+            generation = llm.stream(prompt, **params)
+            for piece in generation:
+                conn.send(("chunk", req_id, {"choices": [{"text": piece, "index": 0, "finish_reason": None}]}))
+                if conn.poll():
+                    kind, cancel_id, reason = conn.recv()
+                    if kind == "stop":
+                        return
+                    if cancel_id == req_id:
+                        generation.finish_reason = reason or "cancelled"
+                        generation.close()
+                        break
+            conn.send(("done", req_id, {
+                "finish_reason": generation.finish_reason,
+                "usage": generation.usage,
+                "timings": generation.timings,
+            }))
+        except Exception as e:
+            conn.send(("error", req_id, str(e)))
+
+
+class PoolJob:
+    """One request dispatched to a worker. Produced by WorkerPool.submit()."""
+
+    _ids = itertools.count(1)
+
+    def __init__(
+        self,
+        prompt: Prompt,
+        params: Dict,
+        session: Optional[str] = None,
+        deadline: Optional[float] = None,
+        priority: int = 1,
+    ):
+        self.id = next(PoolJob._ids)
+        self.prompt = prompt
+        self.params = params
+        self.session = session
+        self.deadline = deadline
+        self.priority = priority
+        self.cancelled = False
+        self.buffered = False  # result() collects everything, so a retry can start over
+        self.attempts = 0
+        self.chunks_sent = 0
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._events: "queue.Queue" = queue.Queue()
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def stop_reason(self, now: float) -> Optional[str]:
+        if self.cancelled:
+            return "cancelled"
+        if self.deadline is not None and now >= self.deadline:
+            return "deadline"
+        return None
+
+    def _put(self, kind: str, payload=None):
+        if kind in ("done", "error"):
+            self.finished_at = time.time()
+        self._events.put((kind, payload))
+
+    def _timings(self, payload: Dict) -> Optional[Dict]:
+        """The worker's prefill/decode split plus the time spent waiting for it."""
+        timings = payload.get("timings")
+        if timings is None:
+            return None
+        queue = (self.started_at or self.submitted_at) - self.submitted_at
+        return {**timings, "queue": round(queue, 4)}
+
+    def stream(self) -> Iterator[Dict]:
+        """Yield llama-cpp style chunks; the last one carries finish_reason and usage."""
+        try:
+            while True:
+                kind, payload = self._events.get()
+                if kind == "chunk":
+                    yield payload
+                elif kind == "done":
+                    yield {
+                        "choices": [{"text": "", "index": 0, "finish_reason": payload["finish_reason"]}],
+                        "usage": payload["usage"],
+                        "timings": self._timings(payload),
+                    }
+                    return
+                elif kind == "error":
+                    raise RuntimeError(payload)
+        finally:
+            if not self.done:
+                self.cancel()
+
+    def result(self) -> Dict:
+        """Block until the worker finishes and return a llama-cpp style completion."""
+        self.buffered = True
+        text: List[str] = []
+        while True:
+            kind, payload = self._events.get()
+            if kind == "chunk":
+                text.append(payload["choices"][0].get("text") or "")
+            elif kind == "reset":
+                text = []  # the worker died and the request is being retried
+            elif kind == "error":
+                raise RuntimeError(payload)
+            elif kind == "done":
+                return {
+                    "id": f"cmpl-pool-{self.id}",
+                    "object": "text_completion",
+                    "created": int(self.submitted_at),
+                    "choices": [
+                        {"text": "".join(text), "index": 0, "logprobs": None, "finish_reason": payload["finish_reason"]}
+                    ],
+                    "usage": payload["usage"],
+                    "timings": self._timings(payload),
+                }
+
+
+class _Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.pid: Optional[int] = None
+        self.ready = False
+        self.busy = False
+        self.restarts = 0
+        self.completed = 0
+        # (priority, job id, job); None is queued behind everything on close
+        self.queue: "queue.PriorityQueue" = queue.PriorityQueue()
+
+
+class WorkerPool:
+    """N model processes behind one Scheduler-like front; see module docstring."""
+
+    def __init__(
+        self,
+        model_path: str,
+        workers: int = 2,
+        n_ctx: int = 4096,
+        n_threads: Optional[int] = None,
+        max_queue: int = 16,
+        max_retries: int = 2,
+        llama_kwargs: Optional[Dict] = None,
+        backend: str = "llama.cpp",
+    ):
+        """``llama_kwargs`` go to each worker's backend constructor (see backends.py)."""
+        self.model_path = model_path
+        self.backend = backend
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.max_retries = max_retries
+        self.n_threads = n_threads or max(1, (os.cpu_count() or 1) // self.workers)
+        self.llama_kwargs = {
+            "n_ctx": n_ctx,
+            "n_batch": 512,
+            "n_threads": self.n_threads,
+            "n_threads_batch": self.n_threads,
+            "use_mmap": True,
+            "verbose": False,
+            **(llama_kwargs or {}),
+        }
+        # Scheduler-compatible sizing: one sequence per worker
+        self.n_ctx_seq = n_ctx
+        self.n_ctx = n_ctx * self.workers
+        self.max_batch = self.workers
+
+        # Tokenization (prompt budgets, long-doc chunking) stays in this process
+        self.tokenizer = load_backend(backend, model_path, vocab_only=True, verbose=False)
+        self._mp = mp.get_context("spawn")
+        self._lock = threading.Lock()
+        self._affinity: "OrderedDict[str, int]" = OrderedDict()
+        self._avg_job_seconds = 10.0
+        self.completed = 0
+        self.rejected = 0
+        self.retried = 0
+        self._closed = False
+
+        self._workers = [_Worker(i) for i in range(self.workers)]
+        for worker in self._workers:
+            self._start(worker)
+        for worker in self._workers:
+            threading.Thread(target=self._feed, args=(worker,), name=f"edgewriter-pool-{worker.index}", daemon=True).start()
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        return self.tokenizer.tokenize(text, add_bos=add_bos, special=special)
+
+    def detokenize(self, tokens: List[int]) -> bytes:
+        return self.tokenizer.detokenize(tokens)
+
+    def submit(
+        self,
+        prompt: Prompt,
+        session: Optional[str] = None,
+        speculative: int = 0,
+        deadline: Optional[float] = None,
+        priority: str = "normal",
+        **params,
+    ) -> PoolJob:
+        """
+        Queue a completion on the least loaded worker (or the session's worker).
+        ``speculative`` is accepted for Scheduler compatibility and ignored.
+        """
+        job = PoolJob(prompt, params, session, deadline, priority_rank(priority))
+        with self._lock:
+            waiting = sum(w.queue.qsize() for w in self._workers)
+            if waiting >= self.max_queue:
+                self.rejected += 1
+                raise QueueFullError(waiting, self._retry_after(waiting))
+            worker = self._pick(session)
+            worker.queue.put((job.priority, job.id, job))
+        return track(job)
+
+    def __call__(self, prompt: Prompt, stream: bool = False, echo: bool = False, **params):
+        job = self.submit(prompt, **params)
+        return job.stream() if stream else job.result()
+
+    def drop_session(self, session: str):
+        with self._lock:
+            self._affinity.pop(session, None)
+
+    def close(self):
+        self._closed = True
+        for worker in self._workers:
+            worker.queue.put((len(PRIORITIES), 0, None))
+            try:
+                worker.conn.send(("stop", None, None))
+            except (OSError, AttributeError):
+                pass
+
+    def stats(self) -> Dict:
+        with self._lock:
+            workers = [
+                {
+                    "index": w.index,
+                    "pid": w.pid,
+                    "alive": bool(w.process and w.process.is_alive()),
+                    "ready": w.ready,
+                    "busy": w.busy,
+                    "queued": w.queue.qsize(),
+                    "completed": w.completed,
+                    "restarts": w.restarts,
+                }
+                for w in self._workers
+            ]
+        return {
+            "mode": "pool",
+            "workers": workers,
+            "threadsPerWorker": self.n_threads,
+            "queueDepth": sum(w["queued"] for w in workers),
+            "running": sum(1 for w in workers if w["busy"]),
+            "maxBatch": self.max_batch,
+            "maxQueue": self.max_queue,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "retried": self.retried,
+        }
+
+    # --- internals ---
+
+    def _retry_after(self, waiting: int) -> int:
+        ahead = waiting + sum(1 for w in self._workers if w.busy)
+        return max(1, math.ceil(self._avg_job_seconds * ahead / self.workers))
+
+    def _pick(self, session: Optional[str]) -> _Worker:
+        if session is not None and session in self._affinity:
+            self._affinity.move_to_end(session)
+            return self._workers[self._affinity[session]]
+        worker = min(self._workers, key=lambda w: (w.queue.qsize() + w.busy, w.index))
+        if session is not None:
+            self._affinity[session] = worker.index
+            while len(self._affinity) > MAX_AFFINITY:
+                self._affinity.popitem(last=False)
+        return worker
+
+    def _start(self, worker: _Worker):
+        parent_conn, child_conn = self._mp.Pipe()
+        worker.process = self._mp.Process(
+            target=_worker_main,
+            args=(child_conn, self.backend, self.model_path, self.llama_kwargs),
+            name=f"edgewriter-worker-{worker.index}",
+            daemon=True,
+        )
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+        worker.ready = False
+
+    def _restart(self, worker: _Worker):
+        try:
+            worker.process.kill()
+            worker.process.join(5)
+        except Exception:
+            pass
+        worker.restarts += 1
+        print(f"[pool] Restarting worker {worker.index} (restart #{worker.restarts})")
+        self._start(worker)
+
+    def _wait_ready(self, worker: _Worker):
+        while not worker.conn.poll(0.5):
+            if not worker.process.is_alive():
+                raise EOFError(f"exited with code {worker.process.exitcode} while loading")
+        kind, _, pid = worker.conn.recv()
+        worker.pid = pid
+        worker.ready = True
+        print(f"✓ Worker {worker.index} ready (pid {pid}, {self.n_threads} threads)")
+
+    def _feed(self, worker: _Worker):
+        while True:
+            if not worker.ready:
+                try:
+                    self._wait_ready(worker)
+                except (EOFError, OSError) as e:
+                    if self._closed:
+                        return
+                    print(f"[pool] Worker {worker.index} failed to start ({e})")
+                    time.sleep(1)
+                    self._restart(worker)
+                    continue
+            _, _, job = worker.queue.get()
+            if job is None:
+                return
+            reason = job.stop_reason(time.time())
+            if reason:
+                job._put("done", {"finish_reason": reason, "usage": {}})
+                continue
+            worker.busy = True
+            job.started_at = time.time()
+            while True:
+                try:
+                    if not worker.ready:
+                        self._wait_ready(worker)
+                    worker.conn.send(("run", job.id, (job.prompt, job.params)))
+                    self._relay(worker, job)
+                    break
+                except (EOFError, OSError) as e:
+                    e = str(e) or type(e).__name__
+                    if self._closed:
+                        job._put("error", "Worker pool is shutting down")
+                        break
+                    self._restart(worker)
+                    job.attempts += 1
+                    if job.attempts > self.max_retries or (job.chunks_sent and not job.buffered):
+                        job._put("error", f"Worker {worker.index} died: {e}")
+                        break
+                    if job.chunks_sent:
+                        job._put("reset")
+                        job.chunks_sent = 0
+                    self.retried += 1
+                    print(f"[pool] Worker {worker.index} died ({e}); retrying request {job.id}")
+            worker.busy = False
+            if job.finished_at and not job.cancelled:
+                worker.completed += 1
+                self.completed += 1
+                self._avg_job_seconds = 0.8 * self._avg_job_seconds + 0.2 * (job.finished_at - job.started_at)
+
+    def _relay(self, worker: _Worker, job: PoolJob):
+        cancel_sent = False
+        while True:
+            reason = None if cancel_sent else job.stop_reason(time.time())
+            if reason:
+                worker.conn.send(("cancel", job.id, reason))
+                cancel_sent = True
+            if not worker.conn.poll(0.1):
+                if not worker.process.is_alive():
+                    raise EOFError(f"exited with code {worker.process.exitcode}")
+                continue
+            kind, req_id, payload = worker.conn.recv()
+            if req_id != job.id:
+                continue
+            if kind == "chunk":
+                job.chunks_sent += 1
+                job._put("chunk", payload)
+            else:
+                job._put(kind, payload)
+                return
@@ -834,6 +834,30 @@ async function cacheModel(response) {
   }
 }
 
+// === Live telemetry ===
+// One SSE stream from the server's background sampler: no polling and no
+// subprocess per update
+function startTelemetryStream() {
+  const live = document.getElementById('hw-live');
+  if (!live || !window.EventSource) return;
+  const source = new EventSource('/api/telemetry/stream');
+  source.addEventListener('sample', (event) => {
+    const s = JSON.parse(event.data);
+    const parts = [
+      `CPU ${Math.round(s.cpuPercent)}%`,
+      `RAM ${s.ramUsedGB.toFixed(1)}/${s.ramGB} GB`,
+      `Server ${Math.round(s.processRssMB)} MB`
+    ];
+    const gpu = (s.gpus || []).find(g => g.utilization != null);
+    if (gpu) {
+      parts.push(`GPU ${gpu.utilization}% (${(gpu.memoryUsedMB / 1024).toFixed(1)}/${(gpu.memoryTotalMB / 1024).toFixed(1)} GB)`);
+    }
+    live.textContent = `Live: ${parts.join(' • ')}`;
+  });
+  // EventSource reconnects by itself
+  source.onerror = () => { live.textContent = 'Live: --'; };
+}
+
 async function init() {
   // Wait for hardware detection to complete
   if (!hardwareDetectionComplete) {
@@ -1112,4 +1136,5 @@ submit.disabled = false;
   applyForceHighPerformanceFlag();
   await detectHardware();
   console.log(`Hardware detection complete: integratedOnly=${integratedOnly}, lowResourceMode=${lowResourceMode}`);
-})();
\ No newline at end of file
+})();
+startTelemetryStream();
\ No newline at end of file
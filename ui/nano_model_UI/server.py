@@ -5,7 +5,6 @@ Integrates GPU detection with forced high-performance GPU browser launch
 """
 
 import http.server
-import socketserver
 import subprocess
 import tempfile
 import shutil
@@ -16,9 +15,20 @@ import os
 import psutil
 import time
 import threading
+import uuid
+from email.utils import formatdate
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from edgewriter.http_ranges import file_etag, multipart_parts, not_modified, parse_ranges, range_applies
+from edgewriter.telemetry import TelemetrySampler
 
 PORT = 8000
 URL = f"http://localhost:{PORT}"
+# Hardware telemetry (/api/telemetry): seconds between samples and how many
+# samples are kept
+TELEMETRY_INTERVAL = float(os.environ.get("EDGEWRITER_TELEMETRY_INTERVAL", "2"))
+TELEMETRY_HISTORY = int(os.environ.get("EDGEWRITER_TELEMETRY_HISTORY", "300"))
 
 # Create temporary Chrome profile (so flags don't affect your main Chrome)
 temp_profile = tempfile.mkdtemp(prefix="edgewriter_gpu_force_")
@@ -124,6 +134,9 @@ def get_system_info():
 
     return {"ramGB": ram_gb}
 
+# nvidia-smi/wmic run once in the sampler thread, not per request
+telemetry = TelemetrySampler(get_gpu_info, TELEMETRY_INTERVAL, TELEMETRY_HISTORY)
+
 def find_browser():
     """Find Chrome or Edge executable"""
     if sys.platform == 'win32':
@@ -159,23 +172,150 @@ def find_browser():
     return None
 
 class Handler(http.server.SimpleHTTPRequestHandler):
-    """HTTP handler with GPU info API endpoint"""
-    
+    """
+    HTTP/1.1 handler with GPU info API endpoint. Files are served with
+    keep-alive, ETag/Last-Modified revalidation (304) and byte ranges (206,
+    multipart for several, 416 when unsatisfiable); bodies go out through
+    socket.sendfile, which uses os.sendfile where the platform has it.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Seconds an idle keep-alive connection holds its thread
+    timeout = 30
+
     def log_message(self, format, *args):
         """Silent logging for cleaner output"""
         pass
-    
+
     def do_GET(self):
-        if self.path == '/api/gpu-info':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            gpus = get_gpu_info()
-            system = get_system_info()
-            self.wfile.write(json.dumps({"gpus": gpus, **system}).encode('utf-8'))
+        url = urlsplit(self.path)
+        if url.path == '/api/gpu-info':
+            # GPUs and RAM from the latest telemetry sample
+            sample = telemetry.latest()
+            self.send_json(sample if sample is not None else {"gpus": [], **get_system_info()})
+        elif url.path == '/api/telemetry':
+            limit = int(parse_qs(url.query).get('limit', ['0'])[0] or 0)
+            self.send_json({"interval": telemetry.interval, "samples": telemetry.history(limit or None)})
+        elif url.path == '/api/telemetry/stream':
+            self.stream_telemetry()
         else:
-            super().do_GET()
+            self.serve_file(head_only=False)
+
+    def send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_telemetry(self):
+        """Server-Sent Events: the latest sample, then a ``sample`` event as each new one is taken."""
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        # No Content-Length: the stream ends when the connection does
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        sample = telemetry.latest()
+        seq = 0
+        while server_running:
+            if sample is None:
+                self.wfile.write(b": keep-alive\n\n")
+            else:
+                seq = sample["seq"]
+                self.wfile.write(f"event: sample\ndata: {json.dumps(sample)}\n\n".encode('utf-8'))
+            sample = telemetry.wait(seq, timeout=15)
+
+    def do_HEAD(self):
+        self.serve_file(head_only=True)
+
+    def serve_file(self, head_only):
+        url_path = self.path.split('?', 1)[0].split('#', 1)[0]
+        path = self.translate_path(self.path)
+        if url_path.endswith('/') or not os.path.isfile(path):
+            # Directories, index.html redirects and 404s
+            if head_only:
+                super().do_HEAD()
+            else:
+                super().do_GET()
+            return
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+        with f:
+            self._send_file(f, self.guess_type(path), head_only)
+
+    def _send_file(self, f, media_type, head_only):
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        etag = file_etag(st)
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+        validators = {"Accept-Ranges": "bytes", "ETag": etag, "Last-Modified": last_modified}
+
+        if not_modified(self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since'), etag, st.st_mtime):
+            self._send_head(304, validators)
+            return
+
+        ranges = None
+        range_header = self.headers.get('Range')
+        if range_header and range_applies(self.headers.get('If-Range'), etag, last_modified):
+            ranges = parse_ranges(range_header, size)
+        if ranges == []:
+            self._send_head(416, {**validators, "Content-Range": f"bytes */{size}", "Content-Length": "0"})
+            return
+
+        if not ranges:
+            self._send_head(200, {**validators, "Content-Type": media_type, "Content-Length": str(size)})
+            if not head_only and size:
+                self.connection.sendfile(f, 0, size)
+            return
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self._send_head(206, {
+                **validators,
+                "Content-Type": media_type,
+                "Content-Range": f"bytes {start}-{end}/{size}",
+                "Content-Length": str(end - start + 1),
+            })
+            if not head_only:
+                self.connection.sendfile(f, start, end - start + 1)
+            return
+
+        boundary = uuid.uuid4().hex
+        parts, closing, length = multipart_parts(ranges, size, media_type, boundary)
+        self._send_head(206, {
+            **validators,
+            "Content-Type": f"multipart/byteranges; boundary={boundary}",
+            "Content-Length": str(length),
+        })
+        if head_only:
+            return
+        for i, (part, (start, end)) in enumerate(zip(parts, ranges)):
+            self.wfile.write((b"\r\n" if i else b"") + part)
+            self.connection.sendfile(f, start, end - start + 1)
+        self.wfile.write(closing)
+
+    def _send_head(self, status, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+class Server(http.server.ThreadingHTTPServer):
+    """One thread per connection, so a weights.bin download does not hold up the page's other requests."""
+
+    def handle_error(self, request, client_address):
+        # Tabs closed or reloaded mid-download, idle keep-alive connections timing out
+        if isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            return
+        super().handle_error(request, client_address)
 
 def launch_browser_with_gpu_force(browser_path):
     global browser_process
@@ -328,7 +468,8 @@ def main():
     
     # Start HTTP server
     global httpd_ref
-    with socketserver.TCPServer(("", PORT), Handler) as httpd:
+    telemetry.start()
+    with Server(("", PORT), Handler) as httpd:
         httpd_ref = httpd
         try:
             httpd.serve_forever()
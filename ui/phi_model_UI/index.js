@@ -193,6 +193,30 @@ function renderMarkdownBasic(text) {
   return working;
 }
 
+// === Live telemetry ===
+// One SSE stream from the server's background sampler: no polling and no
+// subprocess per update
+function startTelemetryStream() {
+  const live = document.getElementById('hw-live');
+  if (!live || !window.EventSource) return;
+  const source = new EventSource('/api/telemetry/stream');
+  source.addEventListener('sample', (event) => {
+    const s = JSON.parse(event.data);
+    const parts = [
+      `CPU ${Math.round(s.cpuPercent)}%`,
+      `RAM ${s.ramUsedGB.toFixed(1)}/${s.ramGB} GB`,
+      `Server ${Math.round(s.processRssMB)} MB`
+    ];
+    const gpu = (s.gpus || []).find(g => g.utilization != null);
+    if (gpu) {
+      parts.push(`GPU ${gpu.utilization}% (${(gpu.memoryUsedMB / 1024).toFixed(1)}/${(gpu.memoryTotalMB / 1024).toFixed(1)} GB)`);
+    }
+    live.textContent = `Live: ${parts.join(' • ')}`;
+  });
+  // EventSource reconnects by itself
+  source.onerror = () => { live.textContent = 'Live: --'; };
+}
+
 // Detect hardware
 async function detectHardware() {
   // Platform detection
@@ -574,6 +598,7 @@ updateCounts();
 detectHardware().then(() => {
   console.log("🖥️ [EdgeWriter] Hardware detection complete");
 });
+startTelemetryStream();
 checkServerStatus().then(ready => {
   if (ready) {
     console.log("✅ [EdgeWriter] Ready to generate!");